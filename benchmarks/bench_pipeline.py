@@ -0,0 +1,309 @@
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import resource
+import argparse
+import tempfile
+import subprocess
+import pyarrow as pa
+import pyarrow.dataset as ds
+
+from pathlib import Path
+from datetime import datetime
+
+# Add the src directory to sys.path to get the stages of the pipeline
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
+
+from synthetic_data import get_env_variables, write_workspace
+
+# Stages timed by the benchmark, in the order they run, with the entries of the config
+# file holding the name of their output
+STAGES = {
+    "load_city_codes": ("loading_layer", "city_codes", "LOADED_FILES_PATH"),
+    "process_city_codes": ("processing_layer", "city_codes", "PROCESSED_FILES_PATH"),
+    "load_weather_data": ("loading_layer", "weather_data", "LOADED_FILES_PATH"),
+    "process_weather_data": (
+        "processing_layer",
+        "weather_data",
+        "PROCESSED_FILES_PATH",
+    ),
+}
+
+
+def get_stage_function(stage: str):
+    """
+    Imports the function of the stage 'stage'.
+
+    Args:
+        stage (str): the name of the stage, one of STAGES.
+
+    Returns:
+        callable: the function of the stage.
+    """
+
+    if stage == "load_city_codes":
+        from loading.loading_city_codes import load_city_codes
+
+        return load_city_codes
+    if stage == "process_city_codes":
+        from processing.processing_city_codes import process_city_codes
+
+        return process_city_codes
+    if stage == "load_weather_data":
+        from loading.loading_weather_data import load_weather_data
+
+        return load_weather_data
+    if stage == "process_weather_data":
+        from processing.processing_weather_data import process_weather_data
+
+        return process_weather_data
+
+    raise ValueError(f"Unknown stage {stage}.")
+
+
+def get_stage_output(workspace: Path, stage: str) -> tuple:
+    """
+    Gets the size and the number of rows of the output of the stage 'stage'.
+
+    Args:
+        workspace (Path): the directory of the workspace.
+        stage (str): the name of the stage, one of STAGES.
+
+    Returns:
+        tuple: the size of the output, in bytes, and its number of rows (None if there is
+        no output). The size includes the files written next to the output (manifest,
+        state, fingerprint, index).
+    """
+
+    layer, table, path_variable = STAGES[stage]
+
+    with open(Path(workspace) / "config_file.json", "r") as f:
+        config = json.load(f)
+
+    directory = get_env_variables(workspace)[path_variable]
+    table_name = config.get(layer, {}).get(table, {}).get("table_name")
+
+    # The files of a stage are prefixed with the name of its table, e.g. weather_data_*
+    size = sum(
+        os.path.getsize(Path(root) / file)
+        for entry in os.listdir(directory)
+        if entry.startswith(table)
+        for root, _, files in (
+            os.walk(directory / entry)
+            if os.path.isdir(directory / entry)
+            else [(directory, [], [entry])]
+        )
+        for file in files
+    )
+
+    output_path = directory / table_name
+    if not os.path.exists(output_path):
+        output_path = directory / f"{table_name}.parquet"
+
+    rows = None
+    if os.path.exists(output_path):
+        rows = ds.dataset(
+            output_path,
+            format="parquet",
+            exclude_invalid_files=True,
+            ignore_prefixes=[".", "_"],
+        ).count_rows()
+
+    return size, rows
+
+
+def run_stage(workspace: Path, stage: str) -> dict:
+    """
+    Runs the stage 'stage' on the workspace 'workspace', in the current process, and
+    measures it. Meant to run in a subprocess of its own (see measure_stage), so the peak
+    resident memory is that of the stage.
+
+    Args:
+        workspace (Path): the directory of the workspace.
+        stage (str): the name of the stage, one of STAGES.
+
+    Returns:
+        dict: the wall time and CPU time of the stage, in seconds, and the peak resident
+        memory of the process, in MB.
+    """
+
+    from utils.pipeline_context import PipelineContext
+
+    env_variables = get_env_variables(workspace)
+    with open(env_variables["CONFIG_PATH"], "r") as f:
+        config = json.load(f)
+
+    function = get_stage_function(stage)
+    context = PipelineContext(env_variables=env_variables, config=config)
+
+    start_wall, start_cpu = time.perf_counter(), time.process_time()
+    function(context=context)
+    wall_time = time.perf_counter() - start_wall
+    cpu_time = time.process_time() - start_cpu
+
+    return {
+        "wall_time": wall_time,
+        "cpu_time": cpu_time,
+        # ru_maxrss is given in KB on Linux, and in bytes on macOS
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        / (1024 * 1024 if sys.platform == "darwin" else 1024),
+    }
+
+
+def measure_stage(workspace: Path, stage: str, rows_in: int) -> dict:
+    """
+    Runs the stage 'stage' in a subprocess and gathers its measurements. The logs of the
+    stage are written to <workspace>/<stage>.log.
+
+    Args:
+        workspace (Path): the directory of the workspace.
+        stage (str): the name of the stage, one of STAGES.
+        rows_in (int): the number of rows read by the stage.
+
+    Returns:
+        dict: the measurements of the stage, see run_stage, with its throughput (rows read
+        per second), the size of its output and its number of rows.
+    """
+
+    with open(Path(workspace) / f"{stage}.log", "w") as log:
+        completed = subprocess.run(
+            [sys.executable, __file__, "--run-stage", stage, "--workspace", workspace],
+            stdout=subprocess.PIPE,
+            stderr=log,
+            check=True,
+        )
+
+    result = json.loads(completed.stdout.decode().strip().splitlines()[-1])
+    output_bytes, rows_out = get_stage_output(workspace, stage)
+
+    return {
+        "stage": stage,
+        "rows_in": rows_in,
+        "rows_out": rows_out,
+        **result,
+        "throughput_rows_per_sec": rows_in / result["wall_time"],
+        "output_bytes": output_bytes,
+    }
+
+
+def benchmark_scale(
+    workspace: Path,
+    n_observations: int,
+    n_cities: int,
+    n_city_list: int,
+    seed: int,
+) -> dict:
+    """
+    Generates the synthetic data of one scale in 'workspace', and runs the stages on it.
+
+    Args:
+        workspace (Path): the directory of the workspace, created empty.
+        n_observations (int): the number of weather measurements.
+        n_cities (int): the number of cities with measurements.
+        n_city_list (int): the number of cities in the city list.
+        seed (int): the seed of the random number generators.
+
+    Returns:
+        dict: the parameters of the scale and the measurements of each stage.
+    """
+
+    n_cities = min(n_cities, n_observations)
+    n_timestamps = -(-n_observations // n_cities)
+
+    start = time.perf_counter()
+    write_workspace(
+        workspace=workspace,
+        n_cities=n_cities,
+        n_timestamps=n_timestamps,
+        n_city_list=n_city_list,
+        seed=seed,
+    )
+    generation_time = time.perf_counter() - start
+
+    rows_in = {
+        "load_city_codes": max(n_city_list, n_cities),
+        "process_city_codes": max(n_city_list, n_cities),
+        "load_weather_data": n_cities * n_timestamps,
+        "process_weather_data": n_cities * n_timestamps,
+    }
+
+    stages = []
+    for stage in STAGES:
+        stages.append(measure_stage(workspace, stage, rows_in[stage]))
+        print(
+            f"{n_cities * n_timestamps:>10,} observations {stage:>20}: "
+            f"{stages[-1]['wall_time']:>8.2f}s "
+            f"{stages[-1]['throughput_rows_per_sec']:>12,.0f} rows/sec "
+            f"{stages[-1]['peak_rss_mb']:>8.0f} MB",
+            file=sys.stderr,
+        )
+
+    return {
+        "observations": n_cities * n_timestamps,
+        "cities": n_cities,
+        "timestamps": n_timestamps,
+        "city_list": max(n_city_list, n_cities),
+        "generation_time": generation_time,
+        "stages": stages,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark of the loading and processing stages on synthetic data."
+    )
+    parser.add_argument(
+        "--scales", type=int, nargs="+", default=[1_000, 100_000, 1_000_000]
+    )
+    parser.add_argument("--cities", type=int, default=1000)
+    parser.add_argument("--city-list", type=int, default=200_000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=Path, default=Path("bench_pipeline.json"))
+    parser.add_argument("--workspace", type=Path, default=None)
+    parser.add_argument("--keep", action="store_true")
+    parser.add_argument("--run-stage", choices=list(STAGES), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    # Run a single stage, from measure_stage
+    if args.run_stage:
+        print(json.dumps(run_stage(args.workspace, args.run_stage)))
+        sys.exit(0)
+
+    root = args.workspace or Path(tempfile.mkdtemp(prefix="bench_pipeline_"))
+    results = {
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "pyarrow": pa.__version__,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "scales": [],
+    }
+
+    try:
+        for n_observations in args.scales:
+            workspace = root / f"observations_{n_observations}"
+            shutil.rmtree(workspace, ignore_errors=True)
+
+            results["scales"].append(
+                benchmark_scale(
+                    workspace=workspace,
+                    n_observations=n_observations,
+                    n_cities=args.cities,
+                    n_city_list=args.city_list,
+                    seed=args.seed,
+                )
+            )
+
+            if not args.keep:
+                shutil.rmtree(workspace, ignore_errors=True)
+    finally:
+        if not args.keep and args.workspace is None:
+            shutil.rmtree(root, ignore_errors=True)
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=4)
+
+    print(f"Results written to {args.output}.", file=sys.stderr)
@@ -0,0 +1,179 @@
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+from pathlib import Path
+
+# Add the src directory to sys.path to get the query API
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
+
+from synthetic_data import FIRST_CITY_ID, FIRST_DT, get_env_variables
+from query.query_weather_data import query_weather
+from utils.auxiliary_functions import (
+    PROCESSED_WEATHER_DATA_PARTITIONING,
+    publish_staged_fragments,
+    stage_dataset_fragments,
+)
+from utils.pipeline_context import PipelineContext
+
+
+def make_processed_day(
+    rng: np.random.Generator, day: int, n_cities: int, n_timestamps: int
+) -> pa.Table:
+    """
+    Builds a synthetic day of processed weather data, with the main columns of the processed
+    table, ordered by city ID and timestamp as written by process_weather_data.
+
+    Args:
+        rng (Generator): the random number generator.
+        day (int): the number of the day, from the first synthetic timestamp.
+        n_cities (int): the number of cities.
+        n_timestamps (int): the number of measurements of each city during the day.
+
+    Returns:
+        pa.Table: the day, with the 'date' partition column.
+    """
+
+    n_rows = n_cities * n_timestamps
+    dt = (
+        FIRST_DT
+        + day * 86400
+        + np.tile(np.arange(n_timestamps) * (86400 // n_timestamps), n_cities)
+    )
+    time_value = pd.to_datetime(dt, unit="s")
+
+    return pa.table(
+        {
+            "time_value": pa.array(time_value.to_numpy(), type=pa.timestamp("ns")),
+            "city_id": np.repeat(np.arange(n_cities) + FIRST_CITY_ID, n_timestamps),
+            "weather_id": rng.choice([800, 801, 803, 500, 600], n_rows),
+            "temperature": rng.uniform(-10, 40, n_rows),
+            "humidity": rng.integers(0, 100, n_rows),
+            "wind_speed": rng.uniform(0, 20, n_rows),
+            "ingestion_date": pa.array(
+                np.full(n_rows, np.datetime64("now", "ns")), type=pa.timestamp("ns")
+            ),
+            "date": pa.array(time_value.strftime("%Y-%m-%d")),
+        }
+    )
+
+
+def benchmark_history(
+    workspace: Path,
+    n_days: int,
+    n_cities: int,
+    n_timestamps: int,
+    repeat: int,
+    seed: int,
+) -> dict:
+    """
+    Writes 'n_days' days of processed weather data to 'workspace' and times the query of
+    the last day of one city.
+
+    Args:
+        workspace (Path): the directory of the workspace, created empty.
+        n_days (int): the number of days of history.
+        n_cities (int): the number of cities.
+        n_timestamps (int): the number of measurements of each city per day.
+        repeat (int): the number of times the query is run. The best time is kept.
+        seed (int): the seed of the random number generator.
+
+    Returns:
+        dict: the size of the history and the time of the query.
+    """
+
+    env_variables = get_env_variables(workspace)
+    with open(Path(__file__).parent.parent / "config" / "config_file.json", "r") as f:
+        config = json.load(f)
+    context = PipelineContext(env_variables=env_variables, config=config)
+
+    dataset_path = env_variables["PROCESSED_FILES_PATH"] / (
+        config["processing_layer"]["weather_data"]["table_name"]
+    )
+
+    # One batch per day, as written by the runs of the day once compacted
+    rng = np.random.default_rng(seed)
+    for day in range(n_days):
+        batch_id = f"day{day:05d}"
+        stage_dataset_fragments(
+            table=make_processed_day(rng, day, n_cities, n_timestamps),
+            dataset_path=dataset_path,
+            batch_id=batch_id,
+            partitioning=PROCESSED_WEATHER_DATA_PARTITIONING,
+        )
+        publish_staged_fragments(dataset_path=dataset_path, batch_id=batch_id)
+    shutil.rmtree(dataset_path / "_staging")
+
+    last_day = pd.to_datetime(FIRST_DT + (n_days - 1) * 86400, unit="s").normalize()
+    timings = []
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = query_weather(
+            city_ids=[FIRST_CITY_ID + n_cities // 2],
+            start=last_day,
+            end=last_day + pd.Timedelta(days=1),
+            columns=["city_id", "time_value", "temperature"],
+            context=context,
+        )
+        timings.append(time.perf_counter() - start)
+
+    return {
+        "days": n_days,
+        "history_rows": n_days * n_cities * n_timestamps,
+        "rows_returned": result.num_rows,
+        "query_time": min(timings),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark of the query of the last day of a city, as the history grows."
+    )
+    parser.add_argument("--days", type=int, nargs="+", default=[7, 30, 90, 365])
+    parser.add_argument("--cities", type=int, default=1000)
+    parser.add_argument("--timestamps", type=int, default=48)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=Path, default=Path("bench_query.json"))
+    args = parser.parse_args()
+
+    # Silence the logs of the query API
+    logging.getLogger("query_weather_data").setLevel(logging.WARNING)
+
+    root = Path(tempfile.mkdtemp(prefix="bench_query_"))
+    results = []
+
+    try:
+        for n_days in args.days:
+            results.append(
+                benchmark_history(
+                    workspace=root / f"days_{n_days}",
+                    n_days=n_days,
+                    n_cities=args.cities,
+                    n_timestamps=args.timestamps,
+                    repeat=args.repeat,
+                    seed=args.seed,
+                )
+            )
+            print(
+                f"{results[-1]['history_rows']:>12,} rows of history: "
+                f"{results[-1]['query_time'] * 1000:>8.1f} ms "
+                f"({results[-1]['rows_returned']} rows returned)",
+                file=sys.stderr,
+            )
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=4)
+
+    print(f"Results written to {args.output}.", file=sys.stderr)
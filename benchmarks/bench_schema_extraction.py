@@ -0,0 +1,139 @@
+import os
+import sys
+import json
+import time
+import random
+import logging
+import argparse
+
+from pathlib import Path
+
+# Add the src directory to sys.path to get the functions in utils
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
+
+from utils.auxiliary_functions import (
+    compile_schema,
+    extract_row,
+    flatten_json,
+    flatten_schema,
+)
+
+
+def make_document(city_id: int, dt: int) -> dict:
+    """
+    Builds a synthetic document with the shape of a response of the current weather API.
+
+    Args:
+        city_id (int): the city ID.
+        dt (int): the timestamp of the measurement, in seconds since the epoch.
+
+    Returns:
+        dict: the document.
+    """
+
+    return {
+        "coord": {"lon": random.uniform(-180, 180), "lat": random.uniform(-90, 90)},
+        "weather": [
+            {"id": 800, "main": "Clear", "description": "clear sky", "icon": "01d"}
+        ],
+        "base": "stations",
+        "main": {
+            "temp": random.uniform(-10, 40),
+            "feels_like": random.uniform(-10, 40),
+            "temp_min": random.uniform(-10, 40),
+            "temp_max": random.uniform(-10, 40),
+            "pressure": random.randint(980, 1040),
+            "humidity": random.randint(0, 100),
+            "sea_level": random.randint(980, 1040),
+            "grnd_level": random.randint(980, 1040),
+        },
+        "visibility": 10000,
+        "wind": {"speed": random.uniform(0, 20), "deg": random.randint(0, 360)},
+        "clouds": {"all": random.randint(0, 100)},
+        "dt": dt,
+        "sys": {
+            "type": 2,
+            "id": 2012,
+            "country": "PT",
+            "sunrise": dt - 21600,
+            "sunset": dt + 21600,
+        },
+        "timezone": 3600,
+        "id": city_id,
+        "name": f"City {city_id}",
+        "cod": 200,
+    }
+
+
+def benchmark_flatten_json(documents: list, schema: dict, logger: logging.Logger):
+    """
+    Extracts the documents as the loading layer used to: flatten each document recursively
+    and fill the fields of the schema that are missing from it.
+    """
+
+    schema_flattened = flatten_schema(schema_dict=schema, logger=logger)
+    rows = []
+
+    for document in documents:
+        data_flattened = flatten_json(data_json=document, logger=logger)
+        missing_fields = set(schema_flattened) - set(data_flattened)
+
+        for field in missing_fields:
+            data_flattened[field] = None
+
+        rows.append(data_flattened)
+
+    return rows
+
+
+def benchmark_compiled_schema(documents: list, schema: dict, logger: logging.Logger):
+    """
+    Extracts the documents with the schema compiled once into key-path extractors.
+    """
+
+    extractors = compile_schema(schema_dict=schema)
+
+    return [
+        extract_row(document=document, extractors=extractors) for document in documents
+    ]
+
+
+def _timed(function, documents: list, schema: dict, logger: logging.Logger) -> float:
+    """
+    Times one call to 'function', in seconds.
+    """
+
+    start = time.perf_counter()
+    function(documents, schema, logger)
+
+    return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Microbenchmark of the extraction of the raw weather documents."
+    )
+    parser.add_argument("--documents", type=int, default=100_000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    config_path = Path(__file__).parent.parent / "config" / "config_file.json"
+    with open(config_path, "r") as f:
+        schema = json.load(f)["ingestion_layer"]["weather_data"]["fields"]
+
+    random.seed(0)
+    documents = [make_document(i % 1000, 1753600000 + i) for i in range(args.documents)]
+
+    # Log as the pipeline does, to a stream handler, but discard the output
+    logger = logging.getLogger("bench_schema_extraction")
+    logger.setLevel(logging.INFO)
+    logger.addHandler(logging.StreamHandler(open(os.devnull, "w")))
+
+    for name, function in [
+        ("flatten_json", benchmark_flatten_json),
+        ("compiled_schema", benchmark_compiled_schema),
+    ]:
+        best = min(
+            _timed(function, documents, schema, logger) for _ in range(args.repeat)
+        )
+        print(f"{name:>16}: {args.documents / best:>12,.0f} docs/sec")
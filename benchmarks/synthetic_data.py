@@ -0,0 +1,287 @@
+import os
+import sys
+import json
+import random
+import string
+import argparse
+
+from pathlib import Path
+
+# Add the src directory to sys.path to get the functions in utils
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
+
+from utils.raw_batch_writer import NDJSONBatchWriter
+
+# First city ID of the synthetic city list, far from the IDs used by OpenWeather
+FIRST_CITY_ID = 10_000_000
+
+# Timestamp of the first synthetic measurement, in seconds since the epoch
+FIRST_DT = 1753600000
+
+COUNTRIES = ["PT", "ES", "FR", "DE", "IT", "GB", "US", "BR"]
+
+WEATHER_CONDITIONS = [
+    (800, "Clear", "clear sky", "01d"),
+    (801, "Clouds", "few clouds", "02d"),
+    (803, "Clouds", "broken clouds", "04d"),
+    (500, "Rain", "light rain", "10d"),
+    (600, "Snow", "light snow", "13d"),
+]
+
+
+def make_city(rng: random.Random, city_id: int) -> dict:
+    """
+    Builds a synthetic city, with the shape of an entry of the bulk city list of OpenWeather.
+
+    Args:
+        rng (Random): the random number generator.
+        city_id (int): the city ID.
+
+    Returns:
+        dict: the city.
+    """
+
+    return {
+        "id": city_id,
+        "name": "".join(rng.choices(string.ascii_lowercase, k=10)).title(),
+        "state": "",
+        "country": rng.choice(COUNTRIES),
+        "coord": {
+            "lon": round(rng.uniform(-180, 180), 4),
+            "lat": round(rng.uniform(-90, 90), 4),
+        },
+    }
+
+
+def make_weather_document(rng: random.Random, city: dict, dt: int) -> dict:
+    """
+    Builds a synthetic document with the shape of a response of the current weather API,
+    covering every field of the schema in the config file. The optional fields (wind gust,
+    rain and snow) are only present in some documents, as in the API.
+
+    Args:
+        rng (Random): the random number generator.
+        city (dict): the city of the measurement, see make_city.
+        dt (int): the timestamp of the measurement, in seconds since the epoch.
+
+    Returns:
+        dict: the document.
+    """
+
+    weather_id, main, description, icon = rng.choice(WEATHER_CONDITIONS)
+    temperature = round(rng.uniform(-10, 40), 2)
+
+    document = {
+        "coord": city["coord"],
+        "weather": [
+            {"id": weather_id, "main": main, "description": description, "icon": icon}
+        ],
+        "base": "stations",
+        "main": {
+            "temp": temperature,
+            "feels_like": round(temperature + rng.uniform(-3, 3), 2),
+            "temp_min": round(temperature - rng.uniform(0, 3), 2),
+            "temp_max": round(temperature + rng.uniform(0, 3), 2),
+            "pressure": rng.randint(980, 1040),
+            "humidity": rng.randint(0, 100),
+            "sea_level": rng.randint(980, 1040),
+            "grnd_level": rng.randint(950, 1040),
+        },
+        "visibility": 10000,
+        "wind": {"speed": round(rng.uniform(0, 20), 2), "deg": rng.randint(0, 360)},
+        "clouds": {"all": rng.randint(0, 100)},
+        "dt": dt,
+        "sys": {
+            "type": 2,
+            "id": rng.randint(1, 99999),
+            "country": city["country"],
+            "sunrise": dt - 21600,
+            "sunset": dt + 21600,
+        },
+        "timezone": 3600,
+        "id": city["id"],
+        "name": city["name"],
+        "cod": 200,
+    }
+
+    if rng.random() < 0.3:
+        document["wind"]["gust"] = round(rng.uniform(0, 30), 2)
+    if main == "Rain":
+        document["rain"] = {"1h": round(rng.uniform(0, 10), 2)}
+    if main == "Snow":
+        document["snow"] = {"1h": round(rng.uniform(0, 5), 2)}
+
+    return document
+
+
+def write_city_list(path: Path, n_cities: int, seed: int = 0) -> list:
+    """
+    Writes a synthetic city list to the JSON file 'path', as the bulk city list of
+    OpenWeather (a single JSON array).
+
+    Args:
+        path (Path): the JSON file.
+        n_cities (int): the number of cities.
+        seed (int): the seed of the random number generator.
+
+    Returns:
+        list: the cities.
+    """
+
+    rng = random.Random(seed)
+    cities = [make_city(rng, FIRST_CITY_ID + i) for i in range(n_cities)]
+
+    os.makedirs(Path(path).parent, exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(cities, f)
+
+    return cities
+
+
+def write_weather_batches(
+    directory: Path,
+    cities: list,
+    n_timestamps: int,
+    interval: int = 1800,
+    seed: int = 0,
+) -> int:
+    """
+    Writes the synthetic measurements of 'cities' at 'n_timestamps' timestamps, one
+    NDJSON batch per timestamp, as written by the ingestion layer (see NDJSONBatchWriter).
+
+    Args:
+        directory (Path): the directory of the batches, i.e. <RAW_WEATHER_DATA_PATH>/_batches.
+        cities (list): the cities, see make_city.
+        n_timestamps (int): the number of timestamps.
+        interval (int): the time between two timestamps, in seconds.
+        seed (int): the seed of the random number generator.
+
+    Returns:
+        int: the number of documents written.
+    """
+
+    rng = random.Random(seed)
+    n_documents = 0
+
+    for i in range(n_timestamps):
+        dt = FIRST_DT + i * interval
+        writer = NDJSONBatchWriter(
+            directory=Path(directory), file_name=f"synthetic_{i:06d}"
+        )
+
+        for city in cities:
+            document = make_weather_document(rng, city, dt)
+            writer.write(json.dumps(document, separators=(",", ":")).encode())
+            n_documents += 1
+
+        writer.close()
+
+    return n_documents
+
+
+def get_env_variables(workspace: Path) -> dict:
+    """
+    Gets the environment variables of the workspace 'workspace', as given by
+    load_env_variables for the data directories of the repo.
+
+    Args:
+        workspace (Path): the directory of the workspace.
+
+    Returns:
+        dict: the environment variables.
+    """
+
+    workspace = Path(workspace)
+
+    return {
+        "API_KEY": None,
+        "CONFIG_PATH": workspace / "config_file.json",
+        "RAW_CITY_CODES_PATH": workspace / "raw" / "city_codes",
+        "RAW_WEATHER_CODES_PATH": workspace / "raw" / "weather_codes",
+        "RAW_WEATHER_DATA_PATH": workspace / "raw" / "weather_data",
+        "LOADED_FILES_PATH": workspace / "loaded",
+        "PROCESSED_FILES_PATH": workspace / "processed",
+        "METRICS_PATH": workspace / "metrics",
+        "PIPELINE_PROFILE": [],
+    }
+
+
+def write_workspace(
+    workspace: Path,
+    n_cities: int,
+    n_timestamps: int,
+    n_city_list: int = 200_000,
+    seed: int = 0,
+) -> dict:
+    """
+    Writes a self-contained copy of the data directories of the pipeline to 'workspace',
+    with synthetic raw data:
+        - raw/city_codes/city_codes.json: a city list of 'n_city_list' cities.
+        - raw/weather_data/_batches: the measurements of the first 'n_cities' cities of
+          the list at 'n_timestamps' timestamps.
+        - config_file.json: the config file of the repo, with no cities configured, so the
+          loading layer only reads the batches.
+
+    Args:
+        workspace (Path): the directory of the workspace.
+        n_cities (int): the number of cities with measurements.
+        n_timestamps (int): the number of timestamps.
+        n_city_list (int): the number of cities in the city list.
+        seed (int): the seed of the random number generators.
+
+    Returns:
+        dict: the environment variables of the workspace, see get_env_variables.
+    """
+
+    env_variables = get_env_variables(workspace)
+
+    for key, path in env_variables.items():
+        if key.endswith("_PATH") and key != "CONFIG_PATH":
+            os.makedirs(path, exist_ok=True)
+
+    config_path = Path(__file__).parent.parent / "config" / "config_file.json"
+    with open(config_path, "r") as f:
+        config = json.load(f)
+    config["cities"] = []
+
+    with open(env_variables["CONFIG_PATH"], "w") as f:
+        json.dump(config, f, indent=4)
+
+    cities = write_city_list(
+        path=env_variables["RAW_CITY_CODES_PATH"]
+        / config["ingestion_layer"]["city_codes"]["file_name"],
+        n_cities=max(n_city_list, n_cities),
+        seed=seed,
+    )
+    write_weather_batches(
+        directory=env_variables["RAW_WEATHER_DATA_PATH"] / "_batches",
+        cities=cities[:n_cities],
+        n_timestamps=n_timestamps,
+        seed=seed,
+    )
+
+    return env_variables
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Generates synthetic raw data for the pipeline, in a workspace."
+    )
+    parser.add_argument("workspace", type=Path)
+    parser.add_argument("--cities", type=int, default=1000)
+    parser.add_argument("--timestamps", type=int, default=100)
+    parser.add_argument("--city-list", type=int, default=200_000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    write_workspace(
+        workspace=args.workspace,
+        n_cities=args.cities,
+        n_timestamps=args.timestamps,
+        n_city_list=args.city_list,
+        seed=args.seed,
+    )
+    print(
+        f"{args.cities * args.timestamps:,} measurements of {args.cities:,} cities "
+        f"written to {args.workspace}."
+    )
@@ -0,0 +1,378 @@
+import os
+import sys
+import json
+import time
+import uuid
+import logging
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from pathlib import Path
+
+# Add parent directory to sys.path to get the functions in utils
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from utils.auxiliary_functions import (
+    PROCESSED_WEATHER_DATA_PARTITIONING,
+    WEATHER_DATA_PARTITIONING,
+    list_dataset_files,
+    sort_table,
+    write_parquet_file,
+)
+from utils.stage_metrics import current_stage_metrics
+from utils.pipeline_context import PipelineContext
+
+logger = logging.getLogger("compaction_datasets")
+logger.setLevel(logging.INFO)
+
+handler = logging.StreamHandler()
+formatter = logging.Formatter("%(asctime)s %(name)s, %(levelname)s: %(message)s")
+handler.setFormatter(formatter)
+
+logger.addHandler(handler)
+
+
+def plan_compaction(fragment_paths: list, target_file_size: int) -> list:
+    """
+    Groups the small fragments of a partition into the files they are compacted to. The
+    fragments smaller than 'target_file_size' are packed, in order, into groups whose total
+    size does not exceed it. Groups of a single fragment are left out, since compacting
+    them would only rewrite the fragment.
+
+    Args:
+        fragment_paths (list): the fragment files of the partition, in the order they were
+        written.
+        target_file_size (int): the target size of the compacted files, in bytes.
+
+    Returns:
+        list: the groups of fragments, each one a list of paths.
+    """
+
+    groups = [[]]
+    group_size = 0
+
+    for fragment_path in fragment_paths:
+        size = os.path.getsize(fragment_path)
+
+        if size >= target_file_size:
+            continue
+
+        if groups[-1] and group_size + size > target_file_size:
+            groups.append([])
+            group_size = 0
+
+        groups[-1].append(fragment_path)
+        group_size += size
+
+    return [group for group in groups if len(group) > 1]
+
+
+def drop_duplicate_rows(table: pa.Table, keys: list) -> pa.Table:
+    """
+    Drops the rows of 'table' with the same values of the 'keys' columns as a previous row,
+    keeping the first one ingested (by 'ingestion_date', if the table has it). The table is
+    returned sorted by the keys.
+
+    Args:
+        table (pa.Table): the table.
+        keys (list): the key columns, e.g. ['city_id', 'time_value'].
+
+    Returns:
+        pa.Table: the table without duplicates.
+    """
+
+    sort_by = keys
+    if "ingestion_date" in table.column_names and "ingestion_date" not in keys:
+        sort_by = keys + ["ingestion_date"]
+
+    table = sort_table(table=table, sort_by=sort_by)
+
+    if table.num_rows < 2:
+        return table
+
+    # A row is kept if any of its keys differs from the previous row
+    keep = np.ones(table.num_rows, dtype=bool)
+    keep[1:] = False
+    for key in keys:
+        values = table.column(key).to_numpy(zero_copy_only=False)
+        keep[1:] |= values[1:] != values[:-1]
+
+    return table.filter(pa.array(keep))
+
+
+def save_compaction_marker(marker_path: Path, file_name: str, replaces: list) -> None:
+    """
+    Saves the marker of a compaction, naming the compacted file and the fragments it
+    replaces (see list_dataset_files). The file is replaced atomically.
+
+    Args:
+        marker_path (Path): the marker, _compaction-<batch_id>.json in the partition.
+        file_name (str): the name of the compacted file.
+        replaces (list): the names of the fragments it replaces.
+    """
+
+    temporary_path = marker_path.parent / f".{marker_path.name}.tmp"
+
+    with open(temporary_path, "w") as f:
+        json.dump({"file": file_name, "replaces": replaces}, f)
+    os.replace(temporary_path, marker_path)
+
+
+def recover_compactions(dataset_path: Path, partitioning: list) -> None:
+    """
+    Finishes the compactions interrupted by a crash, from their markers:
+        - If the compacted file was renamed into place, the swap happened: the fragments
+          it replaces that were not removed yet are removed.
+        - Otherwise, the swap did not happen: the temporary compacted file is removed, and
+          the fragments are kept.
+    The marker is removed in both cases.
+
+    Args:
+        dataset_path (Path): the root directory of the dataset.
+        partitioning (list): the names of the partition columns, in order.
+    """
+
+    partition_pattern = "/".join(f"{column}=*" for column in partitioning)
+
+    for marker_path in sorted(
+        dataset_path.glob(f"{partition_pattern}/_compaction-*.json")
+    ):
+        partition_path = marker_path.parent
+        with open(marker_path, "r") as f:
+            marker = json.load(f)
+
+        if os.path.exists(partition_path / marker["file"]):
+            logger.info(f"Recovering compaction {marker_path}: removing the fragments.")
+            for fragment_name in marker["replaces"]:
+                if os.path.exists(partition_path / fragment_name):
+                    os.remove(partition_path / fragment_name)
+        else:
+            logger.info(f"Recovering compaction {marker_path}: discarding it.")
+            temporary_path = partition_path / f".{marker['file']}.tmp"
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+
+        os.remove(marker_path)
+
+
+def compact_partition(group: list, keys: list, layout: dict, batch_id: str) -> tuple:
+    """
+    Compacts the fragments in 'group' into a single file of the same partition, without
+    duplicate keys. The fragments are swapped for the file in a single step:
+        1. The file is written under a hidden temporary name, ignored by the readers.
+        2. A marker, _compaction-<batch_id>.json, names the file and the fragments it
+           replaces.
+        3. The file is renamed into place. From then on, the readers of the dataset (see
+           list_dataset_files) ignore the fragments named in the marker.
+        4. The fragments and the marker are removed.
+    Readers thus never see a partially written file, nor the rows of both the fragments
+    and the file, and a crash at any point is finished by recover_compactions.
+
+    Args:
+        group (list): the paths of the fragments, all in the same partition.
+        keys (list): the key columns of the dataset.
+        layout (dict): the layout of the compacted file, see get_parquet_layout.
+        batch_id (str): identifier of the compaction, used to name the file.
+
+    Returns:
+        tuple: the number of rows read, the number of rows written, the number of bytes
+        read and the number of bytes written.
+    """
+
+    bytes_read = sum(os.path.getsize(fragment_path) for fragment_path in group)
+
+    # Read the files on their own, without the partition columns of their path
+    table = pa.concat_tables(
+        [pq.ParquetFile(fragment_path).read() for fragment_path in group],
+        promote_options="permissive",
+    )
+    compacted_table = drop_duplicate_rows(table=table, keys=keys)
+
+    partition_path = Path(group[0]).parent
+    file_name = f"part-compacted-{batch_id}.parquet"
+    temporary_path = partition_path / f".{file_name}.tmp"
+
+    marker_path = partition_path / f"_compaction-{batch_id}.json"
+
+    write_parquet_file(
+        table=compacted_table, path=temporary_path, layout=layout, logger=logger
+    )
+    save_compaction_marker(
+        marker_path=marker_path,
+        file_name=file_name,
+        replaces=[Path(fragment_path).name for fragment_path in group],
+    )
+    os.replace(temporary_path, partition_path / file_name)
+
+    for fragment_path in group:
+        os.remove(fragment_path)
+    os.remove(marker_path)
+
+    return (
+        table.num_rows,
+        compacted_table.num_rows,
+        bytes_read,
+        os.path.getsize(partition_path / file_name),
+    )
+
+
+def compact_datasets(context: PipelineContext = None):
+    """
+    Compacts the Parquet datasets written incrementally by the pipeline (the loaded weather
+    data, the processed weather data and the enriched weather data), where each run adds one
+    small fragment per partition. Within each partition, the small fragments are merged into
+    files of a target size, exact duplicates of the key of the dataset (e.g. 'city_id' and
+    'time_value') are dropped, and the files are written with the layout of the dataset and
+    zstd compression, so a day with 48 runs ends up as one well-sized file per partition.
+
+    Steps:
+        1. Get the environment variables and the config.json from the context of the run,
+           built by the stage itself if it is run on its own.
+        2. Retrieve relevant fields for the task from the config.
+        3. For each dataset, finish the compactions interrupted by a crash, list the
+           fragments of each partition, ignoring the hidden and staging files, and group
+           the small ones up to the target size.
+        4. Compact the groups, starting with the partitions with the most fragments to
+           merge, until the time budget is spent. The remaining partitions are compacted
+           by the next runs.
+    """
+
+    logger.info("Starting compaction of the datasets")
+
+    # Build the context of the run, if the stage is run on its own
+    if context is None:
+        context = PipelineContext.build(
+            path=Path(__file__).parent.parent.parent, logger=logger
+        )
+        if context is None:
+            return
+
+    env_variables = context.env_variables
+    config = context.config
+
+    # Get the LOADED_FILES_PATH
+    loaded_files_path = env_variables.get("LOADED_FILES_PATH")
+
+    # Get the PROCESSED_FILES_PATH
+    processed_files_path = env_variables.get("PROCESSED_FILES_PATH")
+
+    compaction_config = config.get("compaction", {})
+    target_file_size = compaction_config.get("target_file_size_mb", 128) * 1024 * 1024
+    time_budget = compaction_config.get("time_budget_seconds", 300)
+    compression = compaction_config.get("compression", "zstd")
+
+    processing_layer = config.get("processing_layer", {})
+
+    # The datasets to compact, with their partitioning, key and layout
+    datasets = {
+        "loaded_weather_data": {
+            "path": loaded_files_path
+            / config.get("loading_layer", {})
+            .get("weather_data", {})
+            .get("table_name", "weather_data_loaded"),
+            "partitioning": WEATHER_DATA_PARTITIONING,
+            "keys": ["id", "dt"],
+            "layout": {"sort_by": ["id", "dt"]},
+        },
+        "processed_weather_data": {
+            "path": processed_files_path
+            / processing_layer.get("weather_data", {}).get(
+                "table_name", "weather_data_processed"
+            ),
+            "partitioning": PROCESSED_WEATHER_DATA_PARTITIONING,
+            "keys": ["city_id", "time_value"],
+            "layout": processing_layer.get("weather_data", {}).get("layout", {}),
+        },
+        "enriched_weather_data": {
+            "path": processed_files_path
+            / processing_layer.get("weather_data_enriched", {}).get(
+                "table_name", "weather_data_enriched"
+            ),
+            "partitioning": PROCESSED_WEATHER_DATA_PARTITIONING,
+            "keys": ["city_id", "time_value"],
+            "layout": processing_layer.get("weather_data_enriched", {}).get(
+                "layout", {}
+            ),
+        },
+    }
+
+    # Plan the compaction of every partition
+    plans = []
+
+    for name, dataset in datasets.items():
+        if not os.path.exists(dataset["path"]):
+            logger.info(f"The dataset {dataset['path']} does not exist. Skipping.")
+            continue
+
+        # Finish the compactions interrupted by a crash
+        recover_compactions(
+            dataset_path=dataset["path"], partitioning=dataset["partitioning"]
+        )
+
+        fragments_by_partition = {}
+        for fragment_path in list_dataset_files(
+            path=dataset["path"], partitioning=dataset["partitioning"]
+        ):
+            fragments_by_partition.setdefault(fragment_path.parent, []).append(
+                fragment_path
+            )
+
+        for fragment_paths in fragments_by_partition.values():
+            groups = plan_compaction(
+                fragment_paths=fragment_paths, target_file_size=target_file_size
+            )
+            plans.extend((name, group) for group in groups)
+
+    if not plans:
+        logger.info("No partition has fragments to compact.")
+        return
+
+    # Compact the partitions with the most fragments first, within the time budget
+    plans.sort(key=lambda plan: len(plan[1]), reverse=True)
+    start = time.monotonic()
+    compacted_groups = 0
+
+    for name, group in plans:
+        if time.monotonic() - start > time_budget:
+            logger.info(
+                f"Time budget of {time_budget} seconds spent. {len(plans) - compacted_groups} "
+                "groups of fragments are left for the next runs."
+            )
+            break
+
+        dataset = datasets[name]
+        batch_id = f"{pd.Timestamp.now():%Y%m%d%H%M%S}-{uuid.uuid4().hex[:8]}"
+
+        try:
+            rows_in, rows_out, bytes_read, bytes_written = compact_partition(
+                group=group,
+                keys=dataset["keys"],
+                layout={**dataset["layout"], "compression": compression},
+                batch_id=batch_id,
+            )
+        except Exception as e:
+            logger.error(
+                f"Error compacting the fragments of {Path(group[0]).parent}: {e}. Skipping."
+            )
+            continue
+
+        current_stage_metrics().add(
+            rows_in=rows_in,
+            rows_out=rows_out,
+            bytes_read=bytes_read,
+            bytes_written=bytes_written,
+        )
+        compacted_groups += 1
+
+        logger.info(
+            f"Compacted {len(group)} fragments of {Path(group[0]).parent} into one file, "
+            f"dropping {rows_in - rows_out} duplicate rows."
+        )
+
+    logger.info(f"Compaction of the datasets finalized.")
+
+
+if __name__ == "__main__":
+    compact_datasets()
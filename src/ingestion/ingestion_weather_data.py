@@ -9,8 +9,16 @@ from pathlib import Path
 # Add parent directory to sys.path to get the functions in utils
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
 
-from utils.weather_api_client import WeatherAPIClient
-from utils.auxiliary_functions import load_env_variables, create_directory
+from utils.weather_api_client import MAX_GROUP_SIZE, WeatherAPIClient
+from utils.city_index import get_city_index, resolve_cities, select_cities
+from utils.rate_limiter import CallPlanner
+from utils.last_seen_cache import LastSeenCache
+from utils.raw_batch_writer import NDJSONBatchWriter
+from utils.stage_metrics import current_stage_metrics, get_path_size
+from utils.auxiliary_functions import (
+    create_directory,
+)
+from utils.pipeline_context import PipelineContext
 
 logger = logging.getLogger("ingestion_weather_data")
 logger.setLevel(logging.INFO)
@@ -22,16 +30,97 @@ handler.setFormatter(formatter)
 logger.addHandler(handler)
 
 
-def ingest_weather_data():
+def save_city_weather_data(
+    city_weather_data: dict,
+    raw_files_path: Path,
+    last_seen_cache: LastSeenCache,
+    batch_writer: NDJSONBatchWriter = None,
+    content: bytes = None,
+    directory_name: str = None,
+) -> Path:
+    """
+    Stores the weather data of a city, as returned by the API. If the measurement was
+    already stored by a previous call (same city ID and 'dt'), nothing is written.
+
+    The data is stored either:
+        - As a JSON file under raw_files_path/<city-id>/<YYYYMMDD_HHMMSS>_<city-id>.json.
+          The files are keyed by the ID of the city, as different cities can share a name.
+          The cities queried by name, with no known ID, are stored under
+          raw_files_path/<directory_name>/ instead, so the loading layer can find them.
+        - If a batch writer is provided, as a line of the compressed NDJSON file of the run.
+          The raw bytes of the response ('content') are written as they were received;
+          if they are not provided, the data is serialized in compact form.
+
+    Args:
+        city_weather_data (dict): the weather data of the city.
+        raw_files_path (Path): the directory where the raw weather data is stored.
+        last_seen_cache (LastSeenCache): the cache of the last measurement of each city.
+        batch_writer (NDJSONBatchWriter): the writer of the NDJSON file of the run.
+        content (bytes): the raw bytes of the response.
+        directory_name (str): the directory of the city, if it is not keyed by its ID.
+
+    Returns:
+        Path or None: the path of the written file, or None if it was a duplicate.
+    """
+
+    if last_seen_cache.is_duplicate(
+        city_id=city_weather_data.get("id"), dt=city_weather_data.get("dt")
+    ):
+        logger.info(
+            f"The measurement of city {city_weather_data.get('name')} at "
+            f"{city_weather_data.get('dt')} was already stored. Skipping."
+        )
+        return None
+
+    if batch_writer is not None:
+        if content is None:
+            content = json.dumps(city_weather_data, separators=(",", ":")).encode()
+        batch_writer.write(content)
+
+        return batch_writer.path
+
+    city_id = city_weather_data.get("id")
+    measurement_timestamp_unix = city_weather_data.get("dt", 0)
+    measurement_timestamp_string = pd.to_datetime(
+        measurement_timestamp_unix, unit="s"
+    ).strftime("%Y%m%d_%H%M%S")
+
+    # Check if the directory that will store the files exists. If not, create it
+    city_path = raw_files_path / (directory_name or str(city_id))
+    create_directory(path=city_path, logger=logger)
+
+    # Save the file
+    file_path = city_path / f"{measurement_timestamp_string}_{city_id}.json"
+
+    with open(file_path, "w") as file:
+        json.dump(city_weather_data, file, indent=4)
+
+    logger.info(f"Data file {file_path} written successfully.")
+
+    return file_path
+
+
+def ingest_weather_data(context: PipelineContext = None):
     """
     Ingests weather data by making calls to the Weather API and storing the result as a JSON file.
 
     Steps:
-        1. Load the environment variables.
-        2. Retrieve relevant fields for the task from the config.json.
-        3. For a list of cities provided in the config.json, make calls to the weather API
-           and retrieve weather information.
-        4. Store the files.
+        1. Get the environment variables and the config.json from the context of the run,
+           built by the stage itself if it is run on its own.
+        2. Retrieve relevant fields for the task from the config.
+        3. Resolve the cities provided in the config.json to their IDs, using the index
+           built from the processed city codes, and add the cities selected by the city
+           selectors of the config.json.
+        4. For each city, make concurrent calls to the weather API and retrieve weather
+           information, querying by ID when it is known. In 'group' mode, the cities with
+           an ID are fetched in chunks through the group endpoint, and the result of each
+           call is split into the data of each city. Calls are paced at the highest rate
+           allowed by the API quota configured in the config.json, and failed calls are
+           retried with backoff.
+        5. Store the data of each city, as the calls complete, skipping the measurements
+           that were already stored (same city ID and 'dt'). Depending on the 'raw_format'
+           in the config.json, the data is stored as one JSON file per city ("json") or
+           appended to one compressed NDJSON file per run ("ndjson").
 
     Raises:
         ValueError: if no API_KEY is provided in the .env file, an error is raised.
@@ -39,9 +128,17 @@ def ingest_weather_data():
 
     logger.info("Starting ingestion process of weather data from the API")
 
-    # Load the environment variables
-    path = Path(__file__).parent.parent.parent
-    env_variables = load_env_variables(path, logger)
+    # Build the context of the run, if the stage is run on its own, and raise an error if
+    # the configuration file is not found
+    if context is None:
+        context = PipelineContext.build(
+            path=Path(__file__).parent.parent.parent, logger=logger
+        )
+        if context is None:
+            raise ValueError("The JSON configuration file could not be loaded.")
+
+    env_variables = context.env_variables
+    config = context.config
 
     # Check if the API_KEY is present in the .env file, and, if not, raise an error
     api_key = env_variables.get("API_KEY")
@@ -50,58 +147,189 @@ def ingest_weather_data():
             "API_KEY not found in the .env file. Please insert a valid API key in the file."
         )
 
-    # Read the configuration file, and raise an error if it's not found
-    config_path = env_variables.get("CONFIG_PATH")
-    try:
-        logger.info("Loading the JSON configuration file")
-        with open(config_path, "r") as f:
-            config = json.load(f)
-    except Exception as e:
-        logger.error(f"Error loading the JSON configuration file: {e}")
-        raise
-
     # Get API and City information
     base_url = config.get("api", {}).get(
         "base_url", "https://api.openweathermap.org/data/2.5/weather"
     )
     units = config.get("api", {}).get("units", "metric")
     language = config.get("api", {}).get("language", "en")
+    timeout = config.get("api", {}).get("timeout", 10)
+    max_concurrency = config.get("api", {}).get("max_concurrency", 8)
+    group_url = config.get("api", {}).get("group_url")
+    mode = config.get("api", {}).get("mode", "single")
+    group_size = config.get("api", {}).get("group_size", MAX_GROUP_SIZE)
+    max_retries = config.get("api", {}).get("max_retries", 3)
+    backoff_base = config.get("api", {}).get("backoff_base", 1.0)
+    rate_limit = config.get("api", {}).get("rate_limit", {})
     cities = config.get("cities", [])
 
     # Get the RAW_FILES_PATH
     raw_files_path = env_variables.get("RAW_WEATHER_DATA_PATH")
 
+    # Resolve the cities to their IDs
+    city_index = context.get_or_create(
+        "city_index",
+        lambda: get_city_index(
+            processed_files_path=env_variables.get("PROCESSED_FILES_PATH"),
+            config=config,
+            logger=logger,
+        ),
+    )
+    selected_cities = context.get_or_create(
+        "selected_cities",
+        lambda: select_cities(
+            processed_files_path=env_variables.get("PROCESSED_FILES_PATH"),
+            config=config,
+            logger=logger,
+        ),
+    )
+    cities = resolve_cities(
+        cities=cities,
+        index=city_index,
+        logger=logger,
+        selected_cities=selected_cities,
+    )
+
+    # The group endpoint accepts between 1 and MAX_GROUP_SIZE cities per request
+    if not isinstance(group_size, int) or not 1 <= group_size <= MAX_GROUP_SIZE:
+        clamped_group_size = (
+            min(max(int(group_size), 1), MAX_GROUP_SIZE)
+            if isinstance(group_size, (int, float))
+            else MAX_GROUP_SIZE
+        )
+        logger.warning(
+            f"Invalid group size {group_size}: it must be between 1 and "
+            f"{MAX_GROUP_SIZE}. Using {clamped_group_size}."
+        )
+        group_size = clamped_group_size
+
+    # In group mode, the cities with an ID are fetched through the group endpoint
+    if mode == "group":
+        city_ids = [city["id"] for city in cities if city["id"] is not None]
+        single_cities = [city["name"] for city in cities if city["id"] is None]
+
+        if single_cities:
+            logger.warning(
+                f"The cities {single_cities} have no ID, and cannot be fetched through "
+                "the group endpoint. Fetching them one by one."
+            )
+    else:
+        city_ids = []
+        single_cities = [
+            city["id"] if city["id"] is not None else city["name"] for city in cities
+        ]
+
+    # Cache of the last measurement stored for each city
+    last_seen_file_name = (
+        config.get("ingestion_layer", {})
+        .get("weather_data", {})
+        .get("last_seen_file", "last_seen")
+    )
+    last_seen_cache = LastSeenCache(
+        path=raw_files_path / f"{last_seen_file_name}.json", logger=logger
+    )
+
+    # In NDJSON format, the responses of the run are appended to a single compressed file
+    raw_format = (
+        config.get("ingestion_layer", {})
+        .get("weather_data", {})
+        .get("raw_format", "json")
+    )
+    if raw_format == "ndjson":
+        batch_writer = NDJSONBatchWriter(
+            directory=raw_files_path / "_batches",
+            file_name=f"{pd.Timestamp.now():%Y%m%d_%H%M%S}",
+            logger=logger,
+        )
+    else:
+        batch_writer = None
+
+    # Plan the rate of the calls from the API quota
+    call_planner = CallPlanner(
+        calls_per_minute=rate_limit.get("calls_per_minute"),
+        calls_per_day=rate_limit.get("calls_per_day"),
+        calls_per_month=rate_limit.get("calls_per_month"),
+        window_seconds=rate_limit.get("window_seconds", 1800),
+        logger=logger,
+    )
+    n_calls = -(-len(city_ids) // group_size) + len(single_cities)
+    rate_limiter = call_planner.plan(n_calls=n_calls)
+
     # API Client
     api_client = WeatherAPIClient(
         base_url=base_url,
         api_key=api_key,
         units=units,
         language=language,
+        timeout=timeout,
+        max_concurrency=max_concurrency,
+        group_url=group_url,
+        max_retries=max_retries,
+        backoff_base=backoff_base,
+        rate_limiter=rate_limiter,
         logger=logger,
     )
 
-    # Fetch the data
-    for city in cities:
-        logger.info(f"Fetching weather data for city {city}")
-        city_weather_data = api_client.fetch_data(city=city)
+    # Fetch the data, counting the measurements received and stored
+    metrics = current_stage_metrics()
 
-        city_name = city_weather_data.get("name")
-        measurement_timestamp_unix = city_weather_data.get("dt", 0)
-        measurement_timestamp_string = pd.to_datetime(
-            measurement_timestamp_unix, unit="s"
-        ).strftime("%Y%m%d_%H%M%S")
+    for chunk, group_weather_data in api_client.fetch_many_groups(
+        city_ids=city_ids, group_size=group_size
+    ):
+        if not group_weather_data:
+            logger.error(f"No weather data was fetched for cities {chunk}. Skipping.")
+            continue
 
-        # Check if the directory that will store the files exists. If not, create it
-        city_path = raw_files_path / city_name
-        create_directory(path=city_path, logger=logger)
+        for city_weather_data in group_weather_data:
+            file_path = save_city_weather_data(
+                city_weather_data=city_weather_data,
+                raw_files_path=raw_files_path,
+                last_seen_cache=last_seen_cache,
+                batch_writer=batch_writer,
+            )
+            metrics.add(
+                rows_in=1,
+                rows_out=int(file_path is not None),
+                bytes_written=(
+                    get_path_size(file_path)
+                    if file_path is not None and batch_writer is None
+                    else 0
+                ),
+            )
 
-        # Save the file
-        file_path = city_path / f"{measurement_timestamp_string}_{city_name}.json"
+    for city, content in api_client.fetch_many(cities=single_cities, raw=True):
+        if not content:
+            logger.error(f"No weather data was fetched for city {city}. Skipping.")
+            continue
 
-        with open(file_path, "w") as file:
-            json.dump(city_weather_data, file, indent=4)
+        file_path = save_city_weather_data(
+            city_weather_data=json.loads(content),
+            raw_files_path=raw_files_path,
+            last_seen_cache=last_seen_cache,
+            batch_writer=batch_writer,
+            content=content,
+            directory_name=city if isinstance(city, str) else None,
+        )
+        metrics.add(
+            rows_in=1,
+            rows_out=int(file_path is not None),
+            bytes_read=len(content),
+            bytes_written=(
+                get_path_size(file_path)
+                if file_path is not None and batch_writer is None
+                else 0
+            ),
+        )
 
-        logger.info(f"Data file {file_path} written successfully.")
+    # Publish the NDJSON file and save the cache
+    if batch_writer is not None:
+        batch_path = batch_writer.close()
+        if batch_path is not None:
+            metrics.add(bytes_written=get_path_size(batch_path))
+    last_seen_cache.save()
+    logger.info(
+        f"Skipped {last_seen_cache.duplicates} measurements that were already stored."
+    )
 
     logger.info("Ingestion process of weather data completed successfuly.")
 
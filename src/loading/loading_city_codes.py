@@ -1,15 +1,21 @@
 import os
 import sys
-import json
+import inspect
+import gzip
 import logging
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 
 from pathlib import Path
 
 # Add parent directory to sys.path to get the functions in utils
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
 
-from utils.auxiliary_functions import load_env_variables, expand_dictionary_column
+from utils.auxiliary_functions import iter_json_array
+from utils.stage_cache import StageCache
+from utils.stage_metrics import current_stage_metrics, get_path_size
+from utils.pipeline_context import PipelineContext
 
 logger = logging.getLogger("loading_city_codes")
 logger.setLevel(logging.INFO)
@@ -20,28 +26,110 @@ handler.setFormatter(formatter)
 
 logger.addHandler(handler)
 
+# Schema of the loaded city codes table. The 'coord' dictionary of each city is written
+# straight into the coord_lon and coord_lat columns
+CITY_CODES_SCHEMA = pa.schema(
+    [
+        ("id", pa.int64()),
+        ("name", pa.string()),
+        ("state", pa.string()),
+        ("country", pa.string()),
+        ("coord_lon", pa.float64()),
+        ("coord_lat", pa.float64()),
+        ("ingestion_date", pa.timestamp("ns")),
+    ]
+)
+
+
+def write_city_codes(json_path: Path, parquet_path: Path, row_group_size: int) -> int:
+    """
+    Streams the cities of the JSON array in 'json_path', which can be gzip-compressed
+    (.gz), into the Parquet file 'parquet_path', one row group of 'row_group_size' cities
+    at a time. Only one row group is held in memory, whatever the size of the file.
+
+    The file is written under a temporary name and only renamed to 'parquet_path' once
+    complete, so readers never see a partial file.
 
-def load_city_codes():
+    Args:
+        json_path (Path): the JSON file with the list of cities.
+        parquet_path (Path): the Parquet file to write.
+        row_group_size (int): the number of cities per row group.
+
+    Returns:
+        int: the number of cities written.
+    """
+
+    temporary_path = parquet_path.parent / f".{parquet_path.name}.tmp"
+    ingestion_date = pd.Timestamp.now()
+    columns = {name: [] for name in CITY_CODES_SCHEMA.names}
+    n_cities = 0
+
+    open_file = gzip.open if json_path.suffix == ".gz" else open
+
+    try:
+        with open_file(json_path, "rt", encoding="utf-8") as f, pq.ParquetWriter(
+            temporary_path, CITY_CODES_SCHEMA
+        ) as writer:
+            for city in iter_json_array(f):
+                coord = city.get("coord") or {}
+
+                columns["id"].append(city.get("id"))
+                columns["name"].append(city.get("name"))
+                columns["state"].append(city.get("state"))
+                columns["country"].append(city.get("country"))
+                columns["coord_lon"].append(coord.get("lon"))
+                columns["coord_lat"].append(coord.get("lat"))
+                columns["ingestion_date"].append(ingestion_date)
+                n_cities += 1
+
+                if len(columns["id"]) == row_group_size:
+                    writer.write_table(pa.table(columns, schema=CITY_CODES_SCHEMA))
+                    columns = {name: [] for name in CITY_CODES_SCHEMA.names}
+
+            if columns["id"]:
+                writer.write_table(pa.table(columns, schema=CITY_CODES_SCHEMA))
+    except Exception:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+        raise
+
+    os.replace(temporary_path, parquet_path)
+
+    return n_cities
+
+
+def load_city_codes(context: PipelineContext = None):
     """
     Loads the data regarding cities into a Parquet file. The data is read from a JSON file
     provided by OpenWeather, you can find it here: https://bulk.openweathermap.org/sample/
+    The file can be used as downloaded (city.list.json.gz), without decompressing it.
 
     Steps:
-        1. Load the environment variables.
-        2. Retrieve relevant fields for the task from the config.json.
-        3. Check if the source and destination file exist. If both exist, and the source file
-           has not been updated, skip processing. Otherwise, continue with the processing.
-        4. Read the JSON file containing city information as a DataFrame.
-        5. Flatten the 'coord' column into separate columns.
-        6. Add an ingestion_date column, indicating the moment the data was processed.
-        7. Save the DataFrame to a Parquet file.
+        1. Get the environment variables and the config.json from the context of the run,
+           built by the stage itself if it is run on its own.
+        2. Retrieve relevant fields for the task from the config.
+        3. Compute the fingerprint of the stage, from the content of the source file, the
+           relevant config and the code of the stage. If the destination file exists and
+           the fingerprint did not change, skip processing. Otherwise, continue with the
+           processing.
+        4. Stream the cities in the JSON file, decompressing it on the fly if it is
+           gzip-compressed, and write them to the Parquet file one row group at a time:
+            - The 'coord' dictionary is written into the coord_lon and coord_lat columns.
+            - An ingestion_date column is added, indicating the moment the data was processed.
     """
 
     logging.info("Starting loading process of city codes")
 
-    # Load the environment variables
-    path = Path(__file__).parent.parent.parent
-    env_variables = load_env_variables(path, logger)
+    # Build the context of the run, if the stage is run on its own
+    if context is None:
+        context = PipelineContext.build(
+            path=Path(__file__).parent.parent.parent, logger=logger
+        )
+        if context is None:
+            return
+
+    env_variables = context.env_variables
+    config = context.config
 
     # Check if the RAW_CITY_CODES_PATH is present in the .env file
     raw_files_path = env_variables.get("RAW_CITY_CODES_PATH")
@@ -49,16 +137,6 @@ def load_city_codes():
     # Get the LOADED_FILES_PATH
     loaded_files_path = env_variables.get("LOADED_FILES_PATH")
 
-    # Read the configuration file
-    config_path = env_variables.get("CONFIG_PATH")
-    try:
-        logger.info("Loading the JSON configuration file")
-        with open(config_path, "r") as f:
-            config = json.load(f)
-    except Exception as e:
-        logger.error(f"Error loading the JSON configuration file: {e}")
-        return
-
     # Get the directories of the source and destination files
     city_codes_file_name = (
         config.get("ingestion_layer", {})
@@ -67,6 +145,10 @@ def load_city_codes():
     )
     json_path = raw_files_path / city_codes_file_name
 
+    # Use the compressed file, as downloaded, if the uncompressed one does not exist
+    if not os.path.exists(json_path) and os.path.exists(f"{json_path}.gz"):
+        json_path = raw_files_path / f"{city_codes_file_name}.gz"
+
     city_codes_table_name = (
         config.get("loading_layer", {})
         .get("city_codes", {})
@@ -74,38 +156,49 @@ def load_city_codes():
     )
     parquet_path = loaded_files_path / f"{city_codes_table_name}.parquet"
 
-    # If the destination file exists, and the source file hasn't been updated, skip
-    if os.path.exists(json_path) and os.path.exists(parquet_path):
-        json_path_mdate = os.path.getmtime(json_path)
-        parquet_file_mdate = os.path.getmtime(parquet_path)
+    row_group_size = (
+        config.get("loading_layer", {})
+        .get("city_codes", {})
+        .get("row_group_size", 50000)
+    )
 
-        if parquet_file_mdate > json_path_mdate:
-            logger.info(
-                f"Parquet file is up to date. Original file has not been updated."
-                "Skipping file processing."
-            )
-            return
+    # If the destination file exists, and the fingerprint hasn't changed, skip
+    stage_cache = StageCache(output_path=parquet_path, logger=logger)
+    fingerprint = stage_cache.fingerprint(
+        inputs=[json_path],
+        config={
+            "ingestion_layer": config.get("ingestion_layer", {}).get("city_codes"),
+            "loading_layer": config.get("loading_layer", {}).get("city_codes"),
+        },
+        code_files=[__file__, inspect.getfile(iter_json_array)],
+    )
 
-    try:
-        logger.info(f"Loading city codes data from file {json_path}.")
-        with open(json_path) as f:
-            df = pd.read_json(json_path)
-    except Exception as e:
-        logger.error(f"Error loading the JSON file: {e}.")
+    if stage_cache.is_up_to_date(fingerprint):
+        logger.info(
+            f"Parquet file is up to date. Original file, config and code have not changed. "
+            "Skipping file processing."
+        )
         return
 
-    # Flatten the DataFrame's dictionary columns
-    df = expand_dictionary_column(df=df, column="coord", logger=logger)
-
-    # Add ingestion date column
-    df["ingestion_date"] = pd.Timestamp.now()
-
-    # Store the data
+    # Stream the cities into the Parquet file
     try:
-        logger.info(f"Saving the file to {parquet_path}")
-        df.to_parquet(parquet_path, index=False)
+        logger.info(f"Loading city codes data from file {json_path} to {parquet_path}.")
+        n_cities = write_city_codes(
+            json_path=json_path,
+            parquet_path=parquet_path,
+            row_group_size=row_group_size,
+        )
+        logger.info(f"{n_cities} cities saved to {parquet_path}.")
+        current_stage_metrics().add(
+            rows_in=n_cities,
+            rows_out=n_cities,
+            bytes_read=get_path_size(json_path),
+            bytes_written=get_path_size(parquet_path),
+        )
+        stage_cache.save(fingerprint)
     except Exception as e:
-        logger.error(f"Error saving the Parquet file: {e}")
+        logger.error(f"Error loading the JSON file into the Parquet file: {e}.")
+        return
 
     logger.info(f"Loading of city codes finalized.")
 
@@ -1,6 +1,5 @@
 import os
 import sys
-import json
 import logging
 import pandas as pd
 
@@ -9,7 +8,9 @@ from pathlib import Path
 # Add parent directory to sys.path to get the functions in utils
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
 
-from utils.auxiliary_functions import load_env_variables
+from utils.stage_cache import StageCache
+from utils.stage_metrics import current_stage_metrics, get_path_size
+from utils.pipeline_context import PipelineContext
 
 logger = logging.getLogger("loading_weather_codes")
 logger.setLevel(logging.INFO)
@@ -21,16 +22,19 @@ handler.setFormatter(formatter)
 logger.addHandler(handler)
 
 
-def load_weather_codes():
+def load_weather_codes(context: PipelineContext = None):
     """
     Loads the data regarding weather codes into a Parquet file. The data is read from a CSV file
     generated from the information available in https://openweathermap.org/weather-conditions
 
     Steps:
-        1. Load the environment variables.
-        2. Retrieve relevant fields for the task from the config.json.
-        3. Check if the source and destination file exist. If both exist, and the source file
-           has not been updated, skip processing. Otherwise, continue with the processing.
+        1. Get the environment variables and the config.json from the context of the run,
+           built by the stage itself if it is run on its own.
+        2. Retrieve relevant fields for the task from the config.
+        3. Compute the fingerprint of the stage, from the content of the source file, the
+           relevant config and the code of the stage. If the destination file exists and
+           the fingerprint did not change, skip processing. Otherwise, continue with the
+           processing.
         3. Read the CSV file containing weather code information as a DataFrame.
         4. Add an ingestion_date column, indicating the moment the data was processed.
         5. Save the DataFrame to a Parquet file under the data/loaded folder.
@@ -38,9 +42,16 @@ def load_weather_codes():
 
     logging.info("Starting ingestion process of weather codes")
 
-    # Load the environment variables
-    path = Path(__file__).parent.parent.parent
-    env_variables = load_env_variables(path, logger)
+    # Build the context of the run, if the stage is run on its own
+    if context is None:
+        context = PipelineContext.build(
+            path=Path(__file__).parent.parent.parent, logger=logger
+        )
+        if context is None:
+            return
+
+    env_variables = context.env_variables
+    config = context.config
 
     # Check if the RAW_WEATHER_CODES_PATH is present in the .env file
     raw_files_path = env_variables.get("RAW_WEATHER_CODES_PATH")
@@ -48,16 +59,6 @@ def load_weather_codes():
     # Get the LOADED_FILES_PATH
     loaded_files_path = env_variables.get("LOADED_FILES_PATH")
 
-    # Read the configuration file
-    config_path = env_variables.get("CONFIG_PATH")
-    try:
-        logger.info("Loading the JSON configuration file")
-        with open(config_path, "r") as f:
-            config = json.load(f)
-    except Exception as e:
-        logger.error(f"Error loading the JSON configuration file: {e}")
-        return
-
     # Get the directories of the source and destination files
     weather_codes_file_name = (
         config.get("ingestion_layer", {})
@@ -73,22 +74,29 @@ def load_weather_codes():
     )
     parquet_path = loaded_files_path / f"{weather_codes_table_name}.parquet"
 
-    # If the destination file exists, and the source file hasn't been updated, skip
-    if os.path.exists(csv_path) and os.path.exists(parquet_path):
-        json_path_mdate = os.path.getmtime(csv_path)
-        parquet_file_mdate = os.path.getmtime(parquet_path)
+    # If the destination file exists, and the fingerprint hasn't changed, skip
+    stage_cache = StageCache(output_path=parquet_path, logger=logger)
+    fingerprint = stage_cache.fingerprint(
+        inputs=[csv_path],
+        config={
+            "ingestion_layer": config.get("ingestion_layer", {}).get("weather_codes"),
+            "loading_layer": config.get("loading_layer", {}).get("weather_codes"),
+        },
+        code_files=[__file__],
+    )
 
-        if parquet_file_mdate > json_path_mdate:
-            logger.info(
-                f"Parquet file is up to date. Original file has not been updated."
-                "Skipping file processing."
-            )
-            return
+    if stage_cache.is_up_to_date(fingerprint):
+        logger.info(
+            f"Parquet file is up to date. Original file, config and code have not changed. "
+            "Skipping file processing."
+        )
+        return
 
     # Fetch the data
     try:
         logger.info(f"Loading weather codes data from file {csv_path}.")
         df = pd.read_csv(csv_path, sep=",")
+        current_stage_metrics().add(rows_in=len(df), bytes_read=get_path_size(csv_path))
     except Exception as e:
         logger.error(f"Error loading the CSV file: {e}.")
         return
@@ -100,6 +108,10 @@ def load_weather_codes():
     try:
         logger.info(f"Saving the file to {parquet_path}")
         df.to_parquet(parquet_path, index=False)
+        current_stage_metrics().add(
+            rows_out=len(df), bytes_written=get_path_size(parquet_path)
+        )
+        stage_cache.save(fingerprint)
     except Exception as e:
         logger.error(f"Error saving the Parquet file: {e}")
 
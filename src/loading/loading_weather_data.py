@@ -1,15 +1,37 @@
 import os
 import sys
 import json
+import uuid
+import shutil
+import gzip
+import hashlib
 import logging
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.json as pajson
+import pyarrow.parquet as pq
 
 from pathlib import Path
 
 # Add parent directory to sys.path to get the functions in utils
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
 
-from utils.auxiliary_functions import flatten_json, flatten_schema, load_env_variables
+from utils.auxiliary_functions import (
+    WEATHER_DATA_PARTITIONING,
+    add_partition_columns,
+    cast_arrow_table,
+    extract_row,
+    flatten_arrow_table,
+    open_parquet_dataset,
+    publish_staged_fragments,
+    repeat_values,
+    stage_dataset_fragments,
+)
+from utils.file_manifest import FileManifest
+from utils.city_index import get_city_index, resolve_cities, select_cities
+from utils.stage_metrics import current_stage_metrics, get_path_size
+from utils.pipeline_context import PipelineContext
 
 logger = logging.getLogger("loading_weather_data")
 logger.setLevel(logging.DEBUG)
@@ -21,41 +43,254 @@ handler.setFormatter(formatter)
 logger.addHandler(handler)
 
 
-def load_weather_data():
+def write_weather_data_fragments(
+    table: pa.Table, dataset_path: Path, batch_id: str
+) -> None:
+    """
+    Writes the Arrow table 'table' as new fragment files of the Hive-partitioned dataset stored
+    under 'dataset_path'. Existing fragments are left untouched.
+
+    The fragments are first written to the staging directory _staging/<batch_id>, which is
+    ignored by the dataset readers. Once all of them are written, a _SUCCESS marker is
+    created and the fragments are moved into their partitions. The staging directory is only
+    removed by the caller, after the batch is committed to the manifest.
+
+    Args:
+        table (pa.Table): the data to write, containing the partition columns.
+        dataset_path (Path): the root directory of the dataset.
+        batch_id (str): identifier of the batch, used to name the fragment files.
+    """
+
+    stage_dataset_fragments(
+        table=table,
+        dataset_path=dataset_path,
+        batch_id=batch_id,
+        partitioning=WEATHER_DATA_PARTITIONING,
+    )
+    publish_staged_fragments(dataset_path=dataset_path, batch_id=batch_id)
+
+
+def read_raw_lines(content: bytes, file_name: str) -> list:
+    """
+    Reads the JSON documents stored in a raw weather data file as lines of NDJSON, without
+    parsing them. The file is either:
+        - A JSON file (.json), with the response of a single API call. Line breaks are
+          removed, which is safe since JSON strings cannot hold raw line breaks.
+        - A gzip-compressed NDJSON file (.ndjson.gz), with one response per line.
+
+    Args:
+        content (bytes): the content of the file.
+        file_name (str): the name of the file.
+
+    Returns:
+        list: the JSON documents in the file, one per line.
+    """
+
+    if file_name.endswith(".ndjson.gz"):
+        return [line for line in gzip.decompress(content).splitlines() if line.strip()]
+
+    return [content.replace(b"\r", b"").replace(b"\n", b"")]
+
+
+def read_weather_documents(
+    lines: list,
+    arrow_schema: pa.Schema,
+    schema_extractors: list,
+    table_schema: pa.Schema,
+) -> pa.Table:
+    """
+    Reads the JSON documents in 'lines' straight into an Arrow table with pyarrow.json,
+    using the explicit schema built from the config file, flattens it into one column
+    per extractor and casts the columns to their types in the loaded table. Fields missing
+    from a document are set to null, and fields that are not in the schema are ignored.
+
+    Args:
+        lines (list): the JSON documents, one per line.
+        arrow_schema (pa.Schema): the nested schema returned by build_arrow_schema.
+        schema_extractors (list): the extractors returned by compile_schema.
+        table_schema (pa.Schema): the flat schema returned by build_table_schema.
+
+    Returns:
+        pa.Table: the flat table, with one row per document.
+    """
+
+    table = pajson.read_json(
+        pa.BufferReader(b"\n".join(lines)),
+        parse_options=pajson.ParseOptions(
+            explicit_schema=arrow_schema, unexpected_field_behavior="ignore"
+        ),
+    )
+
+    table = flatten_arrow_table(table=table, extractors=schema_extractors)
+
+    return cast_arrow_table(table=table, schema=table_schema, logger=logger)
+
+
+def extract_weather_documents(
+    lines: list, schema_extractors: list, table_schema: pa.Schema
+) -> pa.Table:
+    """
+    Reads the JSON documents in 'lines' one at a time with the compiled key-path
+    extractors. It is the fallback of read_weather_documents for documents whose values
+    do not match the types of the schema (e.g. a decimal value in an integer field): the
+    values are extracted as strings and then cast with cast_arrow_table.
+
+    Args:
+        lines (list): the JSON documents, one per line.
+        schema_extractors (list): the extractors returned by compile_schema.
+        table_schema (pa.Schema): the flat schema returned by build_table_schema.
+
+    Returns:
+        pa.Table: the flat table, with one row per document.
+    """
+
+    rows = [
+        extract_row(document=json.loads(line), extractors=schema_extractors)
+        for line in lines
+    ]
+
+    table = pa.table(
+        {
+            name: pa.array(
+                [None if row[i] is None else str(row[i]) for row in rows],
+                type=pa.string(),
+            )
+            for i, (name, _) in enumerate(schema_extractors)
+        }
+    )
+
+    return cast_arrow_table(table=table, schema=table_schema, logger=logger)
+
+
+def recover_pending_batches(manifest: FileManifest, dataset_path: Path) -> None:
+    """
+    Replays the manifest to recover from a run that crashed while loading a batch:
+        - If the fragments of a pending batch were fully written to the staging directory
+          (the _SUCCESS marker exists), they are published and the batch is committed.
+        - Otherwise, nothing was published: the staging directory and the pending files
+          are discarded, so they are loaded again.
+    Staging directories of batches that were already committed are removed.
+
+    Args:
+        manifest (FileManifest): the manifest of loaded files.
+        dataset_path (Path): the root directory of the dataset.
     """
-    Loads the data from the multiple JSON files into a Parquet file.
+
+    for batch_id in manifest.pending_batches():
+        staging_path = dataset_path / "_staging" / batch_id
+
+        if os.path.exists(staging_path / "_SUCCESS"):
+            logger.info(f"Recovering batch {batch_id}: publishing its fragments.")
+            publish_staged_fragments(dataset_path=dataset_path, batch_id=batch_id)
+            manifest.commit_batch(batch_id)
+        else:
+            logger.info(f"Recovering batch {batch_id}: discarding it.")
+            manifest.discard_batch(batch_id)
+
+    if os.path.exists(dataset_path / "_staging"):
+        shutil.rmtree(dataset_path / "_staging")
+
+
+def migrate_string_fragments(dataset_path: Path, table_schema: pa.Schema) -> None:
+    """
+    Migrates, in a single pass, the fragments of the dataset that older versions of the
+    pipeline wrote with every column as strings: each one is cast to the types of the
+    loaded table and replaced atomically. Once done, a _TYPED marker is created in the
+    dataset directory, so the fragments are only inspected once.
+
+    Args:
+        dataset_path (Path): the root directory of the dataset.
+        table_schema (pa.Schema): the flat schema returned by build_table_schema.
+    """
+
+    marker_path = dataset_path / "_TYPED"
+
+    if os.path.exists(marker_path):
+        return
+
+    os.makedirs(dataset_path, exist_ok=True)
+    migrated_fragments = 0
+
+    for fragment_path in sorted(dataset_path.glob("city=*/date=*/*.parquet")):
+        fragment_schema = pq.read_schema(fragment_path)
+
+        # Only the columns typed as strings in the fragment but not in the schema matter
+        if not any(
+            pa.types.is_string(fragment_schema.field(field.name).type)
+            and not pa.types.is_string(field.type)
+            for field in table_schema
+            if field.name in fragment_schema.names
+        ):
+            continue
+
+        # Read the file on its own, without the partition columns of its path
+        table = cast_arrow_table(
+            table=pq.ParquetFile(fragment_path).read(),
+            schema=table_schema,
+            logger=logger,
+        )
+        temporary_path = fragment_path.parent / f".{fragment_path.name}.tmp"
+        pq.write_table(table, temporary_path)
+        os.replace(temporary_path, fragment_path)
+        migrated_fragments += 1
+
+    if migrated_fragments:
+        logger.info(f"Migrated {migrated_fragments} fragments to the typed schema.")
+
+    marker_path.touch()
+
+
+def load_weather_data(context: PipelineContext = None):
+    """
+    Loads the data from the multiple JSON files into a Hive-partitioned Parquet dataset,
+    stored as city=<id>/date=<yyyy-mm-dd>/part-<batch_id>-<i>.parquet. Each run only
+    writes new fragment files, the existing ones are never rewritten.
+
+    The raw files that were already loaded are tracked in a SQLite manifest (see
+    utils/file_manifest.py), which is updated together with the data fragments of each batch.
 
     Steps:
-        1. Load the environment variables.
-        2. Retrieve relevant fields for the task from the config.json.
-        3. Fetch the Parquet file containing the loaded files, and the txt file that stores
-           the names of files that were already processed.
-        4. Make validation checks:
-            - If the Parquet file does not exist and the txt file does not exist aswell,
-              data is processed from scratch.
-            - If the Parquet file does not exist but the txt file does, delete the
-              txt file and start over
-            - If the Parquet file exists but the txt file does not, one of two scenarios can happen:
-                - If the Parquet file does not contain the 'file_name' column, delete the
-                  txt file and start over
-                - Else, the list of processed files is derived from the Parquet via the
-                  'file_name' column.
-            - If both exist, the following checks are made:
-                - If there are more files in the Parquet than in the txt file, the difference
-                  is appended to the txt file
-                - If there are more files in the txt file than in the Parquet, only those in the
-                  Parquet are considered.
-        5. For each of cities configured in the config file, iterate over the JSON files
-           produced from the API calls and extract the relevant fields (defined in the
-           'fields' entry of ingestion_layer > weather_data in the config file).
-        6. Write the data of the new files to the Parquet file and update the txt file.
+        1. Get the environment variables and the config.json from the context of the run,
+           built by the stage itself if it is run on its own.
+        2. Retrieve relevant fields for the task from the config.
+        3. If a single Parquet file from older versions of the pipeline exists, migrate it
+           to the partitioned dataset.
+        4. Open the manifest and make validation checks:
+            - If the manifest has pending batches, recover them.
+            - If the dataset has fragments written with every column as strings by older
+              versions of the pipeline, cast them to their types, once.
+            - If the manifest is empty, seed it from the txt file used by older versions
+              of the pipeline or, if it does not exist, from the 'file_name' column of the
+              dataset.
+            - If the manifest is not empty but the dataset does not exist, reset the
+              manifest and start over.
+        5. For each of cities configured, or selected by the city selectors, in the config
+           file, look up the JSON files produced from the API calls in the manifest, as
+           well as the compressed NDJSON files of the runs that used the "ndjson" raw
+           format. Read the documents of all the new ones in bulk with pyarrow.json,
+           using an explicit Arrow schema built from the 'fields' entry of
+           ingestion_layer > weather_data in the config file, and
+           flatten them into the relevant fields, keeping the int64, float64 and timestamp
+           types of the config file. If the bulk read fails, the files are read
+           one by one, falling back to the compiled key-path extractors.
+        6. Register the new files in the manifest as pending, write their data as new
+           fragments of the dataset and commit them in the manifest.
+        7. Hand off the new rows, as an Arrow table, to the processing stage through the
+           context of the run.
     """
 
     logger.info("Starting loading process of weather data from the API")
 
-    # Load the environment variables
-    path = Path(__file__).parent.parent.parent
-    env_variables = load_env_variables(path, logger)
+    # Build the context of the run, if the stage is run on its own
+    if context is None:
+        context = PipelineContext.build(
+            path=Path(__file__).parent.parent.parent, logger=logger
+        )
+        if context is None:
+            return
+
+    env_variables = context.env_variables
+    config = context.config
 
     # Get the RAW_WEATHER_DATA_PATH
     raw_files_path = env_variables.get("RAW_WEATHER_DATA_PATH")
@@ -63,17 +298,29 @@ def load_weather_data():
     # Get the LOADED_FILES_PATH
     loaded_files_path = env_variables.get("LOADED_FILES_PATH")
 
-    # Read the configuration file
-    config_path = env_variables.get("CONFIG_PATH")
-    try:
-        logger.info("Loading the JSON configuration file")
-        with open(config_path, "r") as f:
-            config = json.load(f)
-    except Exception as e:
-        logger.error(f"Error loading the JSON configuration file: {e}")
-        return
-
-    cities = config.get("cities", [])
+    # Resolve the cities, to get the names of their directories
+    city_index = context.get_or_create(
+        "city_index",
+        lambda: get_city_index(
+            processed_files_path=env_variables.get("PROCESSED_FILES_PATH"),
+            config=config,
+            logger=logger,
+        ),
+    )
+    selected_cities = context.get_or_create(
+        "selected_cities",
+        lambda: select_cities(
+            processed_files_path=env_variables.get("PROCESSED_FILES_PATH"),
+            config=config,
+            logger=logger,
+        ),
+    )
+    cities = resolve_cities(
+        cities=config.get("cities", []),
+        index=city_index,
+        logger=logger,
+        selected_cities=selected_cities,
+    )
 
     weather_table_name = (
         config.get("loading_layer", {})
@@ -87,182 +334,291 @@ def load_weather_data():
         .get("logging_file", "processed_files")
     )
 
-    # Get existing data
-    output_file_path = loaded_files_path / f"{weather_table_name}.parquet"
+    manifest_file_name = (
+        config.get("loading_layer", {})
+        .get("weather_data", {})
+        .get("manifest_file", "weather_data_manifest")
+    )
 
-    if os.path.exists(output_file_path):
-        logger.info(f"Loading data from the Parquet {output_file_path} file")
-        df = pd.read_parquet(output_file_path)
-    else:
-        logger.info(f"The Parquet file {output_file_path} was not found.")
-        df = pd.DataFrame()
+    # Get the schema compiled into one key-path extractor per column, and into the Arrow
+    # schemas of the raw documents and of the loaded table
+    schema_extractors, arrow_schema, table_schema = context.weather_data_schemas()
 
-    # Get the list of processed files
-    text_file_path = loaded_files_path / f"{processed_files_file_name}.txt"
+    # Get existing data
+    dataset_path = loaded_files_path / weather_table_name
+    legacy_file_path = loaded_files_path / f"{weather_table_name}.parquet"
 
-    if os.path.exists(text_file_path):
+    # Migrate the single Parquet file written by older versions of the pipeline
+    if os.path.exists(legacy_file_path) and not os.path.exists(dataset_path):
         logger.info(
-            f"Loading processed files from the {processed_files_file_name}.txt file."
+            f"Migrating the Parquet file {legacy_file_path} to the partitioned dataset "
+            f"{dataset_path}."
         )
-        with open(text_file_path, "r") as f:
-            processed_files = f.read().splitlines()
-    else:
-        logger.info(f"The file {text_file_path} was not found.")
-        processed_files = []
-
-    # If the data does not exist but the text file does, delete the text file and load all data
-    if df.empty and processed_files:
-        logger.info(
-            f"Parquet file does not exist but {processed_files_file_name}.txt exists."
-            "Deleting {processed_files_file_name}.txt and starting over."
+        legacy_table = cast_arrow_table(
+            table=pq.read_table(legacy_file_path), schema=table_schema, logger=logger
         )
-        os.remove(text_file_path)
-        processed_files = []
+        legacy_table = add_partition_columns(table=legacy_table, logger=logger)
+        write_weather_data_fragments(
+            table=legacy_table, dataset_path=dataset_path, batch_id="legacy"
+        )
+        shutil.rmtree(dataset_path / "_staging")
+        os.remove(legacy_file_path)
+
+    # Open the manifest of loaded files
+    manifest = FileManifest(
+        path=loaded_files_path / f"{manifest_file_name}.sqlite", logger=logger
+    )
+    recover_pending_batches(manifest=manifest, dataset_path=dataset_path)
+
+    # Cast the fragments written as strings by older versions of the pipeline
+    migrate_string_fragments(dataset_path=dataset_path, table_schema=table_schema)
+
+    dataset_exists = os.path.exists(dataset_path) and bool(
+        open_parquet_dataset(
+            path=dataset_path, partitioning=WEATHER_DATA_PARTITIONING, logger=logger
+        ).files
+    )
+    text_file_path = loaded_files_path / f"{processed_files_file_name}.txt"
 
-    # If the data does exist but the text file does not, use the file_name column in the Parquet file to infer the the processed files
-    # If the column is not present in the data, load all data
-    elif (not df.empty) and (not processed_files):
-        if "file_name" not in df.columns:
+    # If the manifest is empty, seed it with the files loaded by older versions of the pipeline
+    if manifest.is_empty() and dataset_exists:
+        if os.path.exists(text_file_path):
             logger.info(
-                f"Parquet file exists but {processed_files_file_name}.txt is empty and"
-                "'file_name' column is missing from the data. Cannot determine processed files."
-                "Starting from scratch."
+                f"Seeding the manifest from the {processed_files_file_name}.txt file."
             )
-            os.remove(text_file_path)
-
-            df = pd.DataFrame()
-            processed_files = []
+            with open(text_file_path, "r") as f:
+                processed_files = f.read().splitlines()
         else:
-            logger.info(
-                "Parquet file exists but {processed_files_file_name}.txt is empty."
-                "Getting processed files from the Parquet file."
+            logger.info("Seeding the manifest from the Parquet dataset.")
+            dataset = open_parquet_dataset(
+                path=dataset_path, partitioning=WEATHER_DATA_PARTITIONING, logger=logger
+            )
+            processed_files = (
+                dataset.to_table(columns=["file_name"])
+                .column("file_name")
+                .unique()
+                .to_pylist()
+                if "file_name" in dataset.schema.names
+                else []
             )
-            processed_files = df["file_name"].unique().tolist()
-
-    # If both exist, check if there is a mismatch in the processed files between both
-    elif (not df.empty) and processed_files:
-        if "file_name" in df.columns:
-            processed_files_in_parquet = set(df["file_name"].unique().tolist())
-            processed_files_in_txt = set(processed_files)
-
-            difference_parquet_txt = processed_files_in_parquet - processed_files_in_txt
-            difference_txt_parquet = processed_files_in_txt - processed_files_in_parquet
-
-            # Corner case 1: there are more processed files in the Parquet than those listed in the txt file
-            if difference_parquet_txt:
-                logger.info(
-                    "There are more processed files in the Parquet file than in the text file."
-                    "Updating the text file."
-                )
-
-                with open(text_file_path, "a") as f:
-                    for file in difference_parquet_txt:
-                        f.write(f"{file}\n")
-
-                processed_files.extend(difference_parquet_txt)
-
-            # Corner case 2: there are more processed files in the txt file than in the Parquet
-            elif difference_txt_parquet:
-                logger.info(
-                    "There are more processed files in the text file than in the Parquet file. These will be deleted from the text file."
-                )
 
-                with open(text_file_path, "w") as f:
-                    for file in processed_files_in_parquet:
-                        f.write(f"{file}\n")
+        # Files are named <timestamp>_<city>.json, and stored in the directory of the city
+        manifest.begin_batch(
+            batch_id="legacy",
+            files=[
+                {
+                    "path": f"{file.split('_', 2)[-1].removesuffix('.json')}/{file}",
+                    "size": None,
+                    "mtime": None,
+                    "content_hash": None,
+                }
+                for file in processed_files
+                if file
+            ],
+        )
+        manifest.commit_batch(batch_id="legacy")
 
-                processed_files = processed_files_in_parquet
+    # If the manifest exists but the data does not, start over
+    elif (not manifest.is_empty()) and (not dataset_exists):
+        logger.info("The manifest is not empty but the Parquet dataset does not exist.")
+        manifest.reset()
 
-            else:
-                logger.info(
-                    "The processed files in the Parquet file and the text file match."
-                )
+    if os.path.exists(text_file_path):
+        logger.info(
+            f"Removing {processed_files_file_name}.txt, replaced by the manifest."
+        )
+        os.remove(text_file_path)
 
-    # Get the flattened schema
-    list_fields = (
-        config.get("ingestion_layer", {}).get("weather_data", {}).get("fields", {})
+    # Identify the new raw files, in the directories of the cities and in the NDJSON batches
+    new_files = []
+
+    # The files are keyed by city ID, so cities sharing a name are kept apart. The
+    # directories named after the cities are still read: they hold the files of the
+    # cities queried by name, and those written by older versions. Each directory is
+    # listed once, even if several cities point to it
+    city_directories = list(
+        dict.fromkeys(
+            [str(city["id"]) for city in cities if city["id"] is not None]
+            + [city["name"] for city in cities if city["name"]]
+        )
     )
-    schema_flattened = flatten_schema(schema_dict=list_fields, logger=logger)
-
-    # Iterate through the different city directories and process the files to a single table
-    new_files_processed = 0
-    new_files_list = []
-    new_file_names = []
-    new_files_ingestion_timestamps = []
+    missing_directories = []
 
-    for city in cities:
-        logger.info(f"Processing files for city: {city}")
-        files_path = raw_files_path / city
+    for city_directory in city_directories:
+        files_path = raw_files_path / city_directory
 
         # If the directory does not exist, skip loading
         if not os.path.exists(files_path):
-            logger.error(f"The directory {files_path} does not exist. Skipping.")
+            missing_directories.append(city_directory)
             continue
         else:
             logger.info(f"Processing files in the directory {files_path}.")
 
-        # Identify the new files
-        files = set([f for f in os.listdir(files_path) if f.endswith(".json")])
-        new_files = set(files - set(processed_files))
+        files = sorted(f for f in os.listdir(files_path) if f.endswith(".json"))
+        new_files.extend(
+            manifest.filter_new([f"{city_directory}/{file}" for file in files])
+        )
+
+    if missing_directories:
+        logger.info(
+            f"{len(missing_directories)} city directories do not exist in "
+            f"{raw_files_path}. Skipping them."
+        )
 
-        # Iterate through new files
-        for file in new_files:
-            logger.info(f"Processing file {file}")
-            file_path = files_path / file
+    batches_path = raw_files_path / "_batches"
+    if os.path.exists(batches_path):
+        logger.info(f"Processing files in the directory {batches_path}.")
+        files = sorted(f for f in os.listdir(batches_path) if f.endswith(".ndjson.gz"))
+        new_files.extend(manifest.filter_new([f"_batches/{file}" for file in files]))
 
-            try:
-                with open(file_path, "r") as f:
-                    data = json.load(f)
+    # Read the new files as lines of NDJSON, without parsing them yet. They are keyed by
+    # their path, as the same file name can exist in several directories
+    new_files_lines = {}
+    new_files_manifest_entries = []
+
+    for relative_path in new_files:
+        file = relative_path.split("/")[-1]
+        logger.info(f"Processing file {file}")
+        file_path = raw_files_path / relative_path
+
+        try:
+            with open(file_path, "rb") as f:
+                content = f.read()
+            new_files_lines[relative_path] = read_raw_lines(
+                content=content, file_name=file
+            )
+            file_stats = os.stat(file_path)
+
+            new_files_manifest_entries.append(
+                {
+                    "path": relative_path,
+                    "size": file_stats.st_size,
+                    "mtime": file_stats.st_mtime,
+                    "content_hash": hashlib.sha256(content).hexdigest(),
+                }
+            )
+
+        except Exception as e:
+            logger.error(f"Error reading file {file}: {e}. Skipping.")
+            continue
 
-                # Flatten the JSON structure
-                data_flattened = flatten_json(data_json=data, logger=logger)
+    current_stage_metrics().add(
+        rows_in=sum(len(lines) for lines in new_files_lines.values()),
+        bytes_read=sum(entry["size"] for entry in new_files_manifest_entries),
+    )
 
-                # Check if any fields are missing from the API response
-                missing_fields = set(schema_flattened) - set(data_flattened)
+    # Parse all the new documents in bulk into an Arrow table
+    new_files_table = None
+    new_files_lines = {
+        relative_path: lines
+        for relative_path, lines in new_files_lines.items()
+        if lines
+    }
 
-                # If the fields are missing, create them with None
-                for field in missing_fields:
-                    data_flattened[field] = None
+    if new_files_lines:
+        try:
+            new_files_table = read_weather_documents(
+                lines=[line for lines in new_files_lines.values() for line in lines],
+                arrow_schema=arrow_schema,
+                schema_extractors=schema_extractors,
+                table_schema=table_schema,
+            )
+        except pa.ArrowInvalid as e:
+            logger.warning(
+                f"Error reading the new files in bulk: {e}. Reading them one by one."
+            )
 
-                # Append
-                new_files_list.append(data_flattened)
-                new_file_names.append(file)
-                new_files_ingestion_timestamps.append(pd.Timestamp.now())
-                new_files_processed += 1
+    # If the bulk read failed, read each file on its own, skipping the invalid ones
+    if new_files_lines and new_files_table is None:
+        file_tables = {}
 
-            except Exception as e:
-                logger.error(
-                    f"Error processing file {file} into DataFrame: {e}. Skipping."
+        for relative_path, lines in new_files_lines.items():
+            try:
+                file_tables[relative_path] = read_weather_documents(
+                    lines=lines,
+                    arrow_schema=arrow_schema,
+                    schema_extractors=schema_extractors,
+                    table_schema=table_schema,
                 )
-                continue
+            except pa.ArrowInvalid:
+                try:
+                    file_tables[relative_path] = extract_weather_documents(
+                        lines=lines,
+                        schema_extractors=schema_extractors,
+                        table_schema=table_schema,
+                    )
+                except Exception as e:
+                    logger.error(
+                        f"Error processing file {relative_path}: {e}. Skipping."
+                    )
+
+        new_files_lines = {
+            relative_path: new_files_lines[relative_path]
+            for relative_path in file_tables
+        }
+        new_files_manifest_entries = [
+            entry
+            for entry in new_files_manifest_entries
+            if entry["path"] in file_tables
+        ]
+        new_files_table = (
+            pa.concat_tables(file_tables.values()) if file_tables else None
+        )
 
-    # If new files exist, write the data and the txt file
-    if new_files_list:
-        # To avoid conversion problems, convert everything to string
-        new_files_df = pd.DataFrame(new_files_list).astype("string")
+    new_files_processed = len(new_files_lines)
 
+    # If new files exist, write the data and commit them in the manifest
+    if new_files_table is not None and new_files_table.num_rows:
         # Add the file_name and ingestion_date columns
-        new_files_df["file_name"] = new_file_names
-        new_files_df["ingestion_date"] = new_files_ingestion_timestamps
+        new_files_table = new_files_table.append_column(
+            "file_name",
+            repeat_values(
+                values=[
+                    relative_path.split("/")[-1] for relative_path in new_files_lines
+                ],
+                counts=[len(lines) for lines in new_files_lines.values()],
+                type=pa.string(),
+            ),
+        )
+        new_files_table = new_files_table.append_column(
+            "ingestion_date",
+            pa.array(
+                np.full(new_files_table.num_rows, pd.Timestamp.now().to_datetime64()),
+                type=pa.timestamp("ns"),
+            ),
+        )
 
-        # Append to the existing data
-        df = pd.concat([df, new_files_df], ignore_index=True)
+        # Add the partition columns
+        new_files_table = add_partition_columns(table=new_files_table, logger=logger)
+
+        batch_id = f"{pd.Timestamp.now():%Y%m%d%H%M%S}-{uuid.uuid4().hex[:8]}"
 
         try:
-            # Save the dataframe as a parquet
-            logger.info(f"Saving the DataFrame to {output_file_path}.")
-            df.to_parquet(output_file_path, index=False)
-            logger.info("DataFrame saved successfully.")
-
-            # Save the processed files list
-            logger.info(f"Saving the processed files list to {text_file_path}.")
-            with open(text_file_path, "a") as f:
-                for file in new_file_names:
-                    f.write(f"{file}\n")
+            # Register the files, write the new rows as new fragments of the dataset and commit
+            manifest.begin_batch(batch_id=batch_id, files=new_files_manifest_entries)
+
+            logger.info(f"Writing batch {batch_id} to the dataset {dataset_path}.")
+            write_weather_data_fragments(
+                table=new_files_table, dataset_path=dataset_path, batch_id=batch_id
+            )
+            manifest.commit_batch(batch_id=batch_id)
+            shutil.rmtree(dataset_path / "_staging" / batch_id)
+            current_stage_metrics().add(
+                rows_out=new_files_table.num_rows,
+                bytes_written=get_path_size(
+                    dataset_path, pattern=f"part-{batch_id}-*.parquet"
+                ),
+            )
+
+            # Hand off the new rows to the processing stage, to avoid reading them back
+            context.put_table(weather_table_name, new_files_table)
+
             logger.info(f"Successfuly loaded {new_files_processed} new files.")
 
         except Exception as e:
-            logger.error(f"Error saving the DataFrame or processed files: {e}")
+            logger.error(f"Error saving the table or committing the batch: {e}")
+
+    manifest.close()
 
     logger.info("Loading process of weather data from the API finalized.")
 
@@ -1,6 +1,11 @@
+import os
 import time
+import argparse
 import schedule
 import logging
+import functools
+
+from pathlib import Path
 
 from setup.setup import setup
 
@@ -13,6 +18,13 @@ from loading.loading_weather_data import load_weather_data
 from processing.processing_weather_data import process_weather_data
 from processing.processing_weather_codes import process_weather_codes
 from processing.processing_city_codes import process_city_codes
+from processing.processing_weather_enriched import process_weather_enriched
+from processing.processing_weather_rollups import process_weather_rollups
+
+from compaction.compaction_datasets import compact_datasets
+
+from utils.dag_runner import DAGRunner
+from utils.pipeline_context import PipelineContext
 
 logger = logging.getLogger("pipeline")
 logger.setLevel(logging.INFO)
@@ -23,24 +35,113 @@ handler.setFormatter(formatter)
 
 logger.addHandler(handler)
 
+
 def pipeline():
     """
-    Executes all the tasks in the pipeline.
+    Executes all the tasks in the pipeline. The tasks form three chains, which run
+    concurrently after the setup:
+        - Weather codes: load_weather_codes -> process_weather_codes.
+        - City codes: load_city_codes -> process_city_codes.
+        - Weather data: ingest_weather_data -> load_weather_data -> process_weather_data.
+    The weather data chain waits for process_city_codes, as ingestion and loading resolve
+    the cities to their IDs with the processed city codes. The three chains are then
+    joined by process_weather_enriched, which maintains the view of the weather data with
+    the city and weather code columns, while process_weather_rollups updates the hourly
+    and daily statistics of the new rows. Last, compact_datasets merges the small
+    fragments written by the run into the weather data datasets.
+
+    The environment variables and the config file are read once, into the context of the
+    run, which is shared by all the stages. Each stage is measured (wall time, CPU time,
+    rows and bytes read and written, peak memory) and its measurements are written to the
+    METRICS_PATH directory, see utils/stage_metrics.py.
     """
 
     logger.info("Starting the pipeline")
-    setup()
-    ingest_weather_data()
-    load_weather_data()
-    load_weather_codes()
-    load_city_codes()
-    process_weather_data()
-    process_weather_codes()
-    process_city_codes()
+
+    context = PipelineContext.build(path=Path(__file__).parent.parent, logger=logger)
+    if context is None:
+        logger.error("The pipeline could not be started.")
+        return
+
+    runner = DAGRunner(max_workers=3, logger=logger, metrics=context.metrics)
+    runner.add("setup", setup)
+
+    runner.add(
+        "load_weather_codes",
+        functools.partial(load_weather_codes, context=context),
+        dependencies=["setup"],
+    )
+    runner.add(
+        "process_weather_codes",
+        functools.partial(process_weather_codes, context=context),
+        dependencies=["load_weather_codes"],
+    )
+
+    runner.add(
+        "load_city_codes",
+        functools.partial(load_city_codes, context=context),
+        dependencies=["setup"],
+    )
+    runner.add(
+        "process_city_codes",
+        functools.partial(process_city_codes, context=context),
+        dependencies=["load_city_codes"],
+    )
+
+    runner.add(
+        "ingest_weather_data",
+        functools.partial(ingest_weather_data, context=context),
+        dependencies=["process_city_codes"],
+    )
+    runner.add(
+        "load_weather_data",
+        functools.partial(load_weather_data, context=context),
+        dependencies=["ingest_weather_data"],
+    )
+    runner.add(
+        "process_weather_data",
+        functools.partial(process_weather_data, context=context),
+        dependencies=["load_weather_data"],
+    )
+
+    runner.add(
+        "process_weather_enriched",
+        functools.partial(process_weather_enriched, context=context),
+        dependencies=["process_weather_data", "process_weather_codes"],
+    )
+
+    runner.add(
+        "process_weather_rollups",
+        functools.partial(process_weather_rollups, context=context),
+        dependencies=["process_weather_data"],
+    )
+
+    runner.add(
+        "compact_datasets",
+        functools.partial(compact_datasets, context=context),
+        dependencies=["process_weather_enriched", "process_weather_rollups"],
+    )
+
+    runner.run()
     logger.info("Pipeline completed.")
 
+
 if __name__ == "__main__":
-    # Call pipeline to run for the first time 
+    parser = argparse.ArgumentParser(description="Runs the weather data pipeline.")
+    parser.add_argument(
+        "--profile",
+        nargs="+",
+        choices=["cprofile", "tracemalloc"],
+        default=[],
+        help="Profilers enabled for each stage, overriding PIPELINE_PROFILE.",
+    )
+    args = parser.parse_args()
+
+    # The profilers are read from the environment when the context of each run is built
+    if args.profile:
+        os.environ["PIPELINE_PROFILE"] = ",".join(args.profile)
+
+    # Call pipeline to run for the first time
     pipeline()
 
     # Define the scheduler to run every half an hour after this
@@ -49,4 +150,4 @@ if __name__ == "__main__":
 
     while True:
         schedule.run_pending()
-        time.sleep(5)
\ No newline at end of file
+        time.sleep(5)
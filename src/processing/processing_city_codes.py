@@ -1,15 +1,20 @@
 import os
 import sys
-import json
+import inspect
 import logging
 import pandas as pd
+import pyarrow as pa
 
 from pathlib import Path
 
 # Add parent directory to sys.path to get the functions in utils
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
 
-from utils.auxiliary_functions import cast_columns, load_env_variables
+from utils.auxiliary_functions import cast_columns, write_parquet_file
+from utils.city_index import CityIndex
+from utils.stage_cache import StageCache
+from utils.stage_metrics import current_stage_metrics, get_path_size
+from utils.pipeline_context import PipelineContext
 
 logger = logging.getLogger("processing_city_codes")
 logger.setLevel(logging.DEBUG)
@@ -21,27 +26,40 @@ handler.setFormatter(formatter)
 logger.addHandler(handler)
 
 
-def process_city_codes():
+def process_city_codes(context: PipelineContext = None):
     """
     Processes the data regarding cities.
 
     Steps:
-        1. Load the environment variables.
-        2. Retrieve relevant fields for the task from the config.json.
-        3. Read the loaded/city_codes Parquet file.
-        4. Strip the columns of unwanted spaces.
-        5. Cast the columns to their respective types based on the configuration provided in
+        1. Get the environment variables and the config.json from the context of the run,
+           built by the stage itself if it is run on its own.
+        2. Retrieve relevant fields for the task from the config.
+        3. Compute the fingerprint of the stage, from the content of the loaded file, the
+           relevant config and the code of the stage. If the processed file exists and the
+           fingerprint did not change, skip processing.
+        4. Read the loaded/city_codes Parquet file.
+        5. Strip the columns of unwanted spaces.
+        6. Cast the columns to their respective types based on the configuration provided in
            the config.json file.
-        6. Rename and reorder the columns.
-        7. Add the ingestion date column.
-        8. Save the data as Parquet to the processed/ directory.
+        7. Rename and reorder the columns.
+        8. Add the ingestion date column.
+        9. Save the data as Parquet to the processed/ directory, with the layout of the
+           config.json file (sort order, row groups, encodings, statistics).
+        10. Build the index used to resolve city names to IDs, and save it next to the data.
     """
 
     logger.info("Starting processing of city codes")
 
-    # Load the environment variables
-    path = Path(__file__).parent.parent.parent
-    env_variables = load_env_variables(path, logger)
+    # Build the context of the run, if the stage is run on its own
+    if context is None:
+        context = PipelineContext.build(
+            path=Path(__file__).parent.parent.parent, logger=logger
+        )
+        if context is None:
+            return
+
+    env_variables = context.env_variables
+    config = context.config
 
     # Get the LOADED_FILES_PATH
     loaded_files_path = env_variables.get("LOADED_FILES_PATH")
@@ -49,16 +67,6 @@ def process_city_codes():
     # Get the PROCESSED_FILES_PATH
     processed_files_path = env_variables.get("PROCESSED_FILES_PATH")
 
-    # Read the configuration file
-    config_path = env_variables.get("CONFIG_PATH")
-    try:
-        logger.info("Loading the JSON configuration file")
-        with open(config_path, "r") as f:
-            config = json.load(f)
-    except Exception as e:
-        logger.error(f"Error loading the JSON configuration file: {e}")
-        return
-
     # File to read from
     loaded_city_codes = (
         config.get("loading_layer", {})
@@ -75,6 +83,14 @@ def process_city_codes():
     )
     processed_city_codes_file = processed_files_path / f"{processed_city_codes}.parquet"
 
+    # Index of city names to IDs
+    city_codes_index = (
+        config.get("processing_layer", {})
+        .get("city_codes", {})
+        .get("index_file", "city_codes_index")
+    )
+    city_codes_index_file = processed_files_path / f"{city_codes_index}.pkl"
+
     # Dictionary for column renaming
     columns_rename = (
         config.get("processing_layer", {})
@@ -87,24 +103,35 @@ def process_city_codes():
         config.get("processing_layer", {}).get("city_codes", {}).get("fields", {})
     )
 
-    # If the destination file exists, and the source file hasn't been updated, skip
-    if os.path.exists(loaded_city_codes_file) and os.path.exists(
-        processed_city_codes_file
-    ):
-        loaded_file_mdate = os.path.getmtime(loaded_city_codes_file)
-        processed_file_mdate = os.path.getmtime(processed_city_codes_file)
-
-        if processed_file_mdate > loaded_file_mdate:
-            logger.info(
-                f"Processed Parquet file is up to date. Loaded Parquet file has not been updated."
-                "Skipping file processing."
-            )
-            return
+    # Layout of the Parquet file
+    layout = config.get("processing_layer", {}).get("city_codes", {}).get("layout")
+
+    # If the destination file exists, and the fingerprint hasn't changed, skip
+    stage_cache = StageCache(output_path=processed_city_codes_file, logger=logger)
+    fingerprint = stage_cache.fingerprint(
+        inputs=[loaded_city_codes_file],
+        config=config.get("processing_layer", {}).get("city_codes"),
+        code_files=[
+            __file__,
+            inspect.getfile(cast_columns),
+            inspect.getfile(CityIndex),
+        ],
+    )
+
+    if stage_cache.is_up_to_date(fingerprint):
+        logger.info(
+            f"Processed Parquet file is up to date. Loaded Parquet file, config and code "
+            "have not changed. Skipping file processing."
+        )
+        return
 
     # Check if the file to be processed exists
     if os.path.exists(loaded_city_codes_file):
         logger.info(f"Loading data from the Parquet file {loaded_city_codes_file}")
         df = pd.read_parquet(loaded_city_codes_file)
+        current_stage_metrics().add(
+            rows_in=len(df), bytes_read=get_path_size(loaded_city_codes_file)
+        )
     else:
         logger.error(f"The Parquet file {loaded_city_codes_file} was not found.")
         return
@@ -141,9 +168,29 @@ def process_city_codes():
     # Save the data
     try:
         logger.info(f"Saving the DataFrame to {processed_city_codes_file}.")
-        df.to_parquet(processed_city_codes_file, index=False)
+        write_parquet_file(
+            table=pa.Table.from_pandas(df, preserve_index=False),
+            path=processed_city_codes_file,
+            layout=layout,
+            logger=logger,
+        )
+        current_stage_metrics().add(
+            rows_out=len(df), bytes_written=get_path_size(processed_city_codes_file)
+        )
+        stage_cache.save(fingerprint)
     except Exception as e:
         logger.error(f"Error saving the DataFrame: {e}")
+        return
+
+    # Build the city index
+    try:
+        logger.info(f"Building the city index {city_codes_index_file}.")
+        CityIndex.build(parquet_path=processed_city_codes_file, logger=logger).save(
+            path=city_codes_index_file
+        )
+        current_stage_metrics().add(bytes_written=get_path_size(city_codes_index_file))
+    except Exception as e:
+        logger.error(f"Error building the city index: {e}")
 
     logger.info(f"Processing of weather codes finalized.")
 
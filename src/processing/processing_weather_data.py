@@ -1,15 +1,31 @@
 import os
 import sys
+import inspect
 import json
+import uuid
+import shutil
 import logging
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
 
 from pathlib import Path
 
 # Add parent directory to sys.path to get the functions in utils
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
 
-from utils.auxiliary_functions import cast_columns, flatten_schema, load_env_variables
+from utils.auxiliary_functions import (
+    PROCESSED_WEATHER_DATA_PARTITIONING,
+    WEATHER_DATA_PARTITIONING,
+    open_parquet_dataset,
+    publish_staged_fragments,
+    stage_dataset_fragments,
+)
+from utils.stage_cache import StageCache
+from utils.observation_index import ObservationIndex, get_epoch_seconds
+from utils.stage_metrics import current_stage_metrics, get_path_size
+from utils.pipeline_context import PipelineContext
 
 logger = logging.getLogger("processing_weather_data")
 logger.setLevel(logging.DEBUG)
@@ -21,26 +37,159 @@ handler.setFormatter(formatter)
 logger.addHandler(handler)
 
 
-def process_weather_data():
+def read_processing_state(state_path: Path) -> dict:
     """
-    Processes the weather data.
+    Reads the state of the incremental processing of the weather data, a JSON file with:
+        - watermark: the highest 'ingestion_date' of the loaded rows already processed, in
+          ISO format.
+        - pending: the run whose fragments were staged but not published yet, as a
+          dictionary with its 'batch_id' and the 'watermark' it reached. None otherwise.
+        - generation: the identifier of the last rebuild of the processed data from
+          scratch. The stages reading the processed data incrementally (the enriched view
+          and the rollups) compare it with the one they last read, as a rebuild gives
+          every row a new 'ingestion_date'.
+
+    Args:
+        state_path (Path): the state file.
+
+    Returns:
+        dict: the state. Empty if the file does not exist or cannot be read.
+    """
+
+    if not os.path.exists(state_path):
+        return {}
+
+    try:
+        with open(state_path, "r") as f:
+            return json.load(f)
+    except Exception as e:
+        logger.error(f"Error reading the processing state {state_path}: {e}")
+        return {}
+
+
+def get_processing_state_path(config: dict, processed_files_path: Path) -> Path:
+    """
+    Gets the state file of the incremental processing of the weather data, defined in the
+    'processing_layer' > 'weather_data' entry of the config file.
+
+    Args:
+        config (dict): the configuration file.
+        processed_files_path (Path): the directory of the processed files.
+
+    Returns:
+        Path: the state file.
+    """
+
+    weather_data_config = config.get("processing_layer", {}).get("weather_data", {})
+    table_name = weather_data_config.get("table_name", "weather_data_processed")
+    state_file_name = weather_data_config.get("state_file", f"{table_name}_state")
+
+    return processed_files_path / f"{state_file_name}.json"
+
+
+def save_processing_state(state_path: Path, state: dict) -> None:
+    """
+    Saves the state of the incremental processing. The file is replaced atomically, so a
+    crash never leaves it half-written.
+
+    Args:
+        state_path (Path): the state file.
+        state (dict): the state, see read_processing_state.
+    """
+
+    temporary_path = f"{state_path}.tmp"
+
+    with open(temporary_path, "w") as f:
+        json.dump(state, f)
+    os.replace(temporary_path, state_path)
+
+
+def recover_pending_run(state: dict, state_path: Path, dataset_path: Path) -> dict:
+    """
+    Recovers from a run that crashed after staging its fragments:
+        - If the fragments were fully written (the _SUCCESS marker exists), they are
+          published and the watermark is moved forward.
+        - Otherwise, the staged fragments are discarded and the watermark is kept, so the
+          rows are processed again.
+
+    Args:
+        state (dict): the state, see read_processing_state.
+        state_path (Path): the state file.
+        dataset_path (Path): the root directory of the processed dataset.
+
+    Returns:
+        dict: the recovered state.
+    """
+
+    pending = state.get("pending")
+
+    if pending:
+        batch_id = pending["batch_id"]
+
+        if os.path.exists(dataset_path / "_staging" / batch_id / "_SUCCESS"):
+            logger.info(f"Recovering run {batch_id}: publishing its fragments.")
+            publish_staged_fragments(dataset_path=dataset_path, batch_id=batch_id)
+            state = {**state, "watermark": pending["watermark"], "pending": None}
+        else:
+            logger.info(f"Recovering run {batch_id}: discarding it.")
+            state = {**state, "pending": None}
+
+        save_processing_state(state_path=state_path, state=state)
+
+    if os.path.exists(dataset_path / "_staging"):
+        shutil.rmtree(dataset_path / "_staging")
+
+    return state
+
+
+def process_weather_data(context: PipelineContext = None):
+    """
+    Processes the weather data incrementally. The processed table is a Hive-partitioned
+    Parquet dataset, stored as date=<yyyy-mm-dd>/part-<batch_id>-<i>.parquet, to which each
+    run appends the rows loaded since the previous one.
+
+    The progress is tracked by a watermark, the highest 'ingestion_date' of the loaded rows
+    already processed, stored in a JSON state file next to the dataset. Only the loaded rows
+    ingested after the watermark are read, with a filter pushed down to the Parquet reader.
 
     Steps:
-        1. Load the environment variables.
-        2. Retrieve relevant fields for the task from the config.json.
-        3. Read the loaded/weather_data Parquet file.
-        4. Cast the columns to their respective types based on the configuration provided in
-           the config.json file.
+        1. Get the environment variables and the config.json from the context of the run,
+           built by the stage itself if it is run on its own.
+        2. Retrieve relevant fields for the task from the config.
+        3. Read the state file and recover the run that crashed before publishing its
+           fragments, if any. If there is no watermark, the mode is "full", the processed
+           dataset does not exist or the fingerprint of the config and code of the stage
+           changed, remove the processed data and start over, with a new generation.
+        4. Get the rows of the loaded/weather_data Parquet dataset ingested after the
+           watermark. If they are exactly the rows handed off in memory by the loading
+           stage, through the context of the run, use them. Otherwise, read them through
+           pyarrow.dataset. Its columns are already stored with the types of the
+           config.json file. If there are none, skip processing.
+        5. Reject the rows already processed, or repeated in the new rows, by looking up
+           their keys (city ID and timestamp) in the observation index. The index is
+           rebuilt from the processed dataset if it does not match the watermark.
         6. Rename and reorder the columns.
-        7. Add the ingestion date column.
-        8. Save the data as Parquet to the processed/ directory.
+        7. Order the new rows by the sort columns of the layout in the config.json file
+           (city ID and timestamp).
+        8. Add the ingestion date column.
+        9. Stage the new rows as fragments of the processed dataset, publish them, move
+           the watermark forward and add their keys to the observation index.
+        10. Hand off the new rows, as an Arrow table, to the enriched weather data stage
+            through the context of the run.
     """
 
     logger.info("Starting processing of weather data")
 
-    # Load the environment variables
-    path = Path(__file__).parent.parent.parent
-    env_variables = load_env_variables(path, logger)
+    # Build the context of the run, if the stage is run on its own
+    if context is None:
+        context = PipelineContext.build(
+            path=Path(__file__).parent.parent.parent, logger=logger
+        )
+        if context is None:
+            return
+
+    env_variables = context.env_variables
+    config = context.config
 
     # Get the LOADED_FILES_PATH
     loaded_files_path = env_variables.get("LOADED_FILES_PATH")
@@ -48,30 +197,36 @@ def process_weather_data():
     # Get the PROCESSED_FILES_PATH
     processed_files_path = env_variables.get("PROCESSED_FILES_PATH")
 
-    # Read the configuration file
-    config_path = env_variables.get("CONFIG_PATH")
-    try:
-        logger.info("Loading the JSON configuration file")
-        with open(config_path, "r") as f:
-            config = json.load(f)
-    except Exception as e:
-        logger.error(f"Error loading the JSON configuration file: {e}")
-        return
-
     loaded_weather_data = (
         config.get("loading_layer", {})
         .get("weather_data", {})
         .get("table_name", "weather_data_loaded")
     )
-    loaded_weather_data_file = loaded_files_path / f"{loaded_weather_data}.parquet"
+    loaded_weather_data_path = loaded_files_path / loaded_weather_data
 
     processed_weather_data = (
         config.get("processing_layer", {})
         .get("weather_data", {})
         .get("table_name", "weather_data_processed")
     )
-    processed_weather_data_file = (
-        processed_files_path / f"{processed_weather_data}.parquet"
+    processed_weather_data_path = processed_files_path / processed_weather_data
+    legacy_file_path = processed_files_path / f"{processed_weather_data}.parquet"
+
+    state_path = get_processing_state_path(
+        config=config, processed_files_path=processed_files_path
+    )
+
+    index_file_name = (
+        config.get("processing_layer", {})
+        .get("weather_data", {})
+        .get("index_file", f"{processed_weather_data}_keys")
+    )
+    index_path = processed_files_path / f"{index_file_name}.npz"
+
+    processing_mode = (
+        config.get("processing_layer", {})
+        .get("weather_data", {})
+        .get("mode", "incremental")
     )
 
     columns_rename = (
@@ -80,37 +235,181 @@ def process_weather_data():
         .get("columns_rename", {})
     )
 
-    list_fields = (
-        config.get("ingestion_layer", {}).get("weather_data", {}).get("fields", {})
+    # Layout of the fragments: sort order, row groups, encodings and statistics. The rows
+    # are sorted by city ID and timestamp unless configured otherwise
+    layout = {
+        "sort_by": ["city_id", "time_value"],
+        **config.get("processing_layer", {}).get("weather_data", {}).get("layout", {}),
+    }
+
+    if not os.path.exists(loaded_weather_data_path):
+        logger.error(f"The Parquet dataset {loaded_weather_data_path} was not found.")
+        return
+
+    # Read the state, and recover the previous run if it crashed
+    state = recover_pending_run(
+        state=read_processing_state(state_path=state_path),
+        state_path=state_path,
+        dataset_path=processed_weather_data_path,
     )
+    watermark = state.get("watermark")
+    generation = state.get("generation")
 
-    # If the destination file exists, and the source file hasn't been updated, skip
-    if os.path.exists(loaded_weather_data_file) and os.path.exists(
-        processed_weather_data_file
+    # The rows already processed are stale if the config or the code of the stage changed
+    stage_cache = StageCache(output_path=processed_weather_data_path, logger=logger)
+    fingerprint = stage_cache.fingerprint(
+        inputs=[],
+        config={
+            "fields": config.get("ingestion_layer", {})
+            .get("weather_data", {})
+            .get("fields"),
+            "columns_rename": columns_rename,
+        },
+        code_files=[__file__, inspect.getfile(open_parquet_dataset)],
+    )
+
+    # Without a watermark, in full mode or if the fingerprint changed, rebuild the
+    # processed data from scratch
+    if (
+        watermark is None
+        or processing_mode == "full"
+        or not stage_cache.is_up_to_date(fingerprint)
     ):
-        loaded_file_mdate = os.path.getmtime(loaded_weather_data_file)
-        processed_file_mdate = os.path.getmtime(processed_weather_data_file)
-
-        if processed_file_mdate > loaded_file_mdate:
-            logger.info(
-                f"Processed Parquet file is up to date. Loaded Parquet file has not been updated."
-                "Skipping file processing."
-            )
-            return
+        logger.info("Rebuilding the processed weather data from scratch.")
+        watermark = None
 
-    if os.path.exists(loaded_weather_data_file):
-        logger.info(f"Loading data from the Parquet file {loaded_weather_data_file}")
-        df = pd.read_parquet(loaded_weather_data_file)
-    else:
-        logger.error(f"The Parquet file {loaded_weather_data_file} was not found.")
+        # Start a new generation, before removing the processed data, so the stages
+        # reading it incrementally rebuild their outputs even if this run fails
+        generation = f"{pd.Timestamp.now():%Y%m%d%H%M%S}-{uuid.uuid4().hex[:8]}"
+        save_processing_state(
+            state_path=state_path,
+            state={"watermark": None, "pending": None, "generation": generation},
+        )
+
+        if os.path.exists(processed_weather_data_path):
+            shutil.rmtree(processed_weather_data_path)
+        if os.path.exists(legacy_file_path):
+            os.remove(legacy_file_path)
+        ObservationIndex.remove(index_path)
+
+    # Keys of the observations already processed. If the index does not match the state
+    # (e.g. the previous run crashed before saving it), rebuild it from the processed data
+    index = ObservationIndex(path=index_path, logger=logger)
+
+    if watermark is None or not os.path.exists(processed_weather_data_path):
+        index.reset(watermark=watermark)
+    elif not index.is_consistent(watermark):
+        logger.info("Rebuilding the observation index from the processed weather data.")
+        processed_keys = open_parquet_dataset(
+            path=processed_weather_data_path,
+            partitioning=PROCESSED_WEATHER_DATA_PARTITIONING,
+            logger=logger,
+        ).to_table(columns=["city_id", "time_value"])
+        index.reset(
+            keys=ObservationIndex.encode_keys(
+                city_ids=processed_keys.column("city_id").to_numpy(),
+                epochs=get_epoch_seconds(processed_keys.column("time_value")),
+            ),
+            watermark=watermark,
+        )
+        index.save()
+
+    logger.info(f"Loading data from the Parquet dataset {loaded_weather_data_path}")
+    dataset = open_parquet_dataset(
+        path=loaded_weather_data_path,
+        partitioning=WEATHER_DATA_PARTITIONING,
+        logger=logger,
+    )
+
+    # The partition columns are derived from 'id' and 'dt', so they are not read
+    data_columns = [
+        column
+        for column in dataset.schema.names
+        if column not in WEATHER_DATA_PARTITIONING
+    ]
+
+    # Use the rows handed off in memory by the loading stage, if they are the only rows
+    # ingested after the watermark
+    table = None
+    handed_off_table = context.pop_table(loaded_weather_data)
+
+    if (
+        handed_off_table is not None
+        and watermark is not None
+        and set(data_columns) <= set(handed_off_table.column_names)
+    ):
+        batch_start = pc.min(handed_off_table.column("ingestion_date"))
+        rows_before_batch = dataset.count_rows(
+            filter=(ds.field("ingestion_date") > pd.Timestamp(watermark))
+            & (ds.field("ingestion_date") < batch_start)
+        )
+
+        if rows_before_batch == 0:
+            logger.info("Using the rows handed off by the loading stage.")
+            table = handed_off_table.select(data_columns)
+
+    # Otherwise, only read the rows ingested after the watermark
+    if table is None:
+        row_filter = (
+            ds.field("ingestion_date") > pd.Timestamp(watermark)
+            if watermark is not None
+            else None
+        )
+        table = dataset.to_table(columns=data_columns, filter=row_filter)
+
+        # The filter is not on a partition column, so every file of the dataset is scanned
+        current_stage_metrics().add(
+            bytes_read=sum(os.path.getsize(file) for file in dataset.files)
+        )
+
+    current_stage_metrics().add(rows_in=table.num_rows)
+
+    if table.num_rows == 0:
+        logger.info(
+            f"No rows were loaded after the watermark {watermark}. Skipping processing."
+        )
         return
 
-    # Do schema enforcement
-    # Flatten the schema
-    schema_flattened = flatten_schema(schema_dict=list_fields, logger=logger)
+    new_watermark = pc.max(table.column("ingestion_date")).as_py()
+
+    # Reject the observations already processed, or repeated in the batch
+    keys = ObservationIndex.encode_keys(
+        city_ids=table.column("id").to_numpy(zero_copy_only=False),
+        epochs=get_epoch_seconds(table.column("dt")),
+    )
+    is_new = index.filter_new(keys)
+    duplicates = len(keys) - int(is_new.sum())
+
+    logger.info(
+        f"Rejected {duplicates} duplicate rows out of {len(keys)} "
+        f"({duplicates / len(keys):.1%})."
+    )
+    current_stage_metrics().add(duplicates=duplicates)
+
+    if duplicates == len(keys):
+        logger.info(
+            "All the rows were already processed. Moving the watermark forward."
+        )
+        save_processing_state(
+            state_path=state_path,
+            state={
+                "watermark": pd.Timestamp(new_watermark).isoformat(),
+                "pending": None,
+                "generation": generation,
+            },
+        )
+        index.add(keys=keys[is_new], watermark=pd.Timestamp(new_watermark).isoformat())
+        index.save()
+        return
 
-    # Cast the columns
-    df = cast_columns(df=df, column_types=schema_flattened, logger=logger)
+    if duplicates > 0:
+        table = table.filter(pa.array(is_new))
+
+    logger.info(
+        f"Processing {table.num_rows} rows loaded after the watermark {watermark}."
+    )
+
+    df = table.to_pandas(coerce_temporal_nanoseconds=True)
 
     # Rename and reorder the columns
     if not columns_rename:
@@ -126,17 +425,64 @@ def process_weather_data():
             df = df[columns_rename.values()]
         except IndexError as e:
             logger.info(f"Error in reordering the columns: {e}")
-    
-    # Order the columns by city ID and timestamp
-    df = df.sort_values(by=["city_id", "time_value"], ascending=True)
 
     # Add an ingestion date column
     df["ingestion_date"] = pd.Timestamp.now()
 
+    # Add the partition column, the date of the measurement
+    df["date"] = df["time_value"].dt.strftime("%Y-%m-%d")
+
     # Save the data
+    batch_id = f"{pd.Timestamp.now():%Y%m%d%H%M%S}-{uuid.uuid4().hex[:8]}"
+    processed_table = pa.Table.from_pandas(df, preserve_index=False)
+
     try:
-        logger.info(f"Saving the DataFrame to {processed_weather_data_file}.")
-        df.to_parquet(processed_weather_data_file, index=False)
+        logger.info(
+            f"Saving the new rows to the Parquet dataset {processed_weather_data_path}."
+        )
+        save_processing_state(
+            state_path=state_path,
+            state={
+                "watermark": watermark,
+                "pending": {
+                    "batch_id": batch_id,
+                    "watermark": pd.Timestamp(new_watermark).isoformat(),
+                },
+                "generation": generation,
+            },
+        )
+        stage_dataset_fragments(
+            table=processed_table,
+            dataset_path=processed_weather_data_path,
+            batch_id=batch_id,
+            partitioning=PROCESSED_WEATHER_DATA_PARTITIONING,
+            layout=layout,
+            logger=logger,
+        )
+        publish_staged_fragments(
+            dataset_path=processed_weather_data_path, batch_id=batch_id
+        )
+        save_processing_state(
+            state_path=state_path,
+            state={
+                "watermark": pd.Timestamp(new_watermark).isoformat(),
+                "pending": None,
+                "generation": generation,
+            },
+        )
+        shutil.rmtree(processed_weather_data_path / "_staging")
+        index.add(keys=keys[is_new], watermark=pd.Timestamp(new_watermark).isoformat())
+        index.save()
+        current_stage_metrics().add(
+            rows_out=len(df),
+            bytes_written=get_path_size(
+                processed_weather_data_path, pattern=f"part-{batch_id}-*.parquet"
+            ),
+        )
+        stage_cache.save(fingerprint)
+
+        # Hand off the new rows to the enriched weather data stage
+        context.put_table(processed_weather_data, processed_table)
     except Exception as e:
         logger.error(f"Error saving the DataFrame: {e}")
 
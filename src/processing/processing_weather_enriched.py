@@ -0,0 +1,562 @@
+import os
+import sys
+import inspect
+import uuid
+import shutil
+import logging
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+from pathlib import Path
+
+# Add parent directory to sys.path to get the functions in utils
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from utils.auxiliary_functions import (
+    PROCESSED_WEATHER_DATA_PARTITIONING,
+    list_dataset_files,
+    open_parquet_dataset,
+    publish_staged_fragments,
+    stage_dataset_fragments,
+    write_parquet_file,
+)
+from utils.stage_cache import StageCache
+from utils.stage_metrics import current_stage_metrics, get_path_size
+from utils.pipeline_context import PipelineContext
+from processing.processing_weather_data import (
+    get_processing_state_path,
+    read_processing_state,
+    recover_pending_run,
+    save_processing_state,
+)
+
+logger = logging.getLogger("processing_weather_enriched")
+logger.setLevel(logging.INFO)
+
+handler = logging.StreamHandler()
+formatter = logging.Formatter("%(asctime)s %(name)s, %(levelname)s: %(message)s")
+handler.setFormatter(formatter)
+
+logger.addHandler(handler)
+
+
+def join_dimension(
+    table: pa.Table, foreign_key: str, dimension: pa.Table, key: str, columns: dict
+) -> pa.Table:
+    """
+    Appends the columns of the dimension table 'dimension' to 'table', looking up each row
+    by its 'foreign_key' in the 'key' column of the dimension. Rows without a match get
+    nulls.
+
+    The lookup is a hash join: the distinct keys of 'table' are looked up once in a hash
+    table of the dimension keys (pc.index_in), and the matching dimension rows are taken.
+    String columns are dictionary-encoded, with the matching rows as the dictionary, so the
+    values are stored once per distinct key instead of once per row.
+
+    Args:
+        table (pa.Table): the table, e.g. the processed weather data.
+        foreign_key (str): the column of 'table' holding the key, e.g. 'city_id'.
+        dimension (pa.Table): the dimension table, e.g. the processed city codes.
+        key (str): the key column of the dimension, e.g. 'id'.
+        columns (dict): a dictionary mapping the columns of the dimension to their names in
+        the joined table.
+
+    Returns:
+        pa.Table: the table with the dimension columns appended.
+    """
+
+    keys = table.column(foreign_key).combine_chunks()
+    dimension_keys = pc.cast(dimension.column(key), keys.type)
+
+    # The dimension rows matching the distinct keys of the table
+    unique_keys = pc.unique(keys)
+    positions = pc.index_in(unique_keys, value_set=dimension_keys)
+    matched = pc.is_valid(positions)
+    unique_keys = unique_keys.filter(matched)
+    matched_rows = dimension.take(positions.filter(matched))
+
+    # The position of the key of each row among them
+    indices = pc.index_in(keys, value_set=unique_keys)
+
+    for source, target in columns.items():
+        values = matched_rows.column(source).combine_chunks()
+
+        if pa.types.is_string(values.type) or pa.types.is_large_string(values.type):
+            column = pa.DictionaryArray.from_arrays(indices, values)
+        else:
+            column = values.take(indices)
+
+        table = table.append_column(target, column)
+
+    return table
+
+
+def hash_dimension(dimension: pa.Table, key: str, columns: dict) -> pd.DataFrame:
+    """
+    Hashes the columns used by the view of each row of the dimension table 'dimension'.
+
+    Args:
+        dimension (pa.Table): the dimension table.
+        key (str): the key column of the dimension.
+        columns (dict): the columns of the dimension used by the view, as keys.
+
+    Returns:
+        pd.DataFrame: a DataFrame with the 'key' column and a 'hash' column (uint64).
+    """
+
+    df = dimension.select([key, *columns]).to_pandas()
+
+    return pd.DataFrame(
+        {
+            key: df[key].to_numpy(),
+            "hash": pd.util.hash_pandas_object(
+                df[list(columns)], index=False
+            ).to_numpy(),
+        }
+    )
+
+
+def get_changed_keys(hashes: pd.DataFrame, key: str, snapshot_path: Path) -> list:
+    """
+    Compares the hashes of the rows of a dimension with the snapshot saved by the previous
+    refresh, to get the keys whose rows were added, removed or modified.
+
+    Args:
+        hashes (pd.DataFrame): the hashes of the current rows, see hash_dimension.
+        key (str): the key column of the dimension.
+        snapshot_path (Path): the snapshot of the hashes, a Parquet file.
+
+    Returns:
+        list or None: the changed keys. None if there is no snapshot, in which case every
+        key must be considered changed.
+    """
+
+    if not os.path.exists(snapshot_path):
+        return None
+
+    previous_hashes = pd.read_parquet(snapshot_path)
+
+    # The (key, hash) pairs found in only one of the two versions
+    changed = pd.concat([hashes, previous_hashes]).drop_duplicates(keep=False)
+
+    return changed[key].unique().tolist()
+
+
+def refresh_fragments(
+    dataset_path: Path, dimensions: dict, changed_keys: dict, layout: dict
+) -> int:
+    """
+    Joins again, with the current dimension tables, the fragments of the view holding rows
+    whose keys changed. Only the key columns of each fragment are read to find out if it is
+    affected. The affected fragments are rewritten under a temporary name and replaced
+    atomically, so readers never see a partially written fragment.
+
+    Args:
+        dataset_path (Path): the root directory of the view.
+        dimensions (dict): the dimensions, see process_weather_enriched.
+        changed_keys (dict): a dictionary mapping each dimension to its changed keys, see
+        get_changed_keys. Dimensions without changes are left out.
+        layout (dict): the layout of the fragments, see get_parquet_layout.
+
+    Returns:
+        int: the number of fragments rewritten.
+    """
+
+    rewritten_fragments = 0
+    joined_columns = [
+        column
+        for dimension in dimensions.values()
+        for column in dimension["columns"].values()
+    ]
+
+    for fragment_path in list_dataset_files(
+        path=dataset_path, partitioning=PROCESSED_WEATHER_DATA_PARTITIONING
+    ):
+        fragment = pq.ParquetFile(fragment_path)
+        fragment_keys = fragment.read(
+            columns=[dimensions[name]["foreign_key"] for name in changed_keys]
+        )
+
+        if not any(
+            keys is None
+            or pc.any(
+                pc.is_in(
+                    fragment_keys.column(dimensions[name]["foreign_key"]),
+                    value_set=pa.array(
+                        keys,
+                        type=fragment_keys.schema.field(
+                            dimensions[name]["foreign_key"]
+                        ).type,
+                    ),
+                )
+            ).as_py()
+            for name, keys in changed_keys.items()
+        ):
+            continue
+
+        table = fragment.read()
+        table = table.drop_columns(
+            [column for column in joined_columns if column in table.column_names]
+        )
+        for dimension in dimensions.values():
+            table = join_dimension(
+                table=table,
+                foreign_key=dimension["foreign_key"],
+                dimension=dimension["table"],
+                key=dimension["key"],
+                columns=dimension["columns"],
+            )
+
+        temporary_path = fragment_path.parent / f".{fragment_path.name}.tmp"
+        write_parquet_file(
+            table=table, path=temporary_path, layout=layout, logger=logger
+        )
+        os.replace(temporary_path, fragment_path)
+        rewritten_fragments += 1
+
+    return rewritten_fragments
+
+
+def process_weather_enriched(context: PipelineContext = None):
+    """
+    Maintains the enriched weather data, a denormalized view of the processed weather data
+    joined to the processed city codes (on 'city_id') and weather codes (on 'weather_id'),
+    so consumers do not need to join the tables themselves. The view is a Hive-partitioned
+    Parquet dataset, stored as date=<yyyy-mm-dd>/part-<batch_id>-<i>.parquet.
+
+    The view is maintained incrementally:
+        - New observations: as in process_weather_data, a watermark (the highest
+          'ingestion_date' of the processed rows already joined) is stored in a JSON state
+          file next to the view, and each run only joins and appends the rows processed
+          after it.
+        - Dimension changes: the columns of each dimension used by the view are hashed per
+          row, and the hashes are saved in a snapshot (<table_name>_dimensions/), next to
+          the view. When a dimension file changes, only the fragments of the view holding
+          rows of the keys that were added, removed or modified are joined again.
+
+    Steps:
+        1. Get the environment variables and the config.json from the context of the run,
+           built by the stage itself if it is run on its own.
+        2. Retrieve relevant fields for the task from the config.
+        3. Read the state file and recover the run that crashed before publishing its
+           fragments, if any. If there is no watermark, the mode is "full", the
+           fingerprint of the config and code of the stage changed or the processed data
+           was rebuilt (its generation changed), remove the view and start over.
+        4. Get the processed rows after the watermark, handed off in memory by the
+           processing stage, through the context of the run, or read from the processed
+           dataset, with a filter pushed down to the Parquet reader.
+        5. If the content of the dimension files changed, compare their hashes with the
+           snapshot and join the affected fragments again.
+        6. Join the new rows to the dimensions, stage them as fragments of the view,
+           publish them and move the watermark forward.
+    """
+
+    logger.info("Starting processing of the enriched weather data")
+
+    # Build the context of the run, if the stage is run on its own
+    if context is None:
+        context = PipelineContext.build(
+            path=Path(__file__).parent.parent.parent, logger=logger
+        )
+        if context is None:
+            return
+
+    env_variables = context.env_variables
+    config = context.config
+
+    # Get the PROCESSED_FILES_PATH
+    processed_files_path = env_variables.get("PROCESSED_FILES_PATH")
+
+    processed_weather_data = (
+        config.get("processing_layer", {})
+        .get("weather_data", {})
+        .get("table_name", "weather_data_processed")
+    )
+    processed_weather_data_path = processed_files_path / processed_weather_data
+
+    processed_city_codes = (
+        config.get("processing_layer", {})
+        .get("city_codes", {})
+        .get("table_name", "city_codes_processed")
+    )
+    processed_weather_codes = (
+        config.get("processing_layer", {})
+        .get("weather_codes", {})
+        .get("table_name", "weather_codes_processed")
+    )
+
+    enriched_config = config.get("processing_layer", {}).get(
+        "weather_data_enriched", {}
+    )
+    enriched_weather_data = enriched_config.get("table_name", "weather_data_enriched")
+    enriched_weather_data_path = processed_files_path / enriched_weather_data
+    dimensions_path = processed_files_path / f"{enriched_weather_data}_dimensions"
+
+    state_file_name = enriched_config.get(
+        "state_file", f"{enriched_weather_data}_state"
+    )
+    state_path = processed_files_path / f"{state_file_name}.json"
+
+    processing_mode = enriched_config.get("mode", "incremental")
+
+    # Layout of the fragments: sort order, row groups, encodings and statistics. The rows
+    # are sorted by city ID and timestamp unless configured otherwise
+    layout = {"sort_by": ["city_id", "time_value"], **enriched_config.get("layout", {})}
+
+    # The dimensions joined to the weather data, with the columns they add to the view
+    dimensions = {
+        "city_codes": {
+            "path": processed_files_path / f"{processed_city_codes}.parquet",
+            "key": "id",
+            "foreign_key": "city_id",
+            "columns": enriched_config.get(
+                "city_columns",
+                {
+                    "name": "city_name",
+                    "country": "country",
+                    "latitude": "latitude",
+                    "longitude": "longitude",
+                },
+            ),
+        },
+        "weather_codes": {
+            "path": processed_files_path / f"{processed_weather_codes}.parquet",
+            "key": "id",
+            "foreign_key": "weather_id",
+            "columns": enriched_config.get(
+                "weather_code_columns",
+                {
+                    "short_description": "short_description",
+                    "long_description": "long_description",
+                },
+            ),
+        },
+    }
+
+    if not os.path.exists(processed_weather_data_path):
+        logger.error(
+            f"The Parquet dataset {processed_weather_data_path} was not found."
+        )
+        return
+
+    for dimension in dimensions.values():
+        if not os.path.exists(dimension["path"]):
+            logger.error(f"The Parquet file {dimension['path']} was not found.")
+            return
+
+    # Read the state, and recover the previous run if it crashed
+    state = recover_pending_run(
+        state=read_processing_state(state_path=state_path),
+        state_path=state_path,
+        dataset_path=enriched_weather_data_path,
+    )
+    watermark = state.get("watermark")
+
+    # The generation of the processed data the view was built from. If the processed data
+    # was rebuilt since, all its rows have a new 'ingestion_date', past the watermark
+    source_generation = read_processing_state(
+        state_path=get_processing_state_path(
+            config=config, processed_files_path=processed_files_path
+        )
+    ).get("generation")
+
+    # The view is stale if the config or the code of the stage changed
+    stage_cache = StageCache(output_path=enriched_weather_data_path, logger=logger)
+    fingerprint = stage_cache.fingerprint(
+        inputs=[],
+        config=enriched_config,
+        code_files=[__file__, inspect.getfile(open_parquet_dataset)],
+    )
+
+    # The dimensions changed if the content of their files changed
+    dimensions_cache = StageCache(output_path=dimensions_path, logger=logger)
+    dimensions_fingerprint = dimensions_cache.fingerprint(
+        inputs=[dimension["path"] for dimension in dimensions.values()],
+        config={},
+        code_files=[],
+    )
+
+    # Without a watermark, in full mode, if the fingerprint changed or if the processed
+    # data was rebuilt, rebuild the view
+    rebuild = (
+        watermark is None
+        or processing_mode == "full"
+        or not stage_cache.is_up_to_date(fingerprint)
+        or state.get("source_generation") != source_generation
+    )
+    if rebuild:
+        logger.info("Rebuilding the enriched weather data from scratch.")
+        watermark = None
+
+        for path in [enriched_weather_data_path, dimensions_path]:
+            if os.path.exists(path):
+                shutil.rmtree(path)
+
+    dimensions_changed = rebuild or not dimensions_cache.is_up_to_date(
+        dimensions_fingerprint
+    )
+
+    # Get the processed rows after the watermark, from the rows handed off by the
+    # processing stage if they are the only ones
+    dataset = open_parquet_dataset(
+        path=processed_weather_data_path,
+        partitioning=PROCESSED_WEATHER_DATA_PARTITIONING,
+        logger=logger,
+    )
+
+    table = None
+    handed_off_table = context.pop_table(processed_weather_data)
+
+    if (
+        handed_off_table is not None
+        and watermark is not None
+        and set(dataset.schema.names) <= set(handed_off_table.column_names)
+    ):
+        batch_start = pc.min(handed_off_table.column("ingestion_date"))
+        rows_before_batch = dataset.count_rows(
+            filter=(ds.field("ingestion_date") > pd.Timestamp(watermark))
+            & (ds.field("ingestion_date") < batch_start)
+        )
+
+        if rows_before_batch == 0:
+            logger.info("Using the rows handed off by the processing stage.")
+            table = handed_off_table.select(dataset.schema.names)
+
+    if table is None:
+        row_filter = (
+            ds.field("ingestion_date") > pd.Timestamp(watermark)
+            if watermark is not None
+            else None
+        )
+        table = dataset.to_table(filter=row_filter)
+
+    current_stage_metrics().add(rows_in=table.num_rows)
+
+    if table.num_rows == 0 and not dimensions_changed:
+        logger.info(
+            f"No rows were processed after the watermark {watermark}, and the "
+            "dimensions did not change. Skipping processing."
+        )
+        return
+
+    # Read the columns of the dimensions used by the view
+    for dimension in dimensions.values():
+        logger.info(f"Loading data from the Parquet file {dimension['path']}")
+        dimension["table"] = pq.read_table(
+            dimension["path"], columns=[dimension["key"], *dimension["columns"]]
+        )
+        current_stage_metrics().add(bytes_read=get_path_size(dimension["path"]))
+
+    # Join again the fragments holding rows of the keys that changed
+    if dimensions_changed:
+        os.makedirs(dimensions_path, exist_ok=True)
+        changed_keys = {}
+        hashes = {}
+
+        for name, dimension in dimensions.items():
+            hashes[name] = hash_dimension(
+                dimension=dimension["table"],
+                key=dimension["key"],
+                columns=dimension["columns"],
+            )
+            keys = get_changed_keys(
+                hashes=hashes[name],
+                key=dimension["key"],
+                snapshot_path=dimensions_path / f"{name}.parquet",
+            )
+            if keys is None or keys:
+                changed_keys[name] = keys
+
+        if changed_keys and os.path.exists(enriched_weather_data_path):
+            logger.info(
+                f"Refreshing the enriched weather data for the changed dimensions "
+                f"{list(changed_keys)}."
+            )
+            rewritten_fragments = refresh_fragments(
+                dataset_path=enriched_weather_data_path,
+                dimensions=dimensions,
+                changed_keys=changed_keys,
+                layout=layout,
+            )
+            logger.info(f"Refreshed {rewritten_fragments} fragments.")
+
+        for name, dimension_hashes in hashes.items():
+            dimension_hashes.to_parquet(
+                dimensions_path / f"{name}.parquet", index=False
+            )
+        dimensions_cache.save(dimensions_fingerprint)
+
+    if table.num_rows == 0:
+        logger.info(f"No rows were processed after the watermark {watermark}.")
+        return
+
+    logger.info(
+        f"Joining {table.num_rows} rows processed after the watermark {watermark}."
+    )
+    new_watermark = pc.max(table.column("ingestion_date")).as_py()
+
+    for dimension in dimensions.values():
+        table = join_dimension(
+            table=table,
+            foreign_key=dimension["foreign_key"],
+            dimension=dimension["table"],
+            key=dimension["key"],
+            columns=dimension["columns"],
+        )
+
+    # Save the data
+    batch_id = f"{pd.Timestamp.now():%Y%m%d%H%M%S}-{uuid.uuid4().hex[:8]}"
+
+    try:
+        logger.info(
+            f"Saving the new rows to the Parquet dataset {enriched_weather_data_path}."
+        )
+        save_processing_state(
+            state_path=state_path,
+            state={
+                "watermark": watermark,
+                "pending": {
+                    "batch_id": batch_id,
+                    "watermark": pd.Timestamp(new_watermark).isoformat(),
+                },
+                "source_generation": source_generation,
+            },
+        )
+        stage_dataset_fragments(
+            table=table,
+            dataset_path=enriched_weather_data_path,
+            batch_id=batch_id,
+            partitioning=PROCESSED_WEATHER_DATA_PARTITIONING,
+            layout=layout,
+            logger=logger,
+        )
+        publish_staged_fragments(
+            dataset_path=enriched_weather_data_path, batch_id=batch_id
+        )
+        save_processing_state(
+            state_path=state_path,
+            state={
+                "watermark": pd.Timestamp(new_watermark).isoformat(),
+                "pending": None,
+                "source_generation": source_generation,
+            },
+        )
+        shutil.rmtree(enriched_weather_data_path / "_staging")
+        current_stage_metrics().add(
+            rows_out=table.num_rows,
+            bytes_written=get_path_size(
+                enriched_weather_data_path, pattern=f"part-{batch_id}-*.parquet"
+            ),
+        )
+        stage_cache.save(fingerprint)
+    except Exception as e:
+        logger.error(f"Error saving the table: {e}")
+
+    logger.info(f"Processing of the enriched weather data finalized.")
+
+
+if __name__ == "__main__":
+    process_weather_enriched()
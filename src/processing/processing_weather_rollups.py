@@ -0,0 +1,393 @@
+import os
+import sys
+import inspect
+import shutil
+import uuid
+import logging
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+from pathlib import Path
+
+# Add parent directory to sys.path to get the functions in utils
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from utils.auxiliary_functions import (
+    PROCESSED_WEATHER_DATA_PARTITIONING,
+    open_parquet_dataset,
+    publish_staged_fragments,
+    write_parquet_file,
+)
+from utils.stage_cache import StageCache
+from utils.stage_metrics import current_stage_metrics, get_path_size
+from utils.pipeline_context import PipelineContext
+from processing.processing_weather_data import (
+    get_processing_state_path,
+    read_processing_state,
+    recover_pending_run,
+    save_processing_state,
+)
+
+logger = logging.getLogger("processing_weather_rollups")
+logger.setLevel(logging.INFO)
+
+handler = logging.StreamHandler()
+formatter = logging.Formatter("%(asctime)s %(name)s, %(levelname)s: %(message)s")
+handler.setFormatter(formatter)
+
+logger.addHandler(handler)
+
+# The grains of the rollups, with the unit the timestamps are floored to
+ROLLUP_GRAINS = {"hourly": "hour", "daily": "day"}
+
+# The partial states kept for each measure, with the aggregation merging them
+ROLLUP_STATES = {
+    "count": "sum",
+    "sum": "sum",
+    "min": "min",
+    "max": "max",
+    "sumsq": "sum",
+}
+
+
+def aggregate_partial_states(table: pa.Table, unit: str, measures: list) -> pa.Table:
+    """
+    Aggregates the weather observations of 'table' into partial states per city and bucket:
+    for each measure, the number of non-null values and their sum, minimum, maximum and sum
+    of squares. The states of two sets of observations can be merged without the
+    observations, see merge_partial_states.
+
+    Args:
+        table (pa.Table): the observations, with the 'city_id', 'time_value' and measure
+        columns.
+        unit (str): the unit the timestamps are floored to, e.g. "hour".
+        measures (list): the measure columns, e.g. ['temperature', 'humidity'].
+
+    Returns:
+        pa.Table: a table with the 'city_id', 'bucket_start' and '<measure>_<state>'
+        columns, with one row per city and bucket.
+    """
+
+    columns = {
+        "city_id": table.column("city_id"),
+        "bucket_start": pc.floor_temporal(table.column("time_value"), unit=unit),
+    }
+    aggregations = []
+
+    for measure in measures:
+        values = pc.cast(table.column(measure), pa.float64())
+        columns[measure] = values
+        columns[f"{measure}_squared"] = pc.multiply(values, values)
+        aggregations += [
+            (measure, "count"),
+            (measure, "sum"),
+            (measure, "min"),
+            (measure, "max"),
+            (f"{measure}_squared", "sum"),
+        ]
+
+    partial_states = (
+        pa.table(columns).group_by(["city_id", "bucket_start"]).aggregate(aggregations)
+    )
+
+    return partial_states.rename_columns(
+        [
+            column.replace("_squared_sum", "_sumsq")
+            for column in partial_states.column_names
+        ]
+    )
+
+
+def merge_partial_states(table: pa.Table, measures: list) -> pa.Table:
+    """
+    Merges the partial states of 'table' with the same city and bucket, e.g. the states
+    stored for a day and those of the new observations of that day.
+
+    Args:
+        table (pa.Table): the partial states, see aggregate_partial_states.
+        measures (list): the measure columns.
+
+    Returns:
+        pa.Table: the merged partial states, with one row per city and bucket.
+    """
+
+    merged = table.group_by(["city_id", "bucket_start"]).aggregate(
+        [
+            (f"{measure}_{state}", aggregation)
+            for measure in measures
+            for state, aggregation in ROLLUP_STATES.items()
+        ]
+    )
+
+    # The aggregation appends its name to the columns, e.g. 'temperature_min_min'
+    return merged.rename_columns(
+        [
+            (
+                column
+                if column in ("city_id", "bucket_start")
+                else column.rsplit("_", 1)[0]
+            )
+            for column in merged.column_names
+        ]
+    )
+
+
+def get_rollup_statistics(table: pa.Table, measures: list) -> pa.Table:
+    """
+    Appends the mean and the (population) standard deviation of each measure to the
+    partial states of the rollups, e.g. for a dashboard.
+
+    Args:
+        table (pa.Table): the partial states, read from the rollups.
+        measures (list): the measure columns.
+
+    Returns:
+        pa.Table: the table with the '<measure>_mean' and '<measure>_std' columns appended.
+    """
+
+    for measure in measures:
+        count = pc.cast(table.column(f"{measure}_count"), pa.float64())
+        mean = pc.divide(table.column(f"{measure}_sum"), count)
+        variance = pc.subtract(
+            pc.divide(table.column(f"{measure}_sumsq"), count), pc.multiply(mean, mean)
+        )
+
+        table = table.append_column(f"{measure}_mean", mean)
+        table = table.append_column(
+            f"{measure}_std", pc.sqrt(pc.max_element_wise(variance, 0.0))
+        )
+
+    return table
+
+
+def process_weather_rollups(context: PipelineContext = None):
+    """
+    Maintains the rollups of the processed weather data: the statistics of each measure
+    (e.g. temperature, humidity, wind speed and rain) per city and hour, and per city and
+    day. The rollups are a Hive-partitioned Parquet dataset, stored as
+    grain=<hourly|daily>/date=<yyyy-mm-dd>/rollup.parquet, with one file per grain and day.
+
+    Instead of the statistics themselves, the rollups store mergeable partial states (count,
+    sum, minimum, maximum and sum of squares), from which the mean and standard deviation
+    are derived (see get_rollup_statistics). As in process_weather_data, a watermark (the
+    highest 'ingestion_date' of the processed rows already aggregated) is stored in a JSON
+    state file next to the rollups. Each run only aggregates the rows processed after it,
+    and merges their states into the files of the days they touch, so its cost depends on
+    the new rows, not on the history.
+
+    Steps:
+        1. Get the environment variables and the config.json from the context of the run,
+           built by the stage itself if it is run on its own.
+        2. Retrieve relevant fields for the task from the config.
+        3. Read the state file and recover the run that crashed before publishing its
+           files, if any. If there is no watermark, the mode is "full", the fingerprint of
+           the config and code of the stage changed or the processed data was rebuilt (its
+           generation changed), remove the rollups and start over.
+        4. Read the processed rows after the watermark, with a filter pushed down to the
+           Parquet reader. If there are none, skip processing.
+        5. For each grain, aggregate the new rows into partial states per city and bucket.
+        6. For each grain and day touched by the new rows, merge their states with the
+           stored ones and stage the merged file.
+        7. Publish the staged files, replacing the previous files of the touched days, and
+           move the watermark forward.
+    """
+
+    logger.info("Starting processing of the weather data rollups")
+
+    # Build the context of the run, if the stage is run on its own
+    if context is None:
+        context = PipelineContext.build(
+            path=Path(__file__).parent.parent.parent, logger=logger
+        )
+        if context is None:
+            return
+
+    env_variables = context.env_variables
+    config = context.config
+
+    # Get the PROCESSED_FILES_PATH
+    processed_files_path = env_variables.get("PROCESSED_FILES_PATH")
+
+    processed_weather_data = (
+        config.get("processing_layer", {})
+        .get("weather_data", {})
+        .get("table_name", "weather_data_processed")
+    )
+    processed_weather_data_path = processed_files_path / processed_weather_data
+
+    rollups_config = config.get("processing_layer", {}).get("weather_data_rollups", {})
+    rollups_table_name = rollups_config.get("table_name", "weather_data_rollups")
+    rollups_path = processed_files_path / rollups_table_name
+
+    state_file_name = rollups_config.get("state_file", f"{rollups_table_name}_state")
+    state_path = processed_files_path / f"{state_file_name}.json"
+
+    processing_mode = rollups_config.get("mode", "incremental")
+
+    measures = rollups_config.get(
+        "measures", ["temperature", "humidity", "wind_speed", "rain"]
+    )
+    grains = {
+        grain: ROLLUP_GRAINS[grain]
+        for grain in rollups_config.get("grains", list(ROLLUP_GRAINS))
+        if grain in ROLLUP_GRAINS
+    }
+
+    # Layout of the files: the rows are sorted by city ID and bucket unless configured
+    # otherwise
+    layout = {
+        "sort_by": ["city_id", "bucket_start"],
+        **rollups_config.get("layout", {}),
+    }
+
+    if not os.path.exists(processed_weather_data_path):
+        logger.error(
+            f"The Parquet dataset {processed_weather_data_path} was not found."
+        )
+        return
+
+    # Read the state, and recover the previous run if it crashed
+    state = recover_pending_run(
+        state=read_processing_state(state_path=state_path),
+        state_path=state_path,
+        dataset_path=rollups_path,
+    )
+    watermark = state.get("watermark")
+
+    # The generation of the processed data the rollups were built from. If the processed
+    # data was rebuilt since, all its rows have a new 'ingestion_date', past the watermark
+    source_generation = read_processing_state(
+        state_path=get_processing_state_path(
+            config=config, processed_files_path=processed_files_path
+        )
+    ).get("generation")
+
+    # The rollups are stale if the config or the code of the stage changed
+    stage_cache = StageCache(output_path=rollups_path, logger=logger)
+    fingerprint = stage_cache.fingerprint(
+        inputs=[],
+        config=rollups_config,
+        code_files=[__file__, inspect.getfile(open_parquet_dataset)],
+    )
+
+    # Without a watermark, in full mode, if the fingerprint changed or if the processed
+    # data was rebuilt, rebuild the rollups
+    if (
+        watermark is None
+        or processing_mode == "full"
+        or not stage_cache.is_up_to_date(fingerprint)
+        or state.get("source_generation") != source_generation
+    ):
+        logger.info("Rebuilding the weather data rollups from scratch.")
+        watermark = None
+
+        if os.path.exists(rollups_path):
+            shutil.rmtree(rollups_path)
+
+    # Read the processed rows after the watermark. Each run writes its own fragments,
+    # whose 'ingestion_date' statistics let the reader skip the row groups of older runs
+    dataset = open_parquet_dataset(
+        path=processed_weather_data_path,
+        partitioning=PROCESSED_WEATHER_DATA_PARTITIONING,
+        logger=logger,
+    )
+    row_filter = (
+        ds.field("ingestion_date") > pd.Timestamp(watermark)
+        if watermark is not None
+        else None
+    )
+    table = dataset.to_table(
+        columns=["city_id", "time_value", "ingestion_date", *measures],
+        filter=row_filter,
+    )
+
+    current_stage_metrics().add(rows_in=table.num_rows)
+
+    if table.num_rows == 0:
+        logger.info(
+            f"No rows were processed after the watermark {watermark}. Skipping processing."
+        )
+        return
+
+    logger.info(
+        f"Aggregating {table.num_rows} rows processed after the watermark {watermark}."
+    )
+    new_watermark = pc.max(table.column("ingestion_date")).as_py()
+
+    batch_id = f"{pd.Timestamp.now():%Y%m%d%H%M%S}-{uuid.uuid4().hex[:8]}"
+    staging_path = rollups_path / "_staging" / batch_id
+    rows_written = 0
+
+    try:
+        logger.info(f"Saving the touched days to the rollups {rollups_path}.")
+        save_processing_state(
+            state_path=state_path,
+            state={
+                "watermark": watermark,
+                "pending": {
+                    "batch_id": batch_id,
+                    "watermark": pd.Timestamp(new_watermark).isoformat(),
+                },
+                "source_generation": source_generation,
+            },
+        )
+
+        for grain, unit in grains.items():
+            partial_states = aggregate_partial_states(
+                table=table, unit=unit, measures=measures
+            )
+            dates = pc.strftime(
+                partial_states.column("bucket_start"), format="%Y-%m-%d"
+            )
+
+            # Merge the new states into the stored ones, day by day
+            for date in pc.unique(dates).to_pylist():
+                partition = f"grain={grain}/date={date}"
+                states = partial_states.filter(pc.equal(dates, date))
+
+                # The file is read on its own, so the partition columns are not added
+                if os.path.exists(rollups_path / partition / "rollup.parquet"):
+                    stored_states = pq.ParquetFile(
+                        rollups_path / partition / "rollup.parquet"
+                    ).read()
+                    states = pa.concat_tables(
+                        [stored_states.select(states.column_names), states]
+                    )
+
+                states = merge_partial_states(table=states, measures=measures)
+
+                os.makedirs(staging_path / partition, exist_ok=True)
+                write_parquet_file(
+                    table=states,
+                    path=staging_path / partition / "rollup.parquet",
+                    layout=layout,
+                    logger=logger,
+                )
+                rows_written += states.num_rows
+
+        (staging_path / "_SUCCESS").touch()
+        bytes_written = get_path_size(staging_path, pattern="rollup.parquet")
+
+        publish_staged_fragments(dataset_path=rollups_path, batch_id=batch_id)
+        save_processing_state(
+            state_path=state_path,
+            state={
+                "watermark": pd.Timestamp(new_watermark).isoformat(),
+                "pending": None,
+                "source_generation": source_generation,
+            },
+        )
+        shutil.rmtree(rollups_path / "_staging")
+        current_stage_metrics().add(rows_out=rows_written, bytes_written=bytes_written)
+        stage_cache.save(fingerprint)
+    except Exception as e:
+        logger.error(f"Error saving the rollups: {e}")
+
+    logger.info(f"Processing of the weather data rollups finalized.")
+
+
+if __name__ == "__main__":
+    process_weather_rollups()
@@ -0,0 +1,190 @@
+import os
+import sys
+import argparse
+import logging
+import pandas as pd
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+from pathlib import Path
+
+# Add parent directory to sys.path to get the functions in utils
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from utils.auxiliary_functions import (
+    PROCESSED_WEATHER_DATA_PARTITIONING,
+    open_parquet_dataset,
+)
+from utils.pipeline_context import PipelineContext
+
+logger = logging.getLogger("query_weather_data")
+logger.setLevel(logging.INFO)
+
+handler = logging.StreamHandler()
+formatter = logging.Formatter("%(asctime)s %(name)s, %(levelname)s: %(message)s")
+handler.setFormatter(formatter)
+
+logger.addHandler(handler)
+
+# Tables that can be queried, with the entry of processing_layer in the config file holding
+# their name, and their default name
+QUERY_TABLES = {
+    "processed": ("weather_data", "weather_data_processed"),
+    "enriched": ("weather_data_enriched", "weather_data_enriched"),
+}
+
+
+def build_query_filter(
+    city_ids: list = None, start: pd.Timestamp = None, end: pd.Timestamp = None
+) -> ds.Expression:
+    """
+    Builds the filter of a query over the weather data. Besides the filter on the
+    'time_value' column, the time range is applied to the 'date' partition column, so the
+    partitions outside of it are pruned without being opened.
+
+    Args:
+        city_ids (list): the city IDs. None for all the cities.
+        start (pd.Timestamp): the start of the time range, inclusive. None for no start.
+        end (pd.Timestamp): the end of the time range, exclusive. None for no end.
+
+    Returns:
+        ds.Expression or None: the filter, or None if there is no condition.
+    """
+
+    conditions = []
+
+    if city_ids is not None:
+        conditions.append(ds.field("city_id").isin(list(city_ids)))
+    if start is not None:
+        conditions.append(ds.field("date") >= f"{start:%Y-%m-%d}")
+        conditions.append(ds.field("time_value") >= start)
+    if end is not None:
+        conditions.append(ds.field("date") <= f"{end:%Y-%m-%d}")
+        conditions.append(ds.field("time_value") < end)
+
+    row_filter = None
+    for condition in conditions:
+        row_filter = condition if row_filter is None else row_filter & condition
+
+    return row_filter
+
+
+def query_weather(
+    city_ids: list = None,
+    start=None,
+    end=None,
+    columns: list = None,
+    table: str = "processed",
+    as_pandas: bool = False,
+    context: PipelineContext = None,
+):
+    """
+    Queries the processed (or enriched) weather data, reading only what the query needs:
+        - The partitions (one per date) outside of the time range are pruned.
+        - Within the fragments read, the row groups whose statistics ('city_id' and
+          'time_value' min/max) do not match the filter are skipped.
+        - Only the columns requested are read.
+    The cost of a query therefore depends on the data it matches, not on the size of the
+    history.
+
+    Args:
+        city_ids (list): the city IDs. None for all the cities.
+        start (str, datetime or pd.Timestamp): the start of the time range of the
+        measurements ('time_value'), inclusive. None for no start.
+        end (str, datetime or pd.Timestamp): the end of the time range, exclusive. None for
+        no end.
+        columns (list): the columns to read. None for all the columns.
+        table (str): the table to query, "processed" or "enriched", see QUERY_TABLES.
+        as_pandas (bool): whether to return a pandas DataFrame instead of an Arrow table.
+        context (PipelineContext): the context giving the data directories and the config.
+        Built from the .env file of the repo if not provided.
+
+    Returns:
+        pa.Table or pd.DataFrame: the rows matching the query, ordered by city ID and time.
+
+    Raises:
+        ValueError: if the table is unknown or the config file cannot be loaded.
+        FileNotFoundError: if the table does not exist.
+    """
+
+    if table not in QUERY_TABLES:
+        raise ValueError(f"Unknown table {table}, must be in {list(QUERY_TABLES)}.")
+
+    if context is None:
+        context = PipelineContext.build(
+            path=Path(__file__).parent.parent.parent, logger=logger
+        )
+        if context is None:
+            raise ValueError("The JSON configuration file could not be loaded.")
+
+    config_entry, default_table_name = QUERY_TABLES[table]
+    table_name = (
+        context.config.get("processing_layer", {})
+        .get(config_entry, {})
+        .get("table_name", default_table_name)
+    )
+    dataset_path = context.env_variables.get("PROCESSED_FILES_PATH") / table_name
+
+    if not os.path.exists(dataset_path):
+        raise FileNotFoundError(f"The Parquet dataset {dataset_path} was not found.")
+
+    dataset = open_parquet_dataset(
+        path=dataset_path,
+        partitioning=PROCESSED_WEATHER_DATA_PARTITIONING,
+        logger=logger,
+    )
+
+    start = pd.Timestamp(start) if start is not None else None
+    end = pd.Timestamp(end) if end is not None else None
+
+    result = dataset.to_table(
+        columns=columns,
+        filter=build_query_filter(city_ids=city_ids, start=start, end=end),
+    )
+
+    sort_keys = [
+        (column, "ascending")
+        for column in ["city_id", "time_value"]
+        if column in result.column_names
+    ]
+    if sort_keys:
+        result = result.sort_by(sort_keys)
+
+    return result.to_pandas() if as_pandas else result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Queries the processed weather data, e.g. the last day of a city."
+    )
+    parser.add_argument("--city-ids", type=int, nargs="+", default=None)
+    parser.add_argument(
+        "--start", default=None, help="e.g. 2025-07-30 or 2025-07-30T12:00"
+    )
+    parser.add_argument("--end", default=None, help="exclusive, same format as --start")
+    parser.add_argument("--columns", nargs="+", default=None)
+    parser.add_argument("--table", choices=list(QUERY_TABLES), default="processed")
+    parser.add_argument(
+        "--output",
+        type=Path,
+        default=None,
+        help="CSV or Parquet file to write the result to. Printed if not provided.",
+    )
+    args = parser.parse_args()
+
+    result = query_weather(
+        city_ids=args.city_ids,
+        start=args.start,
+        end=args.end,
+        columns=args.columns,
+        table=args.table,
+    )
+
+    if args.output is None:
+        print(result.to_pandas().to_string(index=False))
+    elif args.output.suffix == ".parquet":
+        pq.write_table(result, args.output)
+    else:
+        result.to_pandas().to_csv(args.output, index=False)
+
+    logger.info(f"{result.num_rows} rows returned.")
@@ -1,10 +1,51 @@
 import os
+import json
 import pandas as pd
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
 
 from pathlib import Path
 from dotenv import load_dotenv
 from logging import Logger
 
+# Partition columns of the loaded weather data table, in order
+WEATHER_DATA_PARTITIONING = ["city", "date"]
+
+# Partition columns of the processed weather data table
+PROCESSED_WEATHER_DATA_PARTITIONING = ["date"]
+
+# Layout of the processed Parquet outputs, overridden by the 'layout' entry of each table in
+# the config file, see get_parquet_write_options
+DEFAULT_PARQUET_LAYOUT = {
+    "sort_by": [],
+    "row_group_size": 131072,
+    "dictionary_columns": True,
+    "compression": "zstd",
+    "write_page_index": True,
+    "bloom_filter_columns": [],
+}
+
+# Arrow types used to parse the raw JSON documents, for each type of the config schema.
+# Timestamps are sent by the API as seconds since the epoch, so they are parsed as integers
+ARROW_JSON_TYPES = {
+    "int64": pa.int64(),
+    "float64": pa.float64(),
+    "string": pa.string(),
+    "timestamp": pa.int64(),
+}
+
+# Arrow types of the columns of the loaded weather data table, for each type of the config
+# schema. Timestamps are stored with a resolution of seconds, as sent by the API
+ARROW_TABLE_TYPES = {
+    "int64": pa.int64(),
+    "float64": pa.float64(),
+    "string": pa.string(),
+    "timestamp": pa.timestamp("s"),
+}
+
 
 def load_env_variables(path: Path, logger: Logger) -> dict:
     """
@@ -48,6 +89,12 @@ def load_env_variables(path: Path, logger: Logger) -> dict:
         "LOADED_FILES_PATH": path / os.getenv("LOADED_FILES_PATH", "data/loaded"),
         "PROCESSED_FILES_PATH": path
         / os.getenv("PROCESSED_FILES_PATH", "data/processed"),
+        "METRICS_PATH": path / os.getenv("METRICS_PATH", "data/metrics"),
+        "PIPELINE_PROFILE": [
+            profiler.strip()
+            for profiler in os.getenv("PIPELINE_PROFILE", "").split(",")
+            if profiler.strip()
+        ],
     }
 
 
@@ -194,6 +241,282 @@ def flatten_schema(schema_dict: dict, logger: Logger, parent_field: str = None)
     return flattened_schema
 
 
+def compile_schema(schema_dict: dict, parent_path: tuple = ()) -> list:
+    """
+    Compiles the dictionary 'schema_dict' into a flat list of key-path extractors, one per
+    column of the flattened schema (see flatten_schema). It is meant to be called once per
+    run, so that documents can then be extracted with extract_row without recursion.
+
+    Consider the following example for the input schema_dict:
+        schema_dict = {
+            'key1': {
+                'type': 'dict',
+                'subfields': {
+                    'key2': {
+                        'type': 'float64'
+                        }
+                    }
+                },
+            'key3': {
+                'type': 'list',
+                'items': {
+                    'type': 'dict',
+                    'subfields': {
+                        'key4': {
+                            'type': 'string'
+                            }
+                        }
+                    }
+                }
+            ...
+        }
+
+    The returned list will be:
+        [
+            ('key1_key2', ('key1', 'key2')),
+            ('key3_key4', ('key3', 0, 'key4')),
+            ...
+        ]
+
+    Lists are read from their first element, as in flatten_json.
+
+    Args:
+        schema_dict (dict): the input schema dictionary.
+        parent_path (tuple): for a nested structure, the path of keys to the parent field.
+
+    Returns:
+        list: a list of (column name, key path) tuples.
+    """
+
+    extractors = []
+
+    for key, value in schema_dict.items():
+        column_type = value.get("type")
+        path = parent_path + (key,)
+
+        if column_type == "dict" and "subfields" in value:
+            extractors.extend(compile_schema(value["subfields"], parent_path=path))
+        elif (
+            column_type == "list" and "items" in value and "subfields" in value["items"]
+        ):
+            extractors.extend(
+                compile_schema(value["items"]["subfields"], parent_path=path + (0,))
+            )
+        else:
+            name = "_".join(str(part) for part in path if not isinstance(part, int))
+            extractors.append((name, path))
+
+    return extractors
+
+
+def extract_row(document: dict, extractors: list) -> list:
+    """
+    Extracts the values of the columns compiled by compile_schema from 'document', in a
+    single pass. Fields missing from the document are returned as None.
+
+    Args:
+        document (dict): the JSON document.
+        extractors (list): the (column name, key path) tuples returned by compile_schema.
+
+    Returns:
+        list: the value of each column, in the order of 'extractors'.
+    """
+
+    row = []
+
+    for _, path in extractors:
+        value = document
+
+        for key in path:
+            try:
+                value = value[key]
+            except (KeyError, IndexError, TypeError):
+                value = None
+                break
+
+        row.append(value)
+
+    return row
+
+
+def build_arrow_schema(schema_dict: dict) -> pa.Schema:
+    """
+    Builds the explicit Arrow schema used to parse the raw JSON documents from the
+    dictionary 'schema_dict' (see flatten_schema), keeping its nested structure:
+    dictionaries become structs and lists become lists of structs. The types are mapped
+    with ARROW_JSON_TYPES, and fields without a known type are parsed as strings.
+
+    Args:
+        schema_dict (dict): the input schema dictionary.
+
+    Returns:
+        pa.Schema: the Arrow schema.
+    """
+
+    fields = []
+
+    for key, value in schema_dict.items():
+        column_type = value.get("type")
+
+        if column_type == "dict" and "subfields" in value:
+            arrow_type = pa.struct(build_arrow_schema(value["subfields"]))
+        elif (
+            column_type == "list" and "items" in value and "subfields" in value["items"]
+        ):
+            arrow_type = pa.list_(
+                pa.struct(build_arrow_schema(value["items"]["subfields"]))
+            )
+        else:
+            arrow_type = ARROW_JSON_TYPES.get(column_type, pa.string())
+
+        fields.append(pa.field(key, arrow_type))
+
+    return pa.schema(fields)
+
+
+def flatten_arrow_table(table: pa.Table, extractors: list) -> pa.Table:
+    """
+    Flattens the nested Arrow table 'table', parsed with the schema of build_arrow_schema,
+    into one column per extractor compiled by compile_schema. Struct fields are selected by
+    name and lists are read from their first element; empty lists give nulls.
+
+    Args:
+        table (pa.Table): the nested table.
+        extractors (list): the (column name, key path) tuples returned by compile_schema.
+
+    Returns:
+        pa.Table: the flat table, with the columns in the order of 'extractors'.
+    """
+
+    columns = {}
+
+    for name, path in extractors:
+        column = table.column(path[0]).combine_chunks()
+
+        for key in path[1:]:
+            if isinstance(key, int):
+                # Lists shorter than the index are set to null, as list_element fails on them
+                long_enough = pc.greater(pc.list_value_length(column), key)
+                column = pc.if_else(
+                    long_enough, column, pa.nulls(len(column), column.type)
+                )
+                column = pc.list_element(column, key)
+            else:
+                column = pc.struct_field(column, [key])
+
+        columns[name] = column
+
+    return pa.table(columns)
+
+
+def build_table_schema(schema_dict: dict, logger: Logger) -> pa.Schema:
+    """
+    Builds the flat Arrow schema of the loaded weather data table from the dictionary
+    'schema_dict', with one column per field of the flattened schema (see flatten_schema).
+    The types are mapped with ARROW_TABLE_TYPES, and fields without a known type are kept
+    as strings.
+
+    Args:
+        schema_dict (dict): the input schema dictionary.
+        logger (Logger): logger.
+
+    Returns:
+        pa.Schema: the flat Arrow schema.
+    """
+
+    return pa.schema(
+        [
+            (name, ARROW_TABLE_TYPES.get(column_type, pa.string()))
+            for name, column_type in flatten_schema(
+                schema_dict=schema_dict, logger=logger
+            ).items()
+        ]
+    )
+
+
+def cast_arrow_column(
+    column: pa.ChunkedArray, arrow_type: pa.DataType, logger: Logger
+) -> pa.ChunkedArray:
+    """
+    Casts the Arrow column 'column' to the type 'arrow_type'. Unlike a plain cast:
+        - Integers and strings are cast to timestamps as seconds since the epoch.
+        - Strings with decimal values (e.g. "9999.5") are cast to integers by truncation,
+          with a warning, instead of failing.
+
+    Args:
+        column (pa.ChunkedArray): the input column.
+        arrow_type (pa.DataType): the target type.
+        logger (Logger): logger.
+
+    Returns:
+        pa.ChunkedArray: the column cast to 'arrow_type'.
+    """
+
+    if column.type == arrow_type:
+        return column
+
+    if pa.types.is_timestamp(arrow_type) and not pa.types.is_timestamp(column.type):
+        column = cast_arrow_column(column=column, arrow_type=pa.int64(), logger=logger)
+        return pc.cast(column, arrow_type)
+
+    try:
+        return pc.cast(column, arrow_type)
+    except pa.ArrowInvalid as e:
+        if not (pa.types.is_string(column.type) and pa.types.is_integer(arrow_type)):
+            raise
+
+        logger.warning(
+            f"Error casting a column to {arrow_type}: {e}. Decimal values are truncated."
+        )
+        return pc.cast(pc.cast(column, pa.float64()), arrow_type, safe=False)
+
+
+def cast_arrow_table(table: pa.Table, schema: pa.Schema, logger: Logger) -> pa.Table:
+    """
+    Casts the columns of the Arrow table 'table' to the types of 'schema', using
+    cast_arrow_column. Columns that are not in 'schema' are kept as they are.
+
+    Args:
+        table (pa.Table): the input table.
+        schema (pa.Schema): the target schema.
+        logger (Logger): logger.
+
+    Returns:
+        pa.Table: the table with the columns in the desired types.
+    """
+
+    for i, name in enumerate(table.column_names):
+        if name in schema.names:
+            table = table.set_column(
+                i,
+                name,
+                cast_arrow_column(
+                    column=table.column(i),
+                    arrow_type=schema.field(name).type,
+                    logger=logger,
+                ),
+            )
+
+    return table
+
+
+def repeat_values(values: list, counts: list, type: pa.DataType) -> pa.Array:
+    """
+    Builds an Arrow array where each value in 'values' is repeated the number of times in
+    'counts', e.g. to tag the rows read from several files with the name of their file.
+
+    Args:
+        values (list): the values.
+        counts (list): the number of repetitions of each value.
+        type (pa.DataType): the type of the array.
+
+    Returns:
+        pa.Array: the array, of length sum(counts).
+    """
+
+    return pa.array(np.repeat(np.array(values, dtype=object), counts), type=type)
+
+
 def cast_columns(df: pd.DataFrame, column_types: dict, logger: Logger):
     """
     Casts the DataFrame df columns to the types specified in column_types.
@@ -226,39 +549,366 @@ def cast_columns(df: pd.DataFrame, column_types: dict, logger: Logger):
     return df
 
 
-def expand_dictionary_column(
-    df: pd.DataFrame, column: str, logger: Logger
-) -> pd.DataFrame:
+def iter_json_array(stream, chunk_size: int = 1 << 20):
     """
-    Expands the column 'column' in the DataFrame 'df' provided that 'column' is a column
-    of dictionaries.
+    Parses the elements of the top-level JSON array in the text stream 'stream' one at a
+    time, reading 'chunk_size' characters at a time, so that the whole array is never held
+    in memory. Only the text of the element being parsed is buffered.
 
-    The DataFrame is returned unmodified if:
-        - The column does not exist in the DataFrame
-        - The column exists, but is not of type dictionary.
+    Args:
+        stream: a text stream (e.g. returned by open or gzip.open in text mode) holding a
+        JSON array.
+        chunk_size (int): the number of characters read at a time.
+
+    Yields:
+        The elements of the array, in order.
+
+    Raises:
+        ValueError: if the stream does not hold a JSON array.
+    """
+
+    decoder = json.JSONDecoder()
+    buffer = ""
+    position = 0
+    started = False
+
+    while True:
+        chunk = stream.read(chunk_size)
+        buffer = buffer[position:] + chunk
+        position = 0
+
+        while True:
+            # Skip the whitespace and separators between elements
+            while position < len(buffer) and buffer[position] in " \t\r\n,":
+                position += 1
+
+            if position == len(buffer):
+                break
+
+            if not started:
+                if buffer[position] != "[":
+                    raise ValueError("The stream does not hold a JSON array.")
+                started = True
+                position += 1
+                continue
+
+            if buffer[position] == "]":
+                return
+
+            try:
+                element, end = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                # The element is incomplete, read the next chunk
+                if not chunk:
+                    raise
+                break
+
+            # A scalar at the end of the buffer may continue in the next chunk
+            if end == len(buffer) and chunk:
+                break
+
+            position = end
+            yield element
+
+        if not chunk:
+            raise ValueError("The JSON array is not terminated.")
+
+
+def add_partition_columns(table: pa.Table, logger: Logger) -> pa.Table:
+    """
+    Adds the Hive partition columns used by the loaded weather data table to the
+    Arrow table 'table':
+        - city: the city ID, taken from the 'id' column.
+        - date: the date of the measurement (yyyy-mm-dd), taken from the 'dt' column, in
+          seconds since the epoch.
 
     Args:
-        df (pd.DataFrame): the input DataFrame.
-        column (str): the column to expand into multiple columns.
+        table (pa.Table): the input table, with the 'id' and 'dt' columns.
         logger (Logger): logger.
 
     Returns:
-        df: the DataFrame with the expanded column.
+        pa.Table: the table with the 'city' and 'date' columns.
     """
 
-    logger.info(f"Expanding column {column} in DataFrame")
+    logger.info("Adding the partition columns to the table")
 
-    if column in df.columns:
-        is_dict_column = df[column].apply(lambda x: isinstance(x, dict)).all()
+    dt = table.column("dt")
+    if pa.types.is_string(dt.type):
+        dt = pc.cast(dt, pa.int64())
+    if not pa.types.is_timestamp(dt.type):
+        dt = pc.cast(dt, pa.timestamp("s"))
 
-        if is_dict_column:
-            df_ = pd.json_normalize(df[column]).add_prefix(f"{column}_")
-            df = pd.concat([df, df_], axis=1).drop(column, axis=1)
+    table = table.append_column("city", pc.cast(table.column("id"), pa.string()))
+    table = table.append_column("date", pc.strftime(dt, format="%Y-%m-%d"))
 
-            logger.info(f"Column {column} succcessfuly expanded.")
-        else:
-            logger.error(f"The column {column} is not of type dict. Skipping.")
-    else:
-        logger.error("The column 'coord' could not be found in the data.")
+    return table
 
-    return df
+
+def list_dataset_files(path: Path, partitioning: list) -> list:
+    """
+    Lists the Parquet files of the Hive-partitioned dataset stored under 'path', ignoring
+    the files starting with '.' or '_' and the fragments replaced by a compaction.
+
+    A compaction (see compaction/compaction_datasets.py) writes a marker in the partition,
+    _compaction-<batch_id>.json, naming the compacted 'file' and the fragments it
+    'replaces', before renaming the compacted file into place. Once the compacted file
+    exists, the fragments it replaces are no longer part of the dataset, even if they were
+    not removed yet, so the rename is the single step that swaps them.
+
+    Args:
+        path (Path): the root directory of the dataset.
+        partitioning (list): the names of the partition columns, in order.
+
+    Returns:
+        list: the paths of the files, sorted.
+    """
+
+    partition_pattern = "/".join(f"{column}=*" for column in partitioning)
+    files = []
+
+    for partition_path in Path(path).glob(partition_pattern):
+        partition_files = [
+            file_path
+            for file_path in partition_path.glob("*.parquet")
+            if not file_path.name.startswith((".", "_"))
+        ]
+
+        # The markers are read after listing the files, so a compacted file in the list
+        # always has its marker read
+        replaced_files = set()
+        for marker_path in partition_path.glob("_compaction-*.json"):
+            try:
+                with open(marker_path, "r") as f:
+                    marker = json.load(f)
+            except FileNotFoundError:
+                # The compaction finished in the meantime
+                continue
+            if os.path.exists(partition_path / marker["file"]):
+                replaced_files.update(marker["replaces"])
+
+        files.extend(
+            file_path
+            for file_path in partition_files
+            if file_path.name not in replaced_files
+        )
+
+    return sorted(files)
+
+
+def open_parquet_dataset(path: Path, partitioning: list, logger: Logger) -> ds.Dataset:
+    """
+    Opens the Hive-partitioned Parquet dataset stored under 'path'. The partition columns
+    in 'partitioning' are read as strings, so that their values are kept as they were written
+    (e.g. city=2267057/date=2025-07-30).
+
+    Args:
+        path (Path): the root directory of the dataset.
+        partitioning (list): the names of the partition columns, in order.
+        logger (Logger): logger.
+
+    Returns:
+        ds.Dataset: the dataset. Files starting with '.' or '_', and the fragments replaced
+        by a compaction, are ignored (see list_dataset_files).
+    """
+
+    logger.info(f"Opening the Parquet dataset {path}")
+
+    return ds.dataset(
+        [str(file_path) for file_path in list_dataset_files(path, partitioning)],
+        format="parquet",
+        partitioning=ds.partitioning(
+            pa.schema([(column, pa.string()) for column in partitioning]),
+            flavor="hive",
+        ),
+        partition_base_dir=str(path),
+    )
+
+
+def get_parquet_layout(layout: dict) -> dict:
+    """
+    Gets the layout of a Parquet output, filling the settings missing from 'layout' with
+    those of DEFAULT_PARQUET_LAYOUT:
+        - sort_by: the columns the rows are sorted by, so that the statistics of each row
+          group cover a narrow range of them, e.g. ["city_id", "time_value"].
+        - row_group_size: the maximum number of rows per row group.
+        - dictionary_columns: the columns to dictionary-encode, or true for all of them.
+        - compression: the compression codec.
+        - write_page_index: whether to write the column and offset indexes of each page,
+          used to skip pages within a row group.
+        - bloom_filter_columns: the columns to write a bloom filter for, e.g. ["city_id"].
+
+    Args:
+        layout (dict): the 'layout' entry of the table in the config file.
+
+    Returns:
+        dict: the layout.
+    """
+
+    return {**DEFAULT_PARQUET_LAYOUT, **(layout or {})}
+
+
+def get_parquet_write_options(layout: dict, logger: Logger) -> dict:
+    """
+    Gets the options of the Parquet writer for the layout 'layout' (see get_parquet_layout),
+    as keyword arguments of pq.write_table and ParquetFileFormat.make_write_options.
+    Column statistics are always written. Bloom filters are only written if the installed
+    version of pyarrow supports them; otherwise, a warning is logged and they are skipped.
+
+    Args:
+        layout (dict): the layout.
+        logger (Logger): logger.
+
+    Returns:
+        dict: the options.
+    """
+
+    layout = get_parquet_layout(layout)
+
+    options = {
+        "compression": layout["compression"],
+        "use_dictionary": layout["dictionary_columns"],
+        "write_statistics": True,
+        "write_page_index": layout["write_page_index"],
+    }
+
+    if layout["bloom_filter_columns"]:
+        options["bloom_filter_options"] = {
+            column: {} for column in layout["bloom_filter_columns"]
+        }
+
+        try:
+            ds.ParquetFileFormat().make_write_options(**options)
+        except (TypeError, ValueError, pa.ArrowNotImplementedError) as e:
+            logger.warning(
+                f"Bloom filters are not supported by this version of pyarrow ({e}). "
+                "Writing the Parquet files without them."
+            )
+            del options["bloom_filter_options"]
+
+    return options
+
+
+def sort_table(table: pa.Table, sort_by: list) -> pa.Table:
+    """
+    Sorts the Arrow table 'table' by the columns in 'sort_by', in ascending order. The
+    columns that are not in the table are ignored.
+
+    Args:
+        table (pa.Table): the table.
+        sort_by (list): the columns to sort by, in order.
+
+    Returns:
+        pa.Table: the sorted table.
+    """
+
+    sort_keys = [
+        (column, "ascending") for column in sort_by if column in table.column_names
+    ]
+
+    return table.sort_by(sort_keys) if sort_keys else table
+
+
+def write_parquet_file(
+    table: pa.Table, path: Path, layout: dict, logger: Logger
+) -> None:
+    """
+    Writes the Arrow table 'table' to the Parquet file 'path' with the layout 'layout' (see
+    get_parquet_layout): the rows are sorted, and the file is written with the configured
+    row groups, encodings, statistics and indexes.
+
+    Args:
+        table (pa.Table): the data to write.
+        path (Path): the Parquet file.
+        layout (dict): the layout.
+        logger (Logger): logger.
+    """
+
+    layout = get_parquet_layout(layout)
+
+    pq.write_table(
+        sort_table(table=table, sort_by=layout["sort_by"]),
+        path,
+        row_group_size=layout["row_group_size"],
+        **get_parquet_write_options(layout=layout, logger=logger),
+    )
+
+
+def stage_dataset_fragments(
+    table: pa.Table,
+    dataset_path: Path,
+    batch_id: str,
+    partitioning: list,
+    layout: dict = None,
+    logger: Logger = None,
+) -> None:
+    """
+    Writes the Arrow table 'table' as new fragment files of the Hive-partitioned dataset
+    stored under 'dataset_path', in the staging directory _staging/<batch_id>, which is
+    ignored by the dataset readers. Once all of them are written, a _SUCCESS marker is
+    created, so that an interrupted write can be told apart from a complete one.
+
+    If a layout is given (see get_parquet_layout), the rows are sorted, their order is kept
+    within each partition, and the fragments are written with the configured row groups,
+    encodings, statistics and indexes.
+
+    Args:
+        table (pa.Table): the data to write, containing the partition columns.
+        dataset_path (Path): the root directory of the dataset.
+        batch_id (str): identifier of the batch, used to name the fragment files.
+        partitioning (list): the names of the partition columns, in order.
+        layout (dict): the layout of the fragments. None for the defaults of Arrow.
+        logger (Logger): logger, required if a layout is given.
+    """
+
+    staging_path = dataset_path / "_staging" / batch_id
+
+    layout_options = {}
+    if layout is not None:
+        layout = get_parquet_layout(layout)
+        table = sort_table(table=table, sort_by=layout["sort_by"])
+        layout_options = {
+            "file_options": ds.ParquetFileFormat().make_write_options(
+                **get_parquet_write_options(layout=layout, logger=logger)
+            ),
+            "min_rows_per_group": min(layout["row_group_size"], table.num_rows),
+            "max_rows_per_group": layout["row_group_size"],
+            "preserve_order": True,
+        }
+
+    # A batch can span more partitions than the default limit of Arrow (1024), e.g. a
+    # thousand cities over two dates
+    n_partitions = table.group_by(partitioning).aggregate([]).num_rows
+
+    ds.write_dataset(
+        table,
+        staging_path,
+        format="parquet",
+        partitioning=ds.partitioning(
+            pa.schema([(column, pa.string()) for column in partitioning]),
+            flavor="hive",
+        ),
+        basename_template=f"part-{batch_id}-{{i}}.parquet",
+        existing_data_behavior="overwrite_or_ignore",
+        max_partitions=max(n_partitions, 1024),
+        **layout_options,
+    )
+    (staging_path / "_SUCCESS").touch()
+
+
+def publish_staged_fragments(dataset_path: Path, batch_id: str) -> None:
+    """
+    Moves the fragments of the batch 'batch_id' from the staging directory into their
+    partitions of the dataset. Each move is an atomic rename, and fragments that were
+    already moved are skipped, so the function can be replayed after a crash.
+
+    Args:
+        dataset_path (Path): the root directory of the dataset.
+        batch_id (str): identifier of the batch.
+    """
+
+    staging_path = dataset_path / "_staging" / batch_id
+
+    for fragment_path in staging_path.rglob("*.parquet"):
+        destination_path = dataset_path / fragment_path.relative_to(staging_path)
+        os.makedirs(destination_path.parent, exist_ok=True)
+        os.replace(fragment_path, destination_path)
@@ -0,0 +1,574 @@
+import os
+import json
+import pickle
+import bisect
+import difflib
+import logging
+import unicodedata
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from pathlib import Path
+
+from utils.stage_cache import StageCache
+
+# The columns of the processed city codes each selector criterion is applied to
+CITY_SELECTOR_COLUMNS = {
+    "country": ["country"],
+    "state": ["state"],
+    "bbox": ["longitude", "latitude"],
+    "min_population": ["population"],
+    "max_population": ["population"],
+}
+
+
+def normalize_city_name(name: str) -> str:
+    """
+    Normalizes a city name for lookups: accents are removed, the name is case-folded and
+    consecutive spaces are collapsed. For example, " São  Paulo" becomes "sao paulo".
+
+    Args:
+        name (str): the city name.
+
+    Returns:
+        str: the normalized name.
+    """
+
+    decomposed = unicodedata.normalize("NFKD", name or "")
+    stripped = "".join(char for char in decomposed if not unicodedata.combining(char))
+
+    return " ".join(stripped.casefold().split())
+
+
+class CityIndex:
+    """
+    Lookup index from city names to OpenWeather city IDs, built once from the processed
+    city codes table and persisted with pickle, so that resolving a name does not require
+    scanning the table.
+
+    The index holds:
+        - entries: a dictionary mapping each normalized name to its cities, as
+          (id, name, state, country) tuples.
+        - names: a dictionary mapping each city ID to its name.
+        - keys: the sorted normalized names, used for prefix matching.
+    """
+
+    def __init__(self, entries: dict, names: dict, logger: logging.Logger = None):
+        self.logger = (
+            logger
+            if isinstance(logger, logging.Logger)
+            else logging.getLogger(__name__)
+        )
+
+        self.entries = entries
+        self.names = names
+        self.keys = sorted(entries)
+
+    @classmethod
+    def build(cls, parquet_path: Path, logger: logging.Logger = None) -> "CityIndex":
+        """
+        Builds the index from the processed city codes Parquet file.
+
+        Args:
+            parquet_path (Path): the processed city codes Parquet file.
+            logger (Logger): logger.
+
+        Returns:
+            CityIndex: the index.
+        """
+
+        table = pq.read_table(parquet_path, columns=["id", "name", "state", "country"])
+        columns = table.to_pydict()
+
+        entries = {}
+        names = {}
+
+        for city_id, name, state, country in zip(
+            columns["id"], columns["name"], columns["state"], columns["country"]
+        ):
+            entries.setdefault(normalize_city_name(name), []).append(
+                (city_id, name, state or "", country or "")
+            )
+            names[city_id] = name
+
+        index = cls(entries=entries, names=names, logger=logger)
+        index.logger.info(f"City index built with {len(names)} cities.")
+
+        return index
+
+    def save(self, path: Path) -> None:
+        """
+        Saves the index to 'path', using pickle. The file is replaced atomically.
+
+        Args:
+            path (Path): the file where to save the index.
+        """
+
+        self.logger.info(f"Saving the city index to {path}")
+
+        temporary_path = path.parent / f".{path.name}.tmp"
+
+        with open(temporary_path, "wb") as f:
+            pickle.dump((self.entries, self.names), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temporary_path, path)
+
+    @classmethod
+    def load(cls, path: Path, logger: logging.Logger = None) -> "CityIndex":
+        """
+        Loads an index saved with 'save'.
+
+        Args:
+            path (Path): the file where the index was saved.
+            logger (Logger): logger.
+
+        Returns:
+            CityIndex: the index.
+        """
+
+        with open(path, "rb") as f:
+            entries, names = pickle.load(f)
+
+        return cls(entries=entries, names=names, logger=logger)
+
+    @classmethod
+    def load_or_build(
+        cls, parquet_path: Path, index_path: Path, logger: logging.Logger = None
+    ) -> "CityIndex":
+        """
+        Loads the index from 'index_path'. If it does not exist, cannot be read, or the city
+        codes Parquet file was updated after it, the index is rebuilt and saved.
+
+        Args:
+            parquet_path (Path): the processed city codes Parquet file.
+            index_path (Path): the file where the index is saved.
+            logger (Logger): logger.
+
+        Returns:
+            CityIndex or None: the index. None if neither the index nor the Parquet file exist.
+        """
+
+        if os.path.exists(index_path) and (
+            not os.path.exists(parquet_path)
+            or os.path.getmtime(index_path) > os.path.getmtime(parquet_path)
+        ):
+            try:
+                return cls.load(path=index_path, logger=logger)
+            except Exception as e:
+                (logger or logging.getLogger(__name__)).error(
+                    f"Error loading the city index {index_path}: {e}. Rebuilding it."
+                )
+
+        if not os.path.exists(parquet_path):
+            return None
+
+        index = cls.build(parquet_path=parquet_path, logger=logger)
+        index.save(path=index_path)
+
+        return index
+
+    def lookup(self, name: str, state: str = None, country: str = None) -> list:
+        """
+        Gets the cities whose normalized name is exactly the normalized 'name', optionally
+        filtered by state and country code.
+
+        Args:
+            name (str): the city name.
+            state (str): the state of the city.
+            country (str): the ISO 3166 country code of the city.
+
+        Returns:
+            list: the matching (id, name, state, country) tuples.
+        """
+
+        candidates = self.entries.get(normalize_city_name(name), [])
+
+        if state:
+            candidates = [c for c in candidates if c[2].casefold() == state.casefold()]
+        if country:
+            candidates = [
+                c for c in candidates if c[3].casefold() == country.casefold()
+            ]
+
+        return candidates
+
+    def prefix(self, prefix: str, limit: int = 10) -> list:
+        """
+        Gets the normalized names that start with the normalized 'prefix'.
+
+        Args:
+            prefix (str): the prefix.
+            limit (int): maximum number of names returned.
+
+        Returns:
+            list: the matching normalized names, in alphabetical order.
+        """
+
+        prefix = normalize_city_name(prefix)
+        start = bisect.bisect_left(self.keys, prefix)
+        matches = []
+
+        for key in self.keys[start : start + limit]:
+            if not key.startswith(prefix):
+                break
+            matches.append(key)
+
+        return matches
+
+    def fuzzy(self, name: str, limit: int = 5, cutoff: float = 0.8) -> list:
+        """
+        Gets the normalized names most similar to the normalized 'name'. Only the names
+        starting with the same letter are compared, to keep the search cheap.
+
+        Args:
+            name (str): the city name.
+            limit (int): maximum number of names returned.
+            cutoff (float): minimum similarity, between 0 and 1.
+
+        Returns:
+            list: the matching normalized names, most similar first.
+        """
+
+        name = normalize_city_name(name)
+        if not name:
+            return []
+
+        start = bisect.bisect_left(self.keys, name[0])
+        end = bisect.bisect_left(self.keys, chr(ord(name[0]) + 1))
+
+        return difflib.get_close_matches(
+            name, self.keys[start:end], n=limit, cutoff=cutoff
+        )
+
+    def resolve(self, query: str) -> tuple:
+        """
+        Resolves a city query to a single city. The query follows the format of the API's
+        'q' parameter: "{city name}", "{city name},{country code}" or
+        "{city name},{state},{country code}".
+
+        The exact name is tried first, then the names starting with it and finally the most
+        similar names (all those with the highest similarity). The same rule applies to the
+        three: if several cities match (e.g. a name shared by cities in different
+        countries, with no country in the query, or a prefix of several names), the query
+        is ambiguous and it is not resolved, so the city is queried by name.
+
+        Args:
+            query (str): the city query.
+
+        Returns:
+            tuple or None: the (id, name, state, country) tuple of the city, or None if no
+            city matches or the query is ambiguous.
+        """
+
+        parts = [part.strip() for part in query.split(",")]
+        name = parts[0]
+        state = parts[1] if len(parts) == 3 else None
+        country = parts[-1] if len(parts) > 1 else None
+
+        candidates = self.lookup(name=name, state=state, country=country)
+
+        # Fall back to every name starting with the query, only if the exact name is not
+        # found
+        if not candidates:
+            for key in self.prefix(name, limit=len(self.keys)):
+                candidates = candidates + self.lookup(
+                    name=key, state=state, country=country
+                )
+
+        # And then to the most similar names, keeping all those with the highest score
+        if not candidates:
+            normalized_name = normalize_city_name(name)
+            scored_keys = [
+                (difflib.SequenceMatcher(None, key, normalized_name).ratio(), key)
+                for key in self.fuzzy(name)
+            ]
+            for score, key in scored_keys:
+                if score == max(scored_keys)[0]:
+                    candidates = candidates + self.lookup(
+                        name=key, state=state, country=country
+                    )
+
+        if not candidates:
+            return None
+
+        if len(candidates) > 1:
+            self.logger.warning(
+                f"{len(candidates)} cities match '{query}' (IDs "
+                f"{', '.join(str(c[0]) for c in sorted(candidates)[:5])}"
+                f"{', ...' if len(candidates) > 5 else ''}). Add the state and country "
+                "code to the query, or configure the city by ID."
+            )
+            return None
+
+        return candidates[0]
+
+    def name_of(self, city_id: int) -> str:
+        """
+        Gets the name of the city with ID 'city_id'.
+
+        Args:
+            city_id (int): the city ID.
+
+        Returns:
+            str or None: the name of the city, or None if the ID is unknown.
+        """
+
+        return self.names.get(city_id)
+
+
+def get_city_index(
+    processed_files_path: Path, config: dict, logger: logging.Logger
+) -> CityIndex:
+    """
+    Gets the city index of the processed city codes table, whose names are defined in the
+    'processing_layer' > 'city_codes' entry of the config file.
+
+    Args:
+        processed_files_path (Path): the directory of the processed files.
+        config (dict): the configuration file.
+        logger (Logger): logger.
+
+    Returns:
+        CityIndex or None: the index. None if the city codes were not processed yet.
+    """
+
+    city_codes_config = config.get("processing_layer", {}).get("city_codes", {})
+    table_name = city_codes_config.get("table_name", "city_codes_processed")
+    index_name = city_codes_config.get("index_file", "city_codes_index")
+
+    index = CityIndex.load_or_build(
+        parquet_path=processed_files_path / f"{table_name}.parquet",
+        index_path=processed_files_path / f"{index_name}.pkl",
+        logger=logger,
+    )
+
+    if index is None:
+        logger.warning(
+            "The city codes were not processed yet. Cities cannot be resolved to IDs."
+        )
+
+    return index
+
+
+def build_selector_mask(table: pa.Table, selector: dict, logger: logging.Logger):
+    """
+    Builds the mask of the cities of 'table' matching all the criteria of 'selector':
+        - country: a list of ISO 3166 country codes, e.g. ["PT", "ES"].
+        - state: a list of states.
+        - bbox: a bounding box, as [min_longitude, min_latitude, max_longitude,
+          max_latitude].
+        - min_population, max_population: bounds of the population, if the processed city
+          codes have a 'population' column.
+
+    Args:
+        table (pa.Table): the processed city codes.
+        selector (dict): the selector.
+        logger (Logger): logger.
+
+    Returns:
+        pa.ChunkedArray or None: the boolean mask. None if the selector is empty, has an
+        unknown or invalid criterion, or one applied to a column missing from the table.
+    """
+
+    if not selector:
+        logger.error("Empty city selectors are not allowed. Skipping.")
+        return None
+
+    mask = None
+
+    for criterion, value in selector.items():
+        columns = CITY_SELECTOR_COLUMNS.get(criterion)
+
+        if columns is None or not set(columns) <= set(table.column_names):
+            logger.error(
+                f"The city selector {selector} cannot be applied: the criterion "
+                f"'{criterion}' is unknown or its columns are missing. Skipping."
+            )
+            return None
+
+        if criterion == "bbox" and len(value) != 4:
+            logger.error(
+                f"The bounding box {value} must be [min_longitude, min_latitude, "
+                "max_longitude, max_latitude]. Skipping."
+            )
+            return None
+
+        if criterion in ("country", "state"):
+            condition = pc.is_in(
+                pc.utf8_upper(table.column(criterion)),
+                value_set=pa.array([str(item).upper() for item in value]),
+            )
+        elif criterion == "bbox":
+            min_longitude, min_latitude, max_longitude, max_latitude = value
+            condition = pc.and_(
+                pc.and_(
+                    pc.greater_equal(table.column("longitude"), min_longitude),
+                    pc.less_equal(table.column("longitude"), max_longitude),
+                ),
+                pc.and_(
+                    pc.greater_equal(table.column("latitude"), min_latitude),
+                    pc.less_equal(table.column("latitude"), max_latitude),
+                ),
+            )
+        elif criterion == "min_population":
+            condition = pc.greater_equal(table.column("population"), value)
+        else:
+            condition = pc.less_equal(table.column("population"), value)
+
+        # Cities with a null value in the column do not match
+        condition = pc.fill_null(condition, False)
+        mask = condition if mask is None else pc.and_(mask, condition)
+
+    return mask
+
+
+def select_cities(
+    processed_files_path: Path, config: dict, logger: logging.Logger
+) -> list:
+    """
+    Gets the cities matching the selectors of the 'city_selectors' entry of the config
+    file, e.g. [{"country": ["PT", "ES"]}, {"bbox": [-9.5, 38.6, -9.0, 38.9]}]. The
+    criteria of a selector must all match, and a city is selected if it matches any of the
+    selectors.
+
+    The selectors are applied to the processed city codes table with vectorized filters.
+    The selected cities are cached in a JSON file next to the table (the 'selection_file'
+    of the 'processing_layer' > 'city_codes' entry of the config file), which is only
+    recomputed when the content of the table or the selectors change.
+
+    Args:
+        processed_files_path (Path): the directory of the processed files.
+        config (dict): the configuration file.
+        logger (Logger): logger.
+
+    Returns:
+        list: a list of dictionaries with the keys 'id' and 'name', ordered by ID. Empty
+        if there are no selectors, or the city codes were not processed yet.
+    """
+
+    selectors = config.get("city_selectors", [])
+    if not selectors:
+        return []
+
+    city_codes_config = config.get("processing_layer", {}).get("city_codes", {})
+    table_name = city_codes_config.get("table_name", "city_codes_processed")
+    selection_name = city_codes_config.get("selection_file", "city_codes_selection")
+
+    parquet_path = processed_files_path / f"{table_name}.parquet"
+    selection_path = processed_files_path / f"{selection_name}.json"
+
+    if not os.path.exists(parquet_path):
+        logger.warning(
+            "The city codes were not processed yet. The city selectors cannot be resolved."
+        )
+        return []
+
+    # Reuse the selected cities if the table and the selectors did not change
+    selection_cache = StageCache(output_path=selection_path, logger=logger)
+    fingerprint = selection_cache.fingerprint(
+        inputs=[parquet_path], config=selectors, code_files=[__file__]
+    )
+
+    if selection_cache.is_up_to_date(fingerprint):
+        with open(selection_path, "r") as f:
+            return json.load(f)
+
+    # Only read the columns used by the selectors
+    schema_names = pq.read_schema(parquet_path).names
+    columns = ["id", "name"] + sorted(
+        {
+            column
+            for selector in selectors
+            for criterion in selector
+            for column in CITY_SELECTOR_COLUMNS.get(criterion, [])
+            if column in schema_names
+        }
+    )
+    table = pq.read_table(parquet_path, columns=columns)
+
+    mask = None
+    for selector in selectors:
+        selector_mask = build_selector_mask(
+            table=table, selector=selector, logger=logger
+        )
+        if selector_mask is not None:
+            mask = selector_mask if mask is None else pc.or_(mask, selector_mask)
+
+    selected = (
+        table.filter(mask).select(["id", "name"]).sort_by("id").to_pylist()
+        if mask is not None
+        else []
+    )
+    logger.info(f"{len(selected)} cities selected by the city selectors.")
+
+    temporary_path = f"{selection_path}.tmp"
+    with open(temporary_path, "w") as f:
+        json.dump(selected, f)
+    os.replace(temporary_path, selection_path)
+    selection_cache.save(fingerprint)
+
+    return selected
+
+
+def resolve_cities(
+    cities: list,
+    index: CityIndex,
+    logger: logging.Logger,
+    selected_cities: list = None,
+) -> list:
+    """
+    Resolves the cities configured in the 'cities' entry of the config file to their ID
+    and name, using the city index.
+
+    Cities given as a dictionary with an ID are kept as they are. Cities given by name are
+    looked up in the index; if there is no index, or the name cannot be resolved, their ID
+    is left as None and they are queried by name. The cities selected by the city
+    selectors (see select_cities) are then added, if their ID is not already present.
+
+    Args:
+        cities (list): the cities, as configured in the config file.
+        index (CityIndex): the city index. Can be None.
+        logger (Logger): logger.
+        selected_cities (list): the cities selected by the city selectors, as
+        dictionaries with the keys 'id' and 'name'.
+
+    Returns:
+        list: a list of dictionaries with the keys 'id' and 'name'.
+    """
+
+    resolved_cities = []
+
+    for city in cities:
+        if isinstance(city, dict) and city.get("id") is not None:
+            name = city.get("name") or (index.name_of(city["id"]) if index else None)
+            resolved_cities.append({"id": city["id"], "name": name})
+            continue
+
+        query = city.get("name") if isinstance(city, dict) else city
+        if not isinstance(query, str) or not query.strip():
+            logger.warning(f"City {city} has neither an ID nor a name. Skipping.")
+            continue
+
+        match = index.resolve(query) if index else None
+
+        if match and normalize_city_name(match[1]) != normalize_city_name(
+            query.split(",")[0]
+        ):
+            logger.warning(
+                f"City '{query}' resolved to ID {match[0]}, with a different name "
+                f"({match[1]})."
+            )
+            resolved_cities.append({"id": match[0], "name": match[1]})
+        elif match:
+            logger.info(f"City '{query}' resolved to ID {match[0]} ({match[1]}).")
+            resolved_cities.append({"id": match[0], "name": match[1]})
+        else:
+            logger.warning(f"City '{query}' could not be resolved to an ID.")
+            resolved_cities.append({"id": None, "name": query})
+
+    resolved_ids = {city["id"] for city in resolved_cities}
+    resolved_cities.extend(
+        city for city in selected_cities or [] if city["id"] not in resolved_ids
+    )
+
+    return resolved_cities
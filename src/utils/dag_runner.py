@@ -0,0 +1,150 @@
+import time
+import logging
+import contextlib
+
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from utils.stage_metrics import MetricsRecorder
+
+
+class DAGRunner:
+    """
+    Runs the stages of the pipeline as a directed acyclic graph: each stage declares the
+    stages it depends on, and starts as soon as all of them have finished, in a thread pool.
+    Independent chains of stages (e.g. weather codes, city codes and weather data) run
+    concurrently, so the duration of a run is that of its longest chain.
+
+    If a stage raises an exception, the stages that depend on it, directly or not, are
+    skipped. The wall time of each stage is logged at the end of the run. If a metrics
+    recorder is given, each stage is measured by it (see MetricsRecorder.measure).
+    """
+
+    def __init__(
+        self,
+        max_workers: int = 4,
+        logger: logging.Logger = None,
+        metrics: MetricsRecorder = None,
+    ):
+        self.logger = (
+            logger
+            if isinstance(logger, logging.Logger)
+            else logging.getLogger(__name__)
+        )
+
+        self.max_workers = max_workers
+        self.metrics = metrics
+        self.stages = {}
+
+    def add(self, name: str, function, dependencies: list = ()) -> None:
+        """
+        Adds the stage 'name' to the graph.
+
+        Args:
+            name (str): the name of the stage.
+            function (callable): the function run by the stage, without arguments.
+            dependencies (list): the names of the stages that must finish before it starts.
+            They must have been added before.
+        """
+
+        unknown_stages = [stage for stage in dependencies if stage not in self.stages]
+        if unknown_stages:
+            raise ValueError(
+                f"Stage {name} depends on unknown stages: {unknown_stages}."
+            )
+
+        self.stages[name] = {"function": function, "dependencies": list(dependencies)}
+
+    def run_stage(self, name: str) -> float:
+        """
+        Runs the stage 'name', measured by the metrics recorder, if any.
+
+        Args:
+            name (str): the name of the stage.
+
+        Returns:
+            float: the wall time of the stage, in seconds.
+        """
+
+        self.logger.info(f"Starting stage {name}.")
+        start = time.perf_counter()
+
+        with (
+            self.metrics.measure(name)
+            if self.metrics is not None
+            else contextlib.nullcontext()
+        ):
+            self.stages[name]["function"]()
+
+        return time.perf_counter() - start
+
+    def run(self) -> dict:
+        """
+        Runs all the stages, each one as soon as its dependencies have finished.
+
+        Returns:
+            dict: a dictionary mapping each stage to its result, a dictionary with the keys
+            'status' ("succeeded", "failed" or "skipped") and 'wall_time' (in seconds, None
+            if the stage did not run).
+        """
+
+        results = {}
+        pending = dict(self.stages)
+        running = {}
+        start = time.perf_counter()
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while pending or running:
+                # Skip the stages depending on a stage that did not succeed
+                for name, stage in list(pending.items()):
+                    if any(
+                        results.get(dependency, {}).get("status")
+                        in ("failed", "skipped")
+                        for dependency in stage["dependencies"]
+                    ):
+                        self.logger.warning(
+                            f"Skipping stage {name}, as one of its dependencies did not succeed."
+                        )
+                        results[name] = {"status": "skipped", "wall_time": None}
+                        del pending[name]
+
+                # Start the stages whose dependencies succeeded
+                for name, stage in list(pending.items()):
+                    if all(
+                        results.get(dependency, {}).get("status") == "succeeded"
+                        for dependency in stage["dependencies"]
+                    ):
+                        running[executor.submit(self.run_stage, name)] = name
+                        del pending[name]
+
+                if not running:
+                    continue
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+
+                for future in done:
+                    name = running.pop(future)
+
+                    try:
+                        wall_time = future.result()
+                        results[name] = {"status": "succeeded", "wall_time": wall_time}
+                        self.logger.info(
+                            f"Stage {name} finished in {wall_time:.2f} seconds."
+                        )
+                    except Exception as e:
+                        self.logger.error(f"Stage {name} failed: {e}")
+                        results[name] = {"status": "failed", "wall_time": None}
+
+        self.logger.info(
+            f"Pipeline run finished in {time.perf_counter() - start:.2f} seconds. "
+            "Wall time per stage: "
+            + ", ".join(
+                (
+                    f"{name}={result['wall_time']:.2f}s"
+                    if result["wall_time"] is not None
+                    else f"{name}={result['status']}"
+                )
+                for name, result in results.items()
+            )
+        )
+
+        return results
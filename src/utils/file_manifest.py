@@ -0,0 +1,166 @@
+import sqlite3
+import logging
+
+from pathlib import Path
+
+
+class FileManifest:
+    """
+    Manifest of the raw files loaded into a dataset, stored as an embedded SQLite table.
+
+    Each raw file has one row, holding its path (relative to the raw data directory), size,
+    modification time, content hash, the ID of the batch that loaded it and the state of that
+    batch:
+        - pending: the batch was started, but its data fragments were not published yet.
+        - committed: the data fragments of the batch were published to the dataset.
+
+    Only committed files count as loaded, so a crash half-way through a batch leaves its
+    files as new, to be loaded again on the next run.
+    """
+
+    def __init__(self, path: Path, logger: logging.Logger = None):
+        self.logger = (
+            logger
+            if isinstance(logger, logging.Logger)
+            else logging.getLogger(__name__)
+        )
+
+        self.path = path
+        self.connection = sqlite3.connect(path)
+
+        with self.connection:
+            self.connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS files (
+                    path TEXT PRIMARY KEY,
+                    size INTEGER,
+                    mtime REAL,
+                    content_hash TEXT,
+                    batch_id TEXT NOT NULL,
+                    state TEXT NOT NULL
+                )
+                """
+            )
+            self.connection.execute(
+                "CREATE INDEX IF NOT EXISTS files_batch_id ON files (batch_id)"
+            )
+
+        self.logger.info(f"File manifest {path} opened.")
+
+    def is_empty(self) -> bool:
+        """
+        Checks if the manifest has no files.
+
+        Returns:
+            bool: True if the manifest has no files, False otherwise.
+        """
+
+        return self.connection.execute("SELECT 1 FROM files LIMIT 1").fetchone() is None
+
+    def filter_new(self, paths: list) -> list:
+        """
+        Filters the paths in 'paths' that were not loaded yet, i.e., that are not in the
+        manifest as committed. Each path is an indexed lookup on the primary key.
+
+        Args:
+            paths (list): the paths of the raw files, relative to the raw data directory.
+
+        Returns:
+            list: the paths that were not loaded yet, in the same order as in 'paths'.
+        """
+
+        committed = set()
+        paths = list(paths)
+
+        # Query in chunks, to stay below SQLite's limit of parameters per query
+        for start in range(0, len(paths), 500):
+            chunk = paths[start : start + 500]
+            placeholders = ",".join("?" * len(chunk))
+            rows = self.connection.execute(
+                f"SELECT path FROM files WHERE state = 'committed' AND path IN ({placeholders})",
+                chunk,
+            )
+            committed.update(row[0] for row in rows)
+
+        return [path for path in paths if path not in committed]
+
+    def begin_batch(self, batch_id: str, files: list) -> None:
+        """
+        Registers the files in 'files' as pending for the batch 'batch_id', in a single
+        transaction.
+
+        Args:
+            batch_id (str): the ID of the batch.
+            files (list): list of dictionaries with the keys 'path', 'size', 'mtime' and
+            'content_hash'.
+        """
+
+        self.logger.info(f"Registering {len(files)} files for batch {batch_id}.")
+
+        with self.connection:
+            self.connection.executemany(
+                """
+                INSERT OR REPLACE INTO files (path, size, mtime, content_hash, batch_id, state)
+                VALUES (:path, :size, :mtime, :content_hash, :batch_id, 'pending')
+                """,
+                [{**file, "batch_id": batch_id} for file in files],
+            )
+
+    def commit_batch(self, batch_id: str) -> None:
+        """
+        Marks the files of the batch 'batch_id' as committed.
+
+        Args:
+            batch_id (str): the ID of the batch.
+        """
+
+        self.logger.info(f"Committing batch {batch_id}.")
+
+        with self.connection:
+            self.connection.execute(
+                "UPDATE files SET state = 'committed' WHERE batch_id = ?", (batch_id,)
+            )
+
+    def discard_batch(self, batch_id: str) -> None:
+        """
+        Removes the files of the batch 'batch_id' from the manifest.
+
+        Args:
+            batch_id (str): the ID of the batch.
+        """
+
+        self.logger.info(f"Discarding batch {batch_id}.")
+
+        with self.connection:
+            self.connection.execute("DELETE FROM files WHERE batch_id = ?", (batch_id,))
+
+    def pending_batches(self) -> list:
+        """
+        Gets the IDs of the batches that were started but not committed.
+
+        Returns:
+            list: the IDs of the pending batches.
+        """
+
+        rows = self.connection.execute(
+            "SELECT DISTINCT batch_id FROM files WHERE state = 'pending'"
+        )
+
+        return [row[0] for row in rows]
+
+    def reset(self) -> None:
+        """
+        Removes all the files from the manifest.
+        """
+
+        self.logger.info(f"Resetting the file manifest {self.path}.")
+
+        with self.connection:
+            self.connection.execute("DELETE FROM files")
+
+    def close(self) -> None:
+        """
+        Closes the connection to the manifest.
+        """
+
+        self.connection.close()
@@ -1,12 +1,19 @@
+from typing import Optional
 from pydantic import BaseModel
 
+
 class APIClientInputConfiguration(BaseModel):
     """
     Configuration for API client input.
     """
-    
+
     base_url: str
+    group_url: Optional[str] = None
     api_key: str
     # city: dict
     units: str = "metric"
-    language: str = "en"
\ No newline at end of file
+    language: str = "en"
+    timeout: float = 10.0
+    max_concurrency: int = 8
+    max_retries: int = 3
+    backoff_base: float = 1.0
@@ -0,0 +1,79 @@
+import os
+import json
+import logging
+
+from pathlib import Path
+
+
+class LastSeenCache:
+    """
+    On-disk cache of the timestamp ('dt') of the last measurement stored for each city ID.
+
+    The API only refreshes the current weather every few minutes, so consecutive calls often
+    return the same measurement. The cache is loaded once per run, and measurements whose
+    (id, dt) pair is not newer than the cached one are reported as duplicates.
+    """
+
+    def __init__(self, path: Path, logger: logging.Logger = None):
+        self.logger = (
+            logger
+            if isinstance(logger, logging.Logger)
+            else logging.getLogger(__name__)
+        )
+
+        self.path = path
+        self.last_seen = {}
+        self.duplicates = 0
+
+        if os.path.exists(path):
+            try:
+                with open(path, "r") as f:
+                    self.last_seen = {
+                        int(city_id): dt for city_id, dt in json.load(f).items()
+                    }
+            except Exception as e:
+                self.logger.error(
+                    f"Error loading the last seen cache {path}: {e}. Starting empty."
+                )
+
+        self.logger.info(
+            f"Last seen cache loaded with {len(self.last_seen)} cities from {path}."
+        )
+
+    def is_duplicate(self, city_id: int, dt: int) -> bool:
+        """
+        Checks if the measurement of the city 'city_id' at 'dt' was already seen. If it was,
+        the duplicate counter is incremented. Otherwise, the cache is updated.
+
+        Args:
+            city_id (int): the city ID.
+            dt (int): the timestamp of the measurement, in seconds since the epoch.
+
+        Returns:
+            bool: True if the measurement was already seen, False otherwise.
+        """
+
+        if city_id is None or dt is None:
+            return False
+
+        if self.last_seen.get(city_id, -1) >= dt:
+            self.duplicates += 1
+            return True
+
+        self.last_seen[city_id] = dt
+
+        return False
+
+    def save(self) -> None:
+        """
+        Saves the cache to disk. The file is replaced atomically, so a crash never leaves it
+        half-written.
+        """
+
+        temporary_path = f"{self.path}.tmp"
+
+        with open(temporary_path, "w") as f:
+            json.dump(self.last_seen, f)
+        os.replace(temporary_path, self.path)
+
+        self.logger.info(f"Last seen cache saved to {self.path}.")
@@ -0,0 +1,336 @@
+import os
+import logging
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from pathlib import Path
+
+
+def get_epoch_seconds(column) -> np.ndarray:
+    """
+    Gets the values of a timestamp column (of any unit) or of an integer column of seconds
+    since the epoch, as seconds since the epoch.
+
+    Args:
+        column (pa.Array or pa.ChunkedArray): the column.
+
+    Returns:
+        np.ndarray: the seconds since the epoch, as int64.
+    """
+
+    if pa.types.is_timestamp(column.type):
+        column = pc.cast(column, pa.timestamp("s"), safe=False)
+
+    return pc.cast(column, pa.int64()).to_numpy(zero_copy_only=False)
+
+
+def merge_sorted_keys(keys: np.ndarray, new_keys: np.ndarray) -> np.ndarray:
+    """
+    Merges the sorted unique keys 'new_keys' into the sorted unique keys 'keys'. The
+    positions of the new keys are found with np.searchsorted and they are inserted in a
+    single pass, so the existing keys are copied once but never sorted again.
+
+    Args:
+        keys (np.ndarray): the sorted unique keys.
+        new_keys (np.ndarray): the sorted unique keys to merge.
+
+    Returns:
+        np.ndarray: the sorted unique keys of both arrays.
+    """
+
+    positions = np.searchsorted(keys, new_keys)
+    found = contains_keys(keys=keys, lookup_keys=new_keys, positions=positions)
+
+    return np.insert(keys, positions[~found], new_keys[~found])
+
+
+def contains_keys(
+    keys: np.ndarray, lookup_keys: np.ndarray, positions: np.ndarray = None
+) -> np.ndarray:
+    """
+    Checks which of 'lookup_keys' are in the sorted keys 'keys'.
+
+    Args:
+        keys (np.ndarray): the sorted keys.
+        lookup_keys (np.ndarray): the keys to look up.
+        positions (np.ndarray): the result of np.searchsorted(keys, lookup_keys), if it
+        was already computed.
+
+    Returns:
+        np.ndarray: a boolean mask of the keys found.
+    """
+
+    if len(keys) == 0:
+        return np.zeros(len(lookup_keys), dtype=bool)
+
+    if positions is None:
+        positions = np.searchsorted(keys, lookup_keys)
+
+    return keys[np.minimum(positions, len(keys) - 1)] == lookup_keys
+
+
+class ObservationIndex:
+    """
+    Persistent index of the observations already processed, used to reject duplicates
+    without reading the processed data back. Each observation is identified by a 64-bit
+    key, city_id << 32 | epoch (the timestamp of the measurement, in seconds), and the keys
+    are kept as sorted int64 NumPy arrays, stored in .npz files together with the
+    watermark of the processing state they match:
+        - The base file, 'path', with the keys merged so far and the sequence number of
+          the last segment merged into it.
+        - One segment file per run, <stem>-<sequence>.npz, with the keys added by the run.
+
+    Looking up a batch of new rows is vectorized (np.searchsorted), so it only depends on
+    the number of new rows and segments, and the index takes 8 bytes per observation.
+    Saving a run only writes its own keys. Once there are 'max_segments' segments, they
+    are merged into the base keys (see merge_sorted_keys) and the base file is rewritten,
+    so its cost is spread over several runs. If the stored watermark does not match the
+    processing state (e.g. a run crashed between publishing its rows and saving the
+    index), the index must be rebuilt from the processed data.
+    """
+
+    def __init__(
+        self, path: Path, max_segments: int = 16, logger: logging.Logger = None
+    ):
+        self.logger = (
+            logger
+            if isinstance(logger, logging.Logger)
+            else logging.getLogger(__name__)
+        )
+
+        self.path = Path(path)
+        self.max_segments = max(1, max_segments)
+        self.keys = np.empty(0, dtype=np.int64)
+        self.segments = []
+        self.unsaved_segments = []
+        self.next_segment = 1
+        self.rewrite = False
+        self.watermark = None
+        self.loaded = False
+
+        if os.path.exists(self.path):
+            try:
+                with np.load(self.path, allow_pickle=False) as index:
+                    self.keys = index["keys"]
+                    self.watermark = str(index["watermark"]) or None
+                    last_segment = (
+                        int(index["last_segment"]) if "last_segment" in index else 0
+                    )
+                self.next_segment = last_segment + 1
+
+                # The segments merged into the base file, left by a run that crashed
+                # before removing them, are skipped
+                for sequence, segment_path in self.list_segments(self.path):
+                    if sequence <= last_segment:
+                        continue
+                    with np.load(segment_path, allow_pickle=False) as segment:
+                        self.segments.append(segment["keys"])
+                        self.watermark = str(segment["watermark"]) or None
+                    self.next_segment = sequence + 1
+
+                self.loaded = True
+            except Exception as e:
+                self.keys = np.empty(0, dtype=np.int64)
+                self.segments = []
+                self.logger.error(
+                    f"Error loading the observation index {self.path}: {e}."
+                )
+
+    @staticmethod
+    def list_segments(path: Path) -> list:
+        """
+        Lists the segment files of the index stored at 'path'.
+
+        Args:
+            path (Path): the base file of the index.
+
+        Returns:
+            list: the (sequence, path) tuples of the segments, in sequence order.
+        """
+
+        path = Path(path)
+        if not os.path.exists(path.parent):
+            return []
+
+        segments = []
+        prefix = f"{path.stem}-"
+
+        for file in os.listdir(path.parent):
+            sequence = file[len(prefix) : -len(".npz")]
+            if file.startswith(prefix) and file.endswith(".npz") and sequence.isdigit():
+                segments.append((int(sequence), path.parent / file))
+
+        return sorted(segments)
+
+    @classmethod
+    def remove(cls, path: Path) -> None:
+        """
+        Removes the base file and the segment files of the index stored at 'path'.
+
+        Args:
+            path (Path): the base file of the index.
+        """
+
+        for _, segment_path in cls.list_segments(path):
+            os.remove(segment_path)
+        if os.path.exists(path):
+            os.remove(path)
+
+    @staticmethod
+    def encode_keys(city_ids, epochs) -> np.ndarray:
+        """
+        Encodes the observations of the cities 'city_ids' at 'epochs' as keys of the index.
+
+        Args:
+            city_ids (np.ndarray): the city IDs.
+            epochs (np.ndarray): the timestamps of the measurements, in seconds since the
+            epoch.
+
+        Returns:
+            np.ndarray: the keys, as int64.
+        """
+
+        return (np.asarray(city_ids, dtype=np.int64) << 32) | (
+            np.asarray(epochs, dtype=np.int64) & 0xFFFFFFFF
+        )
+
+    def __len__(self) -> int:
+        return len(self.keys) + sum(len(segment) for segment in self.segments)
+
+    def is_consistent(self, watermark: str) -> bool:
+        """
+        Checks if the index was loaded and matches the processing state at 'watermark'.
+
+        Args:
+            watermark (str): the watermark of the processing state.
+
+        Returns:
+            bool: True if the index can be used, False if it must be rebuilt.
+        """
+
+        return self.loaded and self.watermark == watermark
+
+    def reset(self, keys: np.ndarray = None, watermark: str = None) -> None:
+        """
+        Replaces the keys of the index, e.g. when it is rebuilt from the processed data.
+        The base file is rewritten on the next save.
+
+        Args:
+            keys (np.ndarray): the keys, in any order. None for an empty index.
+            watermark (str): the watermark of the processing state the keys match.
+        """
+
+        self.keys = np.unique(keys) if keys is not None else np.empty(0, dtype=np.int64)
+        self.segments = []
+        self.unsaved_segments = []
+        self.rewrite = True
+        self.watermark = watermark
+        self.loaded = True
+
+    def filter_new(self, keys: np.ndarray) -> np.ndarray:
+        """
+        Gets the new observations among 'keys': those that are not in the index and are
+        the first occurrence of their key in the batch.
+
+        Args:
+            keys (np.ndarray): the keys of the batch, see encode_keys.
+
+        Returns:
+            np.ndarray: a boolean mask of the new observations.
+        """
+
+        is_new = np.zeros(len(keys), dtype=bool)
+        is_new[np.unique(keys, return_index=True)[1]] = True
+
+        for stored_keys in [self.keys] + self.segments:
+            is_new &= ~contains_keys(keys=stored_keys, lookup_keys=keys)
+
+        return is_new
+
+    def add(self, keys: np.ndarray, watermark: str) -> None:
+        """
+        Adds the keys of the observations of a run to the index, as a new segment. Once
+        there are 'max_segments' segments, they are merged into the base keys.
+
+        Args:
+            keys (np.ndarray): the keys, see encode_keys.
+            watermark (str): the watermark of the processing state after the run.
+        """
+
+        segment = np.unique(np.asarray(keys, dtype=np.int64))
+        self.segments.append(segment)
+        self.unsaved_segments.append(segment)
+        self.watermark = watermark
+
+        if len(self.segments) >= self.max_segments:
+            new_keys = np.unique(np.concatenate(self.segments))
+            self.keys = merge_sorted_keys(keys=self.keys, new_keys=new_keys)
+            self.segments = []
+            self.unsaved_segments = []
+            self.rewrite = True
+
+    def save_file(self, path: Path, **arrays) -> None:
+        """
+        Saves the arrays 'arrays' to the .npz file 'path'. The file is replaced atomically.
+
+        Args:
+            path (Path): the file.
+            arrays: the arrays to save, by name.
+        """
+
+        temporary_path = path.parent / f".{path.name}.tmp"
+
+        with open(temporary_path, "wb") as f:
+            np.savez(f, **arrays)
+        os.replace(temporary_path, path)
+
+    def save(self) -> None:
+        """
+        Saves the index. Only the segments added since the last save are written, unless
+        the index was reset or its segments were merged: then the base file is rewritten
+        and the segment files are removed.
+        """
+
+        watermark = np.array(self.watermark or "")
+
+        if self.rewrite:
+            # The segments added since the merge go into the base file too, so it never
+            # holds a watermark ahead of its keys
+            if self.segments:
+                new_keys = np.unique(np.concatenate(self.segments))
+                self.keys = merge_sorted_keys(keys=self.keys, new_keys=new_keys)
+                self.segments = []
+                self.unsaved_segments = []
+
+            # The base file records the last segment merged into it, so the segments are
+            # ignored if the run crashes before removing them
+            last_segment = self.next_segment - 1
+            self.save_file(
+                self.path,
+                keys=self.keys,
+                watermark=watermark,
+                last_segment=np.array(last_segment),
+            )
+            for sequence, segment_path in self.list_segments(self.path):
+                if sequence <= last_segment:
+                    os.remove(segment_path)
+
+            self.rewrite = False
+            self.logger.info(
+                f"Observation index saved to {self.path} with {len(self.keys)} keys."
+            )
+
+        for segment in self.unsaved_segments:
+            segment_path = (
+                self.path.parent / f"{self.path.stem}-{self.next_segment:06d}.npz"
+            )
+            self.save_file(segment_path, keys=segment, watermark=watermark)
+            self.next_segment += 1
+
+            self.logger.info(
+                f"Observation index segment saved to {segment_path} with "
+                f"{len(segment)} keys ({len(self)} keys in total)."
+            )
+
+        self.unsaved_segments = []
@@ -0,0 +1,164 @@
+import json
+import logging
+import threading
+import pyarrow as pa
+
+from pathlib import Path
+
+from utils.auxiliary_functions import (
+    build_arrow_schema,
+    build_table_schema,
+    compile_schema,
+    load_env_variables,
+)
+from utils.stage_metrics import MetricsRecorder
+
+
+class PipelineContext:
+    """
+    State shared by the stages of one run of the pipeline, built once per run:
+        - env_variables: the environment variables, see load_env_variables.
+        - config: the parsed configuration file.
+        - Objects derived from them and computed on first use, e.g. the compiled schemas
+          of the weather data or the city index, see get_or_create.
+        - tables: the Arrow tables handed off in memory from one stage to the next, e.g.
+          the rows written by load_weather_data, read by process_weather_data instead of
+          reading them back from disk. The stages still write their outputs to disk.
+        - metrics: the recorder of the measurements of the stages of the run, written to
+          METRICS_PATH in the format of the 'metrics' entry of the config file, with the
+          profilers listed in PIPELINE_PROFILE, see MetricsRecorder.
+
+    Every stage accepts an optional context. When a stage is run on its own, without one,
+    it builds its own.
+    """
+
+    def __init__(
+        self, env_variables: dict, config: dict, logger: logging.Logger = None
+    ):
+        self.logger = (
+            logger
+            if isinstance(logger, logging.Logger)
+            else logging.getLogger(__name__)
+        )
+
+        self.env_variables = env_variables
+        self.config = config
+        self.objects = {}
+        self.tables = {}
+        self.lock = threading.RLock()
+
+        metrics_config = config.get("metrics", {})
+        self.metrics = MetricsRecorder(
+            metrics_path=env_variables.get("METRICS_PATH"),
+            output_format=metrics_config.get("format", "jsonl"),
+            file_name=metrics_config.get("file_name", "stage_metrics"),
+            profilers=env_variables.get("PIPELINE_PROFILE", []),
+            logger=self.logger,
+        )
+
+    @classmethod
+    def build(cls, path: Path, logger: logging.Logger = None) -> "PipelineContext":
+        """
+        Builds the context from the .env file located in 'path' and the configuration file
+        it points to.
+
+        Args:
+            path (Path): the path containing the .env file.
+            logger (Logger): logger.
+
+        Returns:
+            PipelineContext or None: the context. None if the configuration file cannot be
+            loaded.
+        """
+
+        logger = (
+            logger
+            if isinstance(logger, logging.Logger)
+            else logging.getLogger(__name__)
+        )
+        env_variables = load_env_variables(path, logger)
+
+        # Read the configuration file
+        config_path = env_variables.get("CONFIG_PATH")
+        try:
+            logger.info("Loading the JSON configuration file")
+            with open(config_path, "r") as f:
+                config = json.load(f)
+        except Exception as e:
+            logger.error(f"Error loading the JSON configuration file: {e}")
+            return None
+
+        return cls(env_variables=env_variables, config=config, logger=logger)
+
+    def get_or_create(self, key: str, factory):
+        """
+        Gets the object 'key' of the context, creating it with 'factory' on first use.
+        Stages running concurrently share the same object, created once.
+
+        Args:
+            key (str): the name of the object.
+            factory (callable): the function creating the object, without arguments.
+
+        Returns:
+            The object.
+        """
+
+        with self.lock:
+            if key not in self.objects:
+                self.objects[key] = factory()
+
+            return self.objects[key]
+
+    def weather_data_schemas(self) -> tuple:
+        """
+        Gets the schemas compiled from the 'fields' entry of ingestion_layer > weather_data
+        in the config file, computed once per run.
+
+        Returns:
+            tuple: the key-path extractors (see compile_schema), the Arrow schema of the raw
+            documents (see build_arrow_schema) and the Arrow schema of the loaded table (see
+            build_table_schema).
+        """
+
+        list_fields = (
+            self.config.get("ingestion_layer", {})
+            .get("weather_data", {})
+            .get("fields", {})
+        )
+
+        return self.get_or_create(
+            "weather_data_schemas",
+            lambda: (
+                compile_schema(schema_dict=list_fields),
+                build_arrow_schema(schema_dict=list_fields),
+                build_table_schema(schema_dict=list_fields, logger=self.logger),
+            ),
+        )
+
+    def put_table(self, name: str, table: pa.Table) -> None:
+        """
+        Hands off the Arrow table 'table' to the next stages, under the name 'name'. The
+        table is kept by reference, without copying it.
+
+        Args:
+            name (str): the name of the table.
+            table (pa.Table): the table.
+        """
+
+        with self.lock:
+            self.tables[name] = table
+
+    def pop_table(self, name: str) -> pa.Table:
+        """
+        Takes the Arrow table handed off under the name 'name', releasing it from the
+        context.
+
+        Args:
+            name (str): the name of the table.
+
+        Returns:
+            pa.Table or None: the table, or None if no table was handed off.
+        """
+
+        with self.lock:
+            return self.tables.pop(name, None)
@@ -0,0 +1,156 @@
+import time
+import logging
+import threading
+
+
+class TokenBucketRateLimiter:
+    """
+    Thread-safe token bucket rate limiter. Tokens are added at 'rate' tokens per second, up
+    to 'capacity' tokens, and each call to the API takes one token. With a capacity of 1,
+    calls are evenly spaced, so the API is never hit in bursts.
+
+    The limiter can also be paused, e.g. when the API answers with a Retry-After header,
+    which holds back every caller sharing it, not only the one that got the response.
+    """
+
+    def __init__(
+        self, rate: float, capacity: float = 1.0, logger: logging.Logger = None
+    ):
+        self.logger = (
+            logger
+            if isinstance(logger, logging.Logger)
+            else logging.getLogger(__name__)
+        )
+
+        if rate <= 0 or capacity < 1:
+            raise ValueError(
+                f"Invalid rate limiter parameters: rate={rate}, capacity={capacity}. "
+                "The rate must be positive and the capacity at least 1."
+            )
+
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last_refill = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self) -> None:
+        """
+        Takes one token, blocking until one is available and the limiter is not paused.
+        """
+
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.capacity, self.tokens + (now - self.last_refill) * self.rate
+                )
+                self.last_refill = now
+
+                if now < self.paused_until:
+                    wait = self.paused_until - now
+                elif self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                else:
+                    wait = (1 - self.tokens) / self.rate
+
+            time.sleep(wait)
+
+    def pause(self, seconds: float) -> None:
+        """
+        Pauses the limiter for 'seconds' seconds. Calls to acquire block until then.
+
+        Args:
+            seconds (float): the duration of the pause, in seconds.
+        """
+
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = 0
+
+        self.logger.info(f"Rate limiter paused for {seconds:.1f} seconds.")
+
+
+class CallPlanner:
+    """
+    Plans the rate of the calls made to the API from its quota, e.g. 60 calls per minute
+    and 1,000,000 calls per month.
+
+    The rate is the highest one that keeps every quota, when the pipeline runs once per
+    scheduling window: calls are spread evenly across the window instead of being made in
+    a burst at its start, and the share of the daily and monthly quotas of each run is
+    never exceeded.
+    """
+
+    def __init__(
+        self,
+        calls_per_minute: float = None,
+        calls_per_day: float = None,
+        calls_per_month: float = None,
+        window_seconds: float = 1800,
+        logger: logging.Logger = None,
+    ):
+        self.logger = (
+            logger
+            if isinstance(logger, logging.Logger)
+            else logging.getLogger(__name__)
+        )
+
+        self.calls_per_minute = calls_per_minute
+        self.calls_per_day = calls_per_day
+        self.calls_per_month = calls_per_month
+        self.window_seconds = window_seconds
+
+    def max_rate(self) -> float:
+        """
+        Gets the highest sustained rate allowed by the quotas.
+
+        Returns:
+            float or None: the rate, in calls per second. None if no quota is set.
+        """
+
+        rates = [
+            calls / seconds
+            for calls, seconds in [
+                (self.calls_per_minute, 60),
+                (self.calls_per_day, 24 * 60 * 60),
+                (self.calls_per_month, 30 * 24 * 60 * 60),
+            ]
+            if calls
+        ]
+
+        return min(rates) if rates else None
+
+    def plan(self, n_calls: int) -> TokenBucketRateLimiter:
+        """
+        Plans 'n_calls' calls to the API in one scheduling window.
+
+        Args:
+            n_calls (int): the number of calls to make.
+
+        Returns:
+            TokenBucketRateLimiter or None: a rate limiter at the highest rate allowed by the
+            quotas. None if no quota is set.
+        """
+
+        rate = self.max_rate()
+
+        if rate is None:
+            self.logger.info("No API quota configured. Calls will not be rate limited.")
+            return None
+
+        budget = int(rate * self.window_seconds)
+        self.logger.info(
+            f"Planning {n_calls} calls at {rate:.3f} calls per second "
+            f"({budget} calls per window of {self.window_seconds} seconds)."
+        )
+
+        if n_calls > budget:
+            self.logger.warning(
+                f"The {n_calls} calls exceed the budget of {budget} calls per window. "
+                f"The run will take about {n_calls / rate:.0f} seconds."
+            )
+
+        return TokenBucketRateLimiter(rate=rate, logger=self.logger)
@@ -0,0 +1,68 @@
+import os
+import gzip
+import json
+import logging
+
+from pathlib import Path
+
+
+class NDJSONBatchWriter:
+    """
+    Writes the raw API responses of one run to a single gzip-compressed, newline-delimited
+    JSON file (<directory>/<YYYYMMDD_HHMMSS>.ndjson.gz), one response per line.
+
+    Responses are appended as the bytes received from the API, without being re-serialized.
+    The file is written under a temporary name and only renamed to its final name when the
+    writer is closed, so the loading layer never reads a partially written batch.
+    """
+
+    def __init__(self, directory: Path, file_name: str, logger: logging.Logger = None):
+        self.logger = (
+            logger
+            if isinstance(logger, logging.Logger)
+            else logging.getLogger(__name__)
+        )
+
+        self.directory = directory
+        self.path = directory / f"{file_name}.ndjson.gz"
+        self.temporary_path = directory / f".{file_name}.ndjson.gz.tmp"
+        self.file = None
+        self.lines = 0
+
+    def write(self, content: bytes) -> None:
+        """
+        Appends the response 'content' to the batch, as one line.
+
+        Args:
+            content (bytes): the body of the API response, a JSON document.
+        """
+
+        if self.file is None:
+            os.makedirs(self.directory, exist_ok=True)
+            self.file = gzip.open(self.temporary_path, "wb")
+
+        # Each document must take a single line
+        if b"\n" in content:
+            content = json.dumps(json.loads(content), separators=(",", ":")).encode()
+
+        self.file.write(content.strip() + b"\n")
+        self.lines += 1
+
+    def close(self) -> Path:
+        """
+        Closes the batch and gives it its final name.
+
+        Returns:
+            Path or None: the path of the batch, or None if nothing was written.
+        """
+
+        if self.file is None:
+            return None
+
+        self.file.close()
+        os.replace(self.temporary_path, self.path)
+        self.file = None
+
+        self.logger.info(f"Batch file {self.path} written with {self.lines} lines.")
+
+        return self.path
@@ -0,0 +1,157 @@
+import os
+import json
+import hashlib
+import logging
+
+from pathlib import Path
+
+
+class StageCache:
+    """
+    Content-fingerprint cache of a pipeline stage, stored in a JSON sidecar file next to the
+    output of the stage (<output name without suffix>.fingerprint.json).
+
+    The fingerprint is a hash of:
+        - The content of the input files of the stage.
+        - The subtree of the config file used by the stage.
+        - The source code of the stage.
+    The stage is skipped only if its output exists and the fingerprint matches the one saved
+    by its last successful run, so touching a file or checking it out again does not trigger
+    a recompute, while a change in the data, the config or the code does.
+
+    To avoid reading unchanged inputs on every run, the hash of each input file is kept in
+    the sidecar together with its size and modification time, and reused while they match.
+    """
+
+    def __init__(self, output_path: Path, logger: logging.Logger = None):
+        self.logger = (
+            logger
+            if isinstance(logger, logging.Logger)
+            else logging.getLogger(__name__)
+        )
+
+        self.output_path = Path(output_path)
+        self.path = (
+            self.output_path.parent / f"{self.output_path.stem}.fingerprint.json"
+        )
+        self.stored_fingerprint = None
+        self.stored_files = {}
+        self.files = {}
+
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, "r") as f:
+                    sidecar = json.load(f)
+                self.stored_fingerprint = sidecar.get("fingerprint")
+                self.stored_files = sidecar.get("files", {})
+            except Exception as e:
+                self.logger.error(f"Error reading the stage cache {self.path}: {e}")
+
+    def hash_file(self, path: Path) -> str:
+        """
+        Gets the SHA-256 hash of the content of the file 'path'. The hash stored in the
+        sidecar is reused if the size and modification time of the file did not change.
+
+        Args:
+            path (Path): the file.
+
+        Returns:
+            str: the hexadecimal hash.
+        """
+
+        key = str(path)
+        stats = os.stat(path)
+        stored = self.stored_files.get(key, {})
+
+        if stored.get("size") == stats.st_size and stored.get("mtime_ns") == (
+            stats.st_mtime_ns
+        ):
+            content_hash = stored["hash"]
+        else:
+            file_hash = hashlib.sha256()
+            with open(path, "rb") as f:
+                for chunk in iter(lambda: f.read(1 << 20), b""):
+                    file_hash.update(chunk)
+            content_hash = file_hash.hexdigest()
+
+        self.files[key] = {
+            "size": stats.st_size,
+            "mtime_ns": stats.st_mtime_ns,
+            "hash": content_hash,
+        }
+
+        return content_hash
+
+    def fingerprint(self, inputs: list, config: dict, code_files: list) -> str:
+        """
+        Computes the fingerprint of a run of the stage.
+
+        Args:
+            inputs (list): the input files of the stage. Directories are hashed through all
+            their files, except the ones starting with '.' or '_'. Missing inputs are
+            hashed as missing.
+            config (dict): the subtree of the config file used by the stage.
+            code_files (list): the source files of the stage.
+
+        Returns:
+            str: the hexadecimal fingerprint.
+        """
+
+        fingerprint = hashlib.sha256()
+        fingerprint.update(json.dumps(config, sort_keys=True, default=str).encode())
+
+        for path in [Path(path) for path in list(inputs) + list(code_files)]:
+            if path.is_dir():
+                files = sorted(
+                    file
+                    for file in path.rglob("*")
+                    if file.is_file()
+                    and not any(
+                        part.startswith((".", "_"))
+                        for part in file.relative_to(path).parts
+                    )
+                )
+            else:
+                files = [path]
+
+            for file in files:
+                content_hash = (
+                    self.hash_file(file) if os.path.exists(file) else "missing"
+                )
+                fingerprint.update(f"{file.name}:{content_hash}\n".encode())
+
+        return fingerprint.hexdigest()
+
+    def is_up_to_date(self, fingerprint: str) -> bool:
+        """
+        Checks if the output of the stage exists and was produced from the same inputs,
+        config and code.
+
+        Args:
+            fingerprint (str): the fingerprint of the current run.
+
+        Returns:
+            bool: True if the stage can be skipped, False otherwise.
+        """
+
+        return os.path.exists(self.output_path) and (
+            self.stored_fingerprint == fingerprint
+        )
+
+    def save(self, fingerprint: str) -> None:
+        """
+        Saves the fingerprint of a successful run, with the hashes of its input files. The
+        file is replaced atomically.
+
+        Args:
+            fingerprint (str): the fingerprint of the run.
+        """
+
+        temporary_path = f"{self.path}.tmp"
+
+        with open(temporary_path, "w") as f:
+            json.dump({"fingerprint": fingerprint, "files": self.files}, f)
+        os.replace(temporary_path, self.path)
+
+        self.stored_fingerprint = fingerprint
+        self.logger.info(f"Stage fingerprint saved to {self.path}.")
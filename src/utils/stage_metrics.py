@@ -0,0 +1,470 @@
+import os
+import json
+import time
+import pstats
+import psutil
+import cProfile
+import logging
+import threading
+import tracemalloc
+import pandas as pd
+
+from pathlib import Path
+from contextlib import contextmanager
+
+# Profilers that can be enabled for each stage
+PROFILERS = ["cprofile", "tracemalloc"]
+
+# Measurements of the stage being run by each thread, see current_stage_metrics
+_current = threading.local()
+
+
+class StageMetrics:
+    """
+    Measurements of one run of a stage:
+        - Measured around the stage, by MetricsRecorder.measure: its status, wall time, CPU
+          time and the peak resident memory of the process while it ran (see RSSSampler).
+        - Reported by the stage itself, with add: the rows it read and wrote, the duplicate
+          rows it rejected, and the bytes it read from and wrote to disk (or the network,
+          for the ingestion).
+    """
+
+    def __init__(self, stage: str):
+        self.stage = stage
+        self.status = None
+        self.wall_time = None
+        self.cpu_time = None
+        self.process_cpu_time = None
+        self.peak_rss_mb = None
+        self.rss_growth_mb = None
+        self.rows_in = 0
+        self.rows_out = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.duplicates = 0
+        self.lock = threading.Lock()
+
+    def add(
+        self,
+        rows_in: int = 0,
+        rows_out: int = 0,
+        bytes_read: int = 0,
+        bytes_written: int = 0,
+        duplicates: int = 0,
+    ) -> None:
+        """
+        Adds rows and bytes to the counters of the stage. It can be called several times,
+        from any thread.
+
+        Args:
+            rows_in (int): the number of rows (or documents) read.
+            rows_out (int): the number of rows (or documents) written.
+            bytes_read (int): the number of bytes read.
+            bytes_written (int): the number of bytes written.
+            duplicates (int): the number of duplicate rows rejected.
+        """
+
+        with self.lock:
+            self.rows_in += rows_in
+            self.rows_out += rows_out
+            self.bytes_read += bytes_read
+            self.bytes_written += bytes_written
+            self.duplicates += duplicates
+
+    def as_dict(self) -> dict:
+        """
+        Gets the measurements as a dictionary.
+
+        Returns:
+            dict: the measurements.
+        """
+
+        return {
+            "stage": self.stage,
+            "status": self.status,
+            "wall_time": self.wall_time,
+            "cpu_time": self.cpu_time,
+            "process_cpu_time": self.process_cpu_time,
+            "rows_in": self.rows_in,
+            "rows_out": self.rows_out,
+            "bytes_read": self.bytes_read,
+            "bytes_written": self.bytes_written,
+            "duplicates": self.duplicates,
+            "peak_rss_mb": self.peak_rss_mb,
+            "rss_growth_mb": self.rss_growth_mb,
+        }
+
+
+def current_stage_metrics() -> StageMetrics:
+    """
+    Gets the measurements of the stage being run by the current thread, to which the stage
+    reports its rows and bytes. When the stage is not measured (e.g. it is run on its own),
+    a new, discarded StageMetrics is returned, so stages can always report to it.
+
+    Returns:
+        StageMetrics: the measurements of the stage.
+    """
+
+    metrics = getattr(_current, "metrics", None)
+
+    return metrics if metrics is not None else StageMetrics(stage=None)
+
+
+def get_path_size(path: Path, pattern: str = "*") -> int:
+    """
+    Gets the size of the file 'path' or, if it is a directory, of all the files below it
+    matching 'pattern'.
+
+    Args:
+        path (Path): the file or directory.
+        pattern (str): the glob pattern of the files of the directory.
+
+    Returns:
+        int: the size, in bytes. 0 if the path does not exist.
+    """
+
+    path = Path(path)
+
+    if path.is_file():
+        return os.path.getsize(path)
+    if path.is_dir():
+        return sum(
+            os.path.getsize(file) for file in path.rglob(pattern) if file.is_file()
+        )
+
+    return 0
+
+
+def get_rss_mb() -> float:
+    """
+    Gets the current resident memory of the process, in MB.
+
+    Returns:
+        float: the resident memory.
+    """
+
+    return psutil.Process().memory_info().rss / (1024 * 1024)
+
+
+class RSSSampler:
+    """
+    Samples the resident memory of the process every 'interval' seconds, in a background
+    thread, while a stage runs. Unlike ru_maxrss, which is the peak since the process
+    started, the peak of the samples only covers the interval of the stage, so a stage
+    that runs after a memory-hungry one is not charged with its peak. Peaks shorter than
+    the interval can be missed.
+
+    The resident memory is that of the whole process: when stages run concurrently, it
+    includes the memory of the other stages. The growth over the memory at the start of
+    the stage is the best estimate of its own footprint.
+    """
+
+    def __init__(self, interval: float = 0.05):
+        self.interval = interval
+        self.start_rss_mb = get_rss_mb()
+        self.peak_rss_mb = self.start_rss_mb
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+        self.thread.start()
+
+    def sample(self) -> None:
+        """
+        Samples the resident memory until the sampler is stopped.
+        """
+
+        while not self.stopped.wait(self.interval):
+            self.peak_rss_mb = max(self.peak_rss_mb, get_rss_mb())
+
+    def stop(self) -> tuple:
+        """
+        Stops sampling, taking a last sample.
+
+        Returns:
+            tuple: the peak resident memory during the stage, and its growth over the
+            memory at the start of the stage, in MB.
+        """
+
+        self.stopped.set()
+        self.thread.join()
+        self.peak_rss_mb = max(self.peak_rss_mb, get_rss_mb())
+
+        return self.peak_rss_mb, self.peak_rss_mb - self.start_rss_mb
+
+
+class MetricsRecorder:
+    """
+    Records the measurements of the stages of one run of the pipeline (see StageMetrics) in
+    the directory 'metrics_path', in one of two formats:
+        - "jsonl": one JSON line per stage and run, appended to <file_name>.jsonl.
+        - "prometheus": the last measurements of each stage, as gauges in the Prometheus
+          text format, in <file_name>.prom, replaced atomically after each stage (to be
+          read by the textfile collector of the node exporter).
+
+    Profilers can be enabled for each stage (see PROFILERS), and write their output next
+    to the metrics:
+        - "cprofile": the cProfile statistics of the thread of the stage, in
+          <run_id>_<stage>.prof (to be read with pstats or snakeviz).
+        - "tracemalloc": the 25 lines of code that allocated the most memory during the
+          stage, in <run_id>_<stage>.tracemalloc.txt.
+
+    Stages run concurrently, in threads: the CPU time is that of the thread of the stage,
+    without the threads of the Arrow pool, which is why the CPU time of the whole process
+    during the stage is recorded too. Likewise, the resident memory sampled during the
+    stage (see RSSSampler) and the memory allocations seen by tracemalloc are those of the
+    whole process.
+    """
+
+    def __init__(
+        self,
+        metrics_path: Path,
+        output_format: str = "jsonl",
+        file_name: str = "stage_metrics",
+        profilers: list = (),
+        logger: logging.Logger = None,
+    ):
+        self.logger = (
+            logger
+            if isinstance(logger, logging.Logger)
+            else logging.getLogger(__name__)
+        )
+
+        if output_format not in ("jsonl", "prometheus"):
+            raise ValueError(
+                f"Unknown metrics format {output_format}, must be 'jsonl' or 'prometheus'."
+            )
+
+        unknown_profilers = [p for p in profilers if p not in PROFILERS]
+        if unknown_profilers:
+            raise ValueError(
+                f"Unknown profilers {unknown_profilers}, must be in {PROFILERS}."
+            )
+
+        self.metrics_path = Path(metrics_path) if metrics_path is not None else None
+        self.output_format = output_format
+        self.file_name = file_name
+        self.profilers = list(profilers)
+        self.run_id = f"{pd.Timestamp.now():%Y%m%d_%H%M%S}"
+        self.results = {}
+        self.lock = threading.Lock()
+        self.tracing_stages = 0
+
+    @contextmanager
+    def measure(self, stage: str):
+        """
+        Measures the stage 'stage', run inside the 'with' block, and records its
+        measurements once it finishes, whether it succeeds or not. The stage reports its
+        rows and bytes to current_stage_metrics.
+
+        Args:
+            stage (str): the name of the stage.
+
+        Yields:
+            StageMetrics: the measurements of the stage.
+        """
+
+        metrics = StageMetrics(stage=stage)
+        profiler = self.start_cprofile(stage) if "cprofile" in self.profilers else None
+        snapshot = self.start_tracemalloc() if "tracemalloc" in self.profilers else None
+        rss_sampler = RSSSampler()
+
+        _current.metrics = metrics
+        start_wall, start_cpu = time.perf_counter(), time.thread_time()
+        start_process_cpu = time.process_time()
+
+        try:
+            yield metrics
+            metrics.status = "succeeded"
+        except Exception:
+            metrics.status = "failed"
+            raise
+        finally:
+            metrics.wall_time = time.perf_counter() - start_wall
+            metrics.cpu_time = time.thread_time() - start_cpu
+            metrics.process_cpu_time = time.process_time() - start_process_cpu
+            metrics.peak_rss_mb, metrics.rss_growth_mb = rss_sampler.stop()
+            _current.metrics = None
+
+            if profiler is not None:
+                profiler.disable()
+                self.write_cprofile(stage, profiler)
+            if snapshot is not None:
+                self.stop_tracemalloc(stage, snapshot)
+
+            self.record(metrics)
+
+    def start_cprofile(self, stage: str) -> cProfile.Profile:
+        """
+        Starts profiling the current thread with cProfile.
+
+        Args:
+            stage (str): the name of the stage.
+
+        Returns:
+            cProfile.Profile or None: the profiler, or None if it could not be started
+            (since Python 3.12, only one profiler can be active at a time).
+        """
+
+        profiler = cProfile.Profile()
+
+        try:
+            profiler.enable()
+        except ValueError as e:
+            self.logger.warning(f"Could not profile stage {stage} with cProfile: {e}")
+            return None
+
+        return profiler
+
+    def write_cprofile(self, stage: str, profiler: cProfile.Profile) -> None:
+        """
+        Writes the cProfile statistics of the stage 'stage' to <run_id>_<stage>.prof.
+
+        Args:
+            stage (str): the name of the stage.
+            profiler (cProfile.Profile): the profiler, disabled.
+        """
+
+        if self.metrics_path is None:
+            return
+
+        try:
+            path = self.metrics_path / f"{self.run_id}_{stage}.prof"
+            pstats.Stats(profiler).dump_stats(path)
+            self.logger.info(f"Profile of stage {stage} written to {path}.")
+        except Exception as e:
+            self.logger.error(f"Error writing the profile of stage {stage}: {e}")
+
+    def start_tracemalloc(self) -> tracemalloc.Snapshot:
+        """
+        Starts tracing the memory allocations, if no other stage is traced, and takes a
+        snapshot of them.
+
+        Returns:
+            tracemalloc.Snapshot: the snapshot at the start of the stage.
+        """
+
+        with self.lock:
+            if self.tracing_stages == 0 and not tracemalloc.is_tracing():
+                tracemalloc.start()
+            self.tracing_stages += 1
+
+        return tracemalloc.take_snapshot()
+
+    def stop_tracemalloc(self, stage: str, snapshot: tracemalloc.Snapshot) -> None:
+        """
+        Writes the lines of code that allocated the most memory since 'snapshot' to
+        <run_id>_<stage>.tracemalloc.txt, and stops tracing the memory allocations if no
+        other stage is traced.
+
+        Args:
+            stage (str): the name of the stage.
+            snapshot (tracemalloc.Snapshot): the snapshot at the start of the stage.
+        """
+
+        try:
+            statistics = tracemalloc.take_snapshot().compare_to(snapshot, "lineno")
+            _, peak = tracemalloc.get_traced_memory()
+
+            if self.metrics_path is not None:
+                path = self.metrics_path / f"{self.run_id}_{stage}.tracemalloc.txt"
+                with open(path, "w") as f:
+                    f.write(f"Peak traced memory: {peak / (1024 * 1024):.1f} MB\n")
+                    f.writelines(f"{statistic}\n" for statistic in statistics[:25])
+                self.logger.info(f"Memory profile of stage {stage} written to {path}.")
+        except Exception as e:
+            self.logger.error(f"Error writing the memory profile of stage {stage}: {e}")
+        finally:
+            with self.lock:
+                self.tracing_stages -= 1
+                if self.tracing_stages == 0:
+                    tracemalloc.stop()
+
+    def record(self, metrics: StageMetrics) -> None:
+        """
+        Records the measurements of a stage, in the format of the recorder. Errors are
+        logged, and never interrupt the pipeline.
+
+        Args:
+            metrics (StageMetrics): the measurements of the stage.
+        """
+
+        with self.lock:
+            self.results[metrics.stage] = metrics.as_dict()
+
+            if self.metrics_path is None:
+                return
+
+            try:
+                os.makedirs(self.metrics_path, exist_ok=True)
+
+                if self.output_format == "jsonl":
+                    with open(self.metrics_path / f"{self.file_name}.jsonl", "a") as f:
+                        f.write(
+                            json.dumps(
+                                {
+                                    "run_id": self.run_id,
+                                    "timestamp": pd.Timestamp.now().isoformat(),
+                                    **metrics.as_dict(),
+                                }
+                            )
+                            + "\n"
+                        )
+                else:
+                    self.write_prometheus()
+            except Exception as e:
+                self.logger.error(
+                    f"Error recording the metrics of stage {metrics.stage}: {e}"
+                )
+
+    def write_prometheus(self) -> None:
+        """
+        Writes the last measurements of each stage of the run to <file_name>.prom, in the
+        Prometheus text format. The file is replaced atomically.
+        """
+
+        gauges = {
+            "wall_time": ("pipeline_stage_wall_seconds", "Wall time of the stage."),
+            "cpu_time": (
+                "pipeline_stage_cpu_seconds",
+                "CPU time of the thread of the stage.",
+            ),
+            "process_cpu_time": (
+                "pipeline_stage_process_cpu_seconds",
+                "CPU time of the process during the stage.",
+            ),
+            "rows_in": ("pipeline_stage_rows_in", "Rows read by the stage."),
+            "rows_out": ("pipeline_stage_rows_out", "Rows written by the stage."),
+            "bytes_read": ("pipeline_stage_bytes_read", "Bytes read by the stage."),
+            "bytes_written": (
+                "pipeline_stage_bytes_written",
+                "Bytes written by the stage.",
+            ),
+            "duplicates": (
+                "pipeline_stage_duplicates",
+                "Duplicate rows rejected by the stage.",
+            ),
+            "peak_rss_mb": (
+                "pipeline_stage_peak_rss_megabytes",
+                "Peak resident memory of the process while the stage ran.",
+            ),
+            "rss_growth_mb": (
+                "pipeline_stage_rss_growth_megabytes",
+                "Growth of the resident memory of the process while the stage ran.",
+            ),
+        }
+
+        lines = []
+        for key, (name, description) in gauges.items():
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} gauge")
+            lines.extend(
+                f'{name}{{stage="{stage}",status="{result["status"]}"}} {result[key]}'
+                for stage, result in self.results.items()
+                if result[key] is not None
+            )
+
+        path = self.metrics_path / f"{self.file_name}.prom"
+        temporary_path = f"{path}.tmp"
+
+        with open(temporary_path, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(temporary_path, path)
@@ -1,8 +1,18 @@
+import json
+import time
+import random
 import requests
 import logging
 
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pydantic import ValidationError
+from requests.adapters import HTTPAdapter
+from email.utils import parsedate_to_datetime
 from utils.input_configuration import APIClientInputConfiguration
+from utils.rate_limiter import TokenBucketRateLimiter
+
+# The maximum number of cities the group endpoint of the API accepts in one request
+MAX_GROUP_SIZE = 20
 
 
 class WeatherAPIClient:
@@ -12,6 +22,12 @@ class WeatherAPIClient:
         api_key: str,
         units: str = "metric",
         language: str = "en",
+        timeout: float = 10.0,
+        max_concurrency: int = 8,
+        group_url: str = None,
+        max_retries: int = 3,
+        backoff_base: float = 1.0,
+        rate_limiter: TokenBucketRateLimiter = None,
         logger: logging.Logger = None,
     ):
         self.logger = (
@@ -25,9 +41,14 @@ class WeatherAPIClient:
         try:
             APIClientInputConfiguration(
                 base_url=base_url,
+                group_url=group_url,
                 api_key=api_key,
                 units=units,
                 language=language,
+                timeout=timeout,
+                max_concurrency=max_concurrency,
+                max_retries=max_retries,
+                backoff_base=backoff_base,
             )
         except ValidationError as e:
             self.logger.error(
@@ -36,34 +57,60 @@ class WeatherAPIClient:
             raise
 
         self.base_url = base_url
+        # The group endpoint lives next to the current weather endpoint, unless configured
+        self.group_url = group_url or f"{base_url.rstrip('/').rsplit('/', 1)[0]}/group"
         self.api_key = api_key
         self.units = units
         self.language = language
+        self.timeout = timeout
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.rate_limiter = rate_limiter
 
         self.logger.info("Input parameters validated successfully.")
 
-    def build_request_url(self, city: str) -> str:
+        # Keep-alive session, with a connection pool large enough for the concurrent requests
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_concurrency)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def build_request_url(self, city) -> str:
         """
-        Builds the URL used to make a request to the API using the city name. 
+        Builds the URL used to make a request to the API using the city name or ID.
         The request URL considered is of the form:
 
             https://api.openweathermap.org/data/2.5/weather? \
             q={city}&appid={api_key}&units={units}&lang={language}
 
+        Or, if the city ID is provided, of the form:
+
+            https://api.openweathermap.org/data/2.5/weather? \
+            id={city}&appid={api_key}&units={units}&lang={language}
+
         Where
             - city is the city for which weather data is to be retrieved
             - appid is the API Key
             - units is the units in which to retrieve the data (defaults to the metric system)
             - language is the language in which to retrieve the data (defaults to englis<h)
 
+        Querying by ID avoids geocoding the city name on every call.
+
         Args:
-            city (str): the city to which to fetch the weather data.
+            city (str or int): the city name or ID to which to fetch the weather data.
 
         Returns:
             str or None: the URL used to make the request to the API.
         """
 
-        if isinstance(city, str):
+        if isinstance(city, bool):
+            self.logger.error(f"Invalid city provided: {city}. Returning None.")
+            request_url = None
+        elif isinstance(city, int):
+            self.logger.info(f"Building URL with city ID {city}")
+            request_url = f"{self.base_url}?id={city}&appid={self.api_key}&units={self.units}&lang={self.language}"
+        elif isinstance(city, str):
             self.logger.info(f"Building URL with city name {city}")
             request_url = f"{self.base_url}?q={city}&appid={self.api_key}&units={self.units}&lang={self.language}"
         else:
@@ -72,15 +119,18 @@ class WeatherAPIClient:
 
         return request_url
 
-    def fetch_data(self, city: str) -> dict:
+    def fetch_data(self, city, raw: bool = False):
         """
         Fetches the data from the API for a given city.
 
         Args:
-            city (str): the city to which to fetch the weather data.
+            city (str or int): the city name or ID to which to fetch the weather data.
+            raw (bool): if True, the body of the response is returned as it was received,
+            without being parsed.
 
         Returns:
-            dict: the response JSON from the API, if successful. Otherwise, an empty dictionary,
+            dict or bytes: the response JSON from the API (or its raw bytes, if 'raw' is True),
+            if successful. Otherwise, an empty dictionary (or empty bytes).
         """
 
         self.logger.info("Fetching data from API")
@@ -90,18 +140,250 @@ class WeatherAPIClient:
 
         # If it is None, return empty dictionary
         if request_url:
-            response = requests.get(request_url)
+            content = self.get_content(request_url)
+        else:
+            content = b""
+
+        if raw:
+            result = content
+        else:
+            result = json.loads(content) if content else {}
+
+        return result
+
+    def get_json(self, request_url: str) -> dict:
+        """
+        Makes a GET request to 'request_url' and parses the response JSON.
+
+        Args:
+            request_url (str): the URL of the request.
+
+        Returns:
+            dict: the response JSON from the API, if successful. Otherwise, an empty dictionary,
+        """
+
+        content = self.get_content(request_url)
+
+        return json.loads(content) if content else {}
+
+    def get_content(self, request_url: str) -> bytes:
+        """
+        Makes a GET request to 'request_url' using the pooled session of the client.
+
+        Each attempt waits for a token of the client's rate limiter, if it has one. Requests
+        that fail with a 429 or 5xx status code, or with a connection error, are retried up
+        to 'max_retries' times. The wait before each retry is the one given by the
+        Retry-After header of the response or, if there is none, an exponential backoff with
+        full jitter. A Retry-After also pauses the rate limiter, holding back the other
+        concurrent requests.
+
+        Args:
+            request_url (str): the URL of the request.
+
+        Returns:
+            bytes: the body of the response, if successful. Otherwise, empty bytes.
+        """
+
+        for attempt in range(self.max_retries + 1):
+            if self.rate_limiter:
+                self.rate_limiter.acquire()
+
+            retry_after = None
+
+            try:
+                response = self.session.get(request_url, timeout=self.timeout)
+            except requests.RequestException as e:
+                self.logger.error(
+                    f"The following error occured when fetching the data: {e}"
+                )
+            else:
+                if response.status_code == 200:
+                    self.logger.info("Data fetched successfully.")
+                    return response.content
 
-            if response.status_code != 200:
                 self.logger.error(
                     f"The following error occured when fetching the data: {response.status_code} - {response.text}"
                 )
-                result = {}
+
+                # Only rate limiting and server errors are worth retrying
+                if response.status_code != 429 and response.status_code < 500:
+                    return b""
+
+                retry_after = self.parse_retry_after(
+                    response.headers.get("Retry-After")
+                )
+
+            if attempt == self.max_retries:
+                break
+
+            if retry_after is not None:
+                delay = retry_after
+                if self.rate_limiter:
+                    self.rate_limiter.pause(delay)
             else:
-                self.logger.info("Data fetched successfully.")
-                result = response.json()
+                delay = random.uniform(0, self.backoff_base * 2**attempt)
+
+            self.logger.info(
+                f"Retrying in {delay:.1f} seconds (attempt {attempt + 1} of {self.max_retries})."
+            )
+            time.sleep(delay)
+
+        self.logger.error(f"Giving up after {self.max_retries} retries.")
+
+        return b""
+
+    @staticmethod
+    def parse_retry_after(retry_after: str) -> float:
+        """
+        Parses the value of a Retry-After header, which is either a number of seconds or an
+        HTTP date.
+
+        Args:
+            retry_after (str): the value of the header.
+
+        Returns:
+            float or None: the number of seconds to wait, or None if the header is missing
+            or invalid.
+        """
+
+        if not retry_after:
+            return None
 
+        try:
+            return max(0.0, float(retry_after))
+        except ValueError:
+            pass
+
+        try:
+            return max(
+                0.0, parsedate_to_datetime(retry_after).timestamp() - time.time()
+            )
+        except (TypeError, ValueError):
+            return None
+
+    def fetch_many(self, cities: list, max_concurrency: int = None, raw: bool = False):
+        """
+        Fetches the data from the API for several cities concurrently, using the pooled
+        keep-alive session of the client. At most 'max_concurrency' requests are in flight
+        at any time, and each of them is bound by the client's timeout.
+
+        Args:
+            cities (list): the city names or IDs to which to fetch the weather data.
+            max_concurrency (int): maximum number of concurrent requests. Defaults to the
+            value the client was created with.
+            raw (bool): if True, the bodies of the responses are returned without being parsed.
+
+        Yields:
+            tuple: (city, result) pairs, in the order the requests complete. The result is
+            the same as the one returned by fetch_data.
+        """
+
+        max_concurrency = max_concurrency or self.max_concurrency
+        self.logger.info(
+            f"Fetching data from API for {len(cities)} cities, "
+            f"with up to {max_concurrency} concurrent requests"
+        )
+
+        with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+            futures = {
+                executor.submit(self.fetch_data, city, raw): city for city in cities
+            }
+
+            for future in as_completed(futures):
+                yield futures[future], future.result()
+
+    def build_group_request_url(self, city_ids: list) -> str:
+        """
+        Builds the URL used to make a request to the group endpoint of the API, which
+        returns the current weather of up to 20 cities in a single call. The request URL
+        considered is of the form:
+
+            https://api.openweathermap.org/data/2.5/group? \
+            id={id_1},{id_2},...&appid={api_key}&units={units}&lang={language}
+
+        Args:
+            city_ids (list): the IDs of the cities to which to fetch the weather data.
+
+        Returns:
+            str or None: the URL used to make the request to the API.
+        """
+
+        if city_ids and all(isinstance(city_id, int) for city_id in city_ids):
+            self.logger.info(f"Building group URL with {len(city_ids)} city IDs")
+            ids = ",".join(str(city_id) for city_id in city_ids)
+            request_url = f"{self.group_url}?id={ids}&appid={self.api_key}&units={self.units}&lang={self.language}"
+        else:
+            self.logger.error(f"Invalid city IDs provided: {city_ids}. Returning None.")
+            request_url = None
+
+        return request_url
+
+    def fetch_group(self, city_ids: list) -> list:
+        """
+        Fetches the data from the group endpoint of the API for up to 20 cities.
+
+        Args:
+            city_ids (list): the IDs of the cities to which to fetch the weather data.
+
+        Returns:
+            list: the weather data of each city, in the same format as the response of
+            fetch_data. Empty if the request was not successful.
+        """
+
+        self.logger.info("Fetching group data from API")
+
+        request_url = self.build_group_request_url(city_ids)
+
+        if request_url:
+            result = self.get_json(request_url).get("list", [])
         else:
-            result = {}
+            result = []
 
         return result
+
+    def fetch_many_groups(
+        self, city_ids: list, group_size: int = 20, max_concurrency: int = None
+    ):
+        """
+        Fetches the data from the group endpoint of the API for several cities. The city
+        IDs are split into chunks of 'group_size', and one request is made per chunk, with
+        at most 'max_concurrency' requests in flight at any time.
+
+        Args:
+            city_ids (list): the IDs of the cities to which to fetch the weather data.
+            group_size (int): number of cities per request, between 1 and MAX_GROUP_SIZE.
+            max_concurrency (int): maximum number of concurrent requests. Defaults to the
+            value the client was created with.
+
+        Raises:
+            ValueError: if 'group_size' is not between 1 and MAX_GROUP_SIZE.
+
+        Yields:
+            tuple: (chunk, result) pairs, in the order the requests complete, where chunk is
+            the list of city IDs of the request and result is the list returned by fetch_group.
+        """
+
+        if not 1 <= group_size <= MAX_GROUP_SIZE:
+            raise ValueError(
+                f"Invalid group size {group_size}: the group endpoint accepts between 1 "
+                f"and {MAX_GROUP_SIZE} cities per request."
+            )
+
+        chunks = [
+            city_ids[start : start + group_size]
+            for start in range(0, len(city_ids), group_size)
+        ]
+
+        max_concurrency = max_concurrency or self.max_concurrency
+        self.logger.info(
+            f"Fetching data from API for {len(city_ids)} cities in {len(chunks)} group requests, "
+            f"with up to {max_concurrency} concurrent requests"
+        )
+
+        with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+            futures = {
+                executor.submit(self.fetch_group, chunk): chunk for chunk in chunks
+            }
+
+            for future in as_completed(futures):
+                yield futures[future], future.result()
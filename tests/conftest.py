@@ -0,0 +1,147 @@
+import sys
+import json
+import random
+import shutil
+
+import pytest
+
+from pathlib import Path
+
+# Add the src and benchmarks directories to sys.path to get the stages and the
+# synthetic data generators
+ROOT_PATH = Path(__file__).parent.parent
+sys.path.append(str(ROOT_PATH / "src"))
+sys.path.append(str(ROOT_PATH / "benchmarks"))
+
+import synthetic_data
+
+from utils.raw_batch_writer import NDJSONBatchWriter
+from utils.pipeline_context import PipelineContext
+
+
+@pytest.fixture
+def workspace(tmp_path: Path) -> dict:
+    """
+    A workspace with synthetic raw data: the measurements of 5 cities at 2 timestamps, in
+    NDJSON batches, and a city list of 50 cities (see synthetic_data.write_workspace), with
+    the weather codes of the repo.
+
+    Returns:
+        dict: the environment variables of the workspace.
+    """
+
+    env_variables = synthetic_data.write_workspace(
+        workspace=tmp_path, n_cities=5, n_timestamps=2, n_city_list=50
+    )
+    shutil.copy(
+        ROOT_PATH / "data" / "raw" / "weather_codes" / "weather_codes.csv",
+        env_variables["RAW_WEATHER_CODES_PATH"],
+    )
+
+    return env_variables
+
+
+def build_context(env_variables: dict) -> PipelineContext:
+    """
+    Builds the context of a run over a workspace, from its config file.
+
+    Args:
+        env_variables (dict): the environment variables of the workspace.
+
+    Returns:
+        PipelineContext: the context.
+    """
+
+    with open(env_variables["CONFIG_PATH"], "r") as f:
+        config = json.load(f)
+
+    return PipelineContext(env_variables=env_variables, config=config)
+
+
+def update_config(env_variables: dict, update) -> None:
+    """
+    Updates the config file of a workspace.
+
+    Args:
+        env_variables (dict): the environment variables of the workspace.
+        update (callable): the function updating the config, in place.
+    """
+
+    with open(env_variables["CONFIG_PATH"], "r") as f:
+        config = json.load(f)
+
+    update(config)
+
+    with open(env_variables["CONFIG_PATH"], "w") as f:
+        json.dump(config, f, indent=4)
+
+
+def run_stages(env_variables: dict, stages: list) -> PipelineContext:
+    """
+    Runs the stages 'stages', in order, with the context of a new run.
+
+    Args:
+        env_variables (dict): the environment variables of the workspace.
+        stages (list): the stages.
+
+    Returns:
+        PipelineContext: the context of the run.
+    """
+
+    context = build_context(env_variables)
+    for stage in stages:
+        stage(context=context)
+
+    return context
+
+
+def write_weather_batch(
+    env_variables: dict, file_name: str, n_cities: int, dts: list, seed: int = 1
+) -> None:
+    """
+    Writes an NDJSON batch with the measurements of the first 'n_cities' cities of the city
+    list of the workspace at the timestamps 'dts'.
+
+    Args:
+        env_variables (dict): the environment variables of the workspace.
+        file_name (str): the name of the batch, without extension.
+        n_cities (int): the number of cities.
+        dts (list): the timestamps, in seconds since the epoch.
+        seed (int): the seed of the random number generator.
+    """
+
+    cities = get_city_list(env_variables)[:n_cities]
+    rng = random.Random(seed)
+    writer = NDJSONBatchWriter(
+        directory=env_variables["RAW_WEATHER_DATA_PATH"] / "_batches",
+        file_name=file_name,
+    )
+
+    for dt in dts:
+        for city in cities:
+            document = synthetic_data.make_weather_document(rng, city, dt)
+            writer.write(json.dumps(document, separators=(",", ":")).encode())
+
+    writer.close()
+
+
+def get_city_list(env_variables: dict) -> list:
+    """
+    Gets the synthetic city list of the workspace.
+
+    Args:
+        env_variables (dict): the environment variables of the workspace.
+
+    Returns:
+        list: the cities, see synthetic_data.make_city.
+    """
+
+    with open(env_variables["CONFIG_PATH"], "r") as f:
+        config = json.load(f)
+
+    city_list_path = (
+        env_variables["RAW_CITY_CODES_PATH"]
+        / config["ingestion_layer"]["city_codes"]["file_name"]
+    )
+    with open(city_list_path, "r") as f:
+        return json.load(f)
@@ -0,0 +1,94 @@
+import pickle
+import logging
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from utils.city_index import CityIndex, normalize_city_name, resolve_cities
+
+CITIES = [
+    (1, "Lisburn", "", "GB"),
+    (2, "Lisbon", "", "PT"),
+    (3, "Springfield", "IL", "US"),
+    (4, "Springfield", "MO", "US"),
+    (5, "Springfield", "", "AU"),
+    (6, "São Tomé", "", "ST"),
+    (7, "São Paulo", "", "BR"),
+]
+
+
+def build_index() -> CityIndex:
+    entries = {}
+    for city in CITIES:
+        entries.setdefault(normalize_city_name(city[1]), []).append(city)
+
+    return CityIndex(entries=entries, names={city[0]: city[1] for city in CITIES})
+
+
+def test_resolve_exact_names():
+    index = build_index()
+
+    assert index.resolve("lisbon")[0] == 2
+    assert index.resolve("Springfield,AU")[0] == 5
+    assert index.resolve("Springfield,MO,US")[0] == 4
+
+
+def test_resolve_refuses_ambiguous_names():
+    index = build_index()
+
+    assert index.resolve("Springfield") is None
+    assert index.resolve("Springfield,US") is None
+
+
+def test_resolve_keeps_the_most_similar_name():
+    index = build_index()
+
+    # "lisbon" is more similar than "lisburn", which has a lower ID
+    assert index.resolve("Lisbn")[0] == 2
+
+
+def test_resolve_refuses_ambiguous_prefixes():
+    index = build_index()
+
+    # Both "sao paulo" and "sao tome" start with the query
+    assert index.resolve("Sao") is None
+    assert index.resolve("Sao,BR")[0] == 7
+    assert index.resolve("Sao P")[0] == 7
+
+
+def test_resolve_cities_skips_entries_without_id_or_name():
+    index = build_index()
+    logger = logging.getLogger(__name__)
+
+    cities = resolve_cities(
+        cities=[{"state": "IL"}, "Lisbon", {"id": 9, "name": "Porto"}],
+        index=index,
+        logger=logger,
+    )
+
+    assert cities == [{"id": 2, "name": "Lisbon"}, {"id": 9, "name": "Porto"}]
+
+
+def test_corrupted_index_is_rebuilt(tmp_path):
+    parquet_path = tmp_path / "city_codes.parquet"
+    index_path = tmp_path / "city_index.pkl"
+    pq.write_table(
+        pa.table(
+            {
+                "id": [city[0] for city in CITIES],
+                "name": [city[1] for city in CITIES],
+                "state": [city[2] for city in CITIES],
+                "country": [city[3] for city in CITIES],
+            }
+        ),
+        parquet_path,
+    )
+
+    # A truncated index, newer than the city codes
+    with open(index_path, "wb") as f:
+        f.write(pickle.dumps(({}, {}))[:5])
+
+    index = CityIndex.load_or_build(parquet_path=parquet_path, index_path=index_path)
+
+    assert index.resolve("Lisbon")[0] == 2
+    assert CityIndex.load(index_path).resolve("Lisbon")[0] == 2
@@ -0,0 +1,121 @@
+import os
+
+import pytest
+
+from conftest import run_stages, write_weather_batch
+
+import synthetic_data
+
+from loading.loading_weather_data import load_weather_data
+from processing.processing_weather_data import process_weather_data
+from compaction import compaction_datasets
+from compaction.compaction_datasets import compact_datasets, recover_compactions
+from utils.auxiliary_functions import (
+    PROCESSED_WEATHER_DATA_PARTITIONING,
+    list_dataset_files,
+    open_parquet_dataset,
+)
+
+STAGES = [load_weather_data, process_weather_data]
+
+
+@pytest.fixture
+def fragmented_workspace(workspace):
+    """
+    A workspace whose processed weather data has three fragments in the same partition,
+    written by three runs.
+    """
+
+    run_stages(workspace, STAGES)
+    for i in range(2):
+        write_weather_batch(
+            workspace,
+            file_name=f"run_{i}",
+            n_cities=5,
+            dts=[synthetic_data.FIRST_DT + (i + 2) * 1800],
+        )
+        run_stages(workspace, STAGES)
+
+    return workspace
+
+
+def get_processed_path(env_variables: dict):
+    return env_variables["PROCESSED_FILES_PATH"] / "weather_data_processed"
+
+
+def count_rows(env_variables: dict) -> int:
+    return open_parquet_dataset(
+        path=get_processed_path(env_variables),
+        partitioning=PROCESSED_WEATHER_DATA_PARTITIONING,
+        logger=compaction_datasets.logger,
+    ).count_rows()
+
+
+def test_compaction_merges_the_fragments(fragmented_workspace):
+    dataset_path = get_processed_path(fragmented_workspace)
+    assert (
+        len(list_dataset_files(dataset_path, PROCESSED_WEATHER_DATA_PARTITIONING)) == 3
+    )
+
+    run_stages(fragmented_workspace, [compact_datasets])
+
+    files = list_dataset_files(dataset_path, PROCESSED_WEATHER_DATA_PARTITIONING)
+    assert len(files) == 1
+    assert files[0].name.startswith("part-compacted-")
+    assert not list(dataset_path.glob("*/_compaction-*.json"))
+    assert count_rows(fragmented_workspace) == 20
+
+
+def test_crash_after_the_swap_is_invisible_and_recovered(
+    fragmented_workspace, monkeypatch
+):
+    dataset_path = get_processed_path(fragmented_workspace)
+
+    # Crash after the compacted file was renamed into place, before the fragments are
+    # removed
+    def crash(path):
+        raise OSError("crash")
+
+    monkeypatch.setattr(compaction_datasets.os, "remove", crash)
+    run_stages(fragmented_workspace, [compact_datasets])
+    monkeypatch.undo()
+
+    # Both the fragments and the compacted file are on disk, but the readers only see
+    # the compacted file
+    assert len(list(dataset_path.glob("*/*.parquet"))) == 4
+    assert count_rows(fragmented_workspace) == 20
+
+    recover_compactions(dataset_path, PROCESSED_WEATHER_DATA_PARTITIONING)
+
+    assert len(list(dataset_path.glob("*/*.parquet"))) == 1
+    assert not list(dataset_path.glob("*/_compaction-*.json"))
+    assert count_rows(fragmented_workspace) == 20
+
+
+def test_crash_before_the_swap_is_discarded(fragmented_workspace, monkeypatch):
+    dataset_path = get_processed_path(fragmented_workspace)
+    fragments = list_dataset_files(dataset_path, PROCESSED_WEATHER_DATA_PARTITIONING)
+
+    # Crash once the marker is written, before the compacted file is renamed into place
+    replace = os.replace
+
+    def crash(source, destination):
+        if str(destination).endswith(".parquet"):
+            raise OSError("crash")
+        replace(source, destination)
+
+    monkeypatch.setattr(compaction_datasets.os, "replace", crash)
+    run_stages(fragmented_workspace, [compact_datasets])
+    monkeypatch.undo()
+
+    assert count_rows(fragmented_workspace) == 20
+
+    recover_compactions(dataset_path, PROCESSED_WEATHER_DATA_PARTITIONING)
+
+    assert (
+        list_dataset_files(dataset_path, PROCESSED_WEATHER_DATA_PARTITIONING)
+        == fragments
+    )
+    assert not [
+        path for path in os.listdir(fragments[0].parent) if path.startswith((".", "_"))
+    ]
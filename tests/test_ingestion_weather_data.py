@@ -0,0 +1,112 @@
+import os
+import json
+import random
+import threading
+
+import pytest
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from conftest import get_city_list, run_stages, update_config
+
+import synthetic_data
+
+from ingestion.ingestion_weather_data import ingest_weather_data
+from loading.loading_city_codes import load_city_codes
+from processing.processing_city_codes import process_city_codes
+
+STAGES = [load_city_codes, process_city_codes, ingest_weather_data]
+
+
+@pytest.fixture
+def weather_server(workspace):
+    """
+    A local stand-in of the weather API, answering the group endpoint with one synthetic
+    measurement per city of the workspace. The IDs of each group request are recorded.
+
+    Yields:
+        tuple: the URL of the current weather endpoint and the list of the IDs of each
+        group request.
+    """
+
+    cities = {city["id"]: city for city in get_city_list(workspace)}
+    requests = []
+    lock = threading.Lock()
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urlparse(self.path)
+            ids = [int(city_id) for city_id in parse_qs(url.query)["id"][0].split(",")]
+            rng = random.Random(0)
+
+            if url.path.endswith("/group"):
+                with lock:
+                    requests.append(ids)
+                body = {
+                    "cnt": len(ids),
+                    "list": [
+                        synthetic_data.make_weather_document(
+                            rng, cities[city_id], 1_700_000_000
+                        )
+                        for city_id in ids
+                    ],
+                }
+            else:
+                body = synthetic_data.make_weather_document(
+                    rng, cities[ids[0]], 1_700_000_000
+                )
+
+            content = json.dumps(body).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    yield f"http://127.0.0.1:{server.server_port}/data/2.5/weather", requests
+
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.mark.parametrize(
+    "group_size, chunk_sizes", [(2, [1, 2, 2]), (0, [1] * 5), (50, [5])]
+)
+def test_group_mode_fans_out_chunks_into_city_files(
+    workspace, weather_server, group_size, chunk_sizes
+):
+    base_url, requests = weather_server
+    city_ids = [city["id"] for city in get_city_list(workspace)[:5]]
+
+    def configure(config):
+        config["cities"] = [{"id": city_id} for city_id in city_ids]
+        config["api"].update(
+            base_url=base_url, mode="group", group_size=group_size, rate_limit={}
+        )
+
+    update_config(workspace, configure)
+    workspace["API_KEY"] = "test"
+
+    run_stages(workspace, STAGES)
+
+    # The IDs are split into chunks of the (clamped) group size, each requested once
+    assert sorted(len(chunk) for chunk in requests) == chunk_sizes
+    assert sorted(city_id for chunk in requests for city_id in chunk) == sorted(
+        city_ids
+    )
+
+    # And each city of a response is stored in its own file
+    raw_files_path = workspace["RAW_WEATHER_DATA_PATH"]
+    for city_id in city_ids:
+        file_name = f"20231114_221320_{city_id}.json"
+        assert os.listdir(raw_files_path / str(city_id)) == [file_name]
+        with open(raw_files_path / str(city_id) / file_name, "r") as f:
+            assert json.load(f)["id"] == city_id
@@ -0,0 +1,157 @@
+import os
+import json
+import random
+
+import pytest
+import pyarrow.dataset as ds
+
+from conftest import get_city_list, run_stages, update_config
+
+import synthetic_data
+
+from ingestion.ingestion_weather_data import save_city_weather_data
+from loading.loading_city_codes import load_city_codes
+from loading import loading_weather_data
+from loading.loading_weather_data import load_weather_data
+from processing.processing_city_codes import process_city_codes
+from utils.last_seen_cache import LastSeenCache
+
+STAGES = [load_city_codes, process_city_codes, load_weather_data]
+
+
+def test_cities_sharing_a_name_are_stored_and_loaded_apart(workspace, tmp_path):
+    # Two cities of the list, outside the batches of the workspace, with the same name,
+    # and a city that is not in the list, queried by name
+    cities = [
+        {**city, "name": "Springfield"} for city in get_city_list(workspace)[10:12]
+    ]
+    unlisted_city = {**get_city_list(workspace)[12], "name": "Atlantis"}
+    update_config(
+        workspace,
+        lambda config: config.update(
+            cities=[{"id": city["id"], "name": city["name"]} for city in cities]
+            + ["Atlantis"]
+        ),
+    )
+
+    rng = random.Random(0)
+    last_seen_cache = LastSeenCache(path=tmp_path / "last_seen.json")
+    raw_files_path = workspace["RAW_WEATHER_DATA_PATH"]
+    for city in cities:
+        save_city_weather_data(
+            city_weather_data=synthetic_data.make_weather_document(
+                rng, city, 1_700_000_000
+            ),
+            raw_files_path=raw_files_path,
+            last_seen_cache=last_seen_cache,
+        )
+    save_city_weather_data(
+        city_weather_data=synthetic_data.make_weather_document(
+            rng, unlisted_city, 1_700_000_000
+        ),
+        raw_files_path=raw_files_path,
+        last_seen_cache=last_seen_cache,
+        directory_name="Atlantis",
+    )
+
+    for city in cities:
+        assert os.listdir(raw_files_path / str(city["id"])) == [
+            f"20231114_221320_{city['id']}.json"
+        ]
+
+    run_stages(workspace, STAGES)
+    # Running again finds no new files
+    run_stages(workspace, STAGES)
+
+    loaded = ds.dataset(
+        workspace["LOADED_FILES_PATH"] / "weather_data_loaded",
+        format="parquet",
+        partitioning="hive",
+    ).to_table()
+
+    # The 10 measurements of the batches, and one of each city
+    assert loaded.num_rows == 13
+    assert {city["id"] for city in cities + [unlisted_city]} <= set(
+        loaded.column("city").to_pylist()
+    )
+
+
+@pytest.mark.parametrize("visibility", [5678, 5678.5])
+def test_files_with_the_same_name_in_two_directories_are_both_loaded(
+    workspace, visibility
+):
+    # A city fetched by ID, and by name in an earlier run. The second visibility is
+    # either valid or a decimal in an integer field, which makes the bulk read fail and
+    # the files be read one by one
+    city = get_city_list(workspace)[10]
+    update_config(
+        workspace,
+        lambda config: config.update(cities=[{"id": city["id"], "name": city["name"]}]),
+    )
+
+    raw_files_path = workspace["RAW_WEATHER_DATA_PATH"]
+    rng = random.Random(0)
+    for directory, document_visibility in [
+        (str(city["id"]), 1234),
+        (city["name"], visibility),
+    ]:
+        document = synthetic_data.make_weather_document(rng, city, 1_700_000_000)
+        document["visibility"] = document_visibility
+        os.makedirs(raw_files_path / directory)
+        with open(
+            raw_files_path / directory / f"20231114_221320_{city['id']}.json", "w"
+        ) as f:
+            json.dump(document, f)
+
+    run_stages(workspace, STAGES)
+    run_stages(workspace, STAGES)
+
+    loaded = ds.dataset(
+        workspace["LOADED_FILES_PATH"] / "weather_data_loaded",
+        format="parquet",
+        partitioning="hive",
+    ).to_table(filter=ds.field("city") == city["id"])
+
+    assert sorted(loaded.column("visibility").to_pylist()) == [1234, 5678]
+
+
+@pytest.mark.parametrize(
+    "failing_step, staged",
+    [("publish_staged_fragments", True), ("stage_dataset_fragments", False)],
+)
+def test_crash_while_loading_a_batch_is_replayed_from_the_manifest(
+    workspace, monkeypatch, failing_step, staged
+):
+    stage_dataset_fragments = loading_weather_data.stage_dataset_fragments
+
+    def crash(**kwargs):
+        # Staging crashes after writing the fragments, before the _SUCCESS marker
+        if failing_step == "stage_dataset_fragments":
+            stage_dataset_fragments(**kwargs)
+            os.remove(
+                kwargs["dataset_path"] / "_staging" / kwargs["batch_id"] / "_SUCCESS"
+            )
+        raise OSError("Simulated crash")
+
+    dataset_path = workspace["LOADED_FILES_PATH"] / "weather_data_loaded"
+
+    # A crash while staging the fragments of the batch, or after staging them and
+    # before publishing, leaves the batch pending in the manifest
+    monkeypatch.setattr(loading_weather_data, failing_step, crash)
+    run_stages(workspace, STAGES)
+    monkeypatch.undo()
+
+    staging_directories = os.listdir(dataset_path / "_staging")
+    assert len(staging_directories) == 1
+    assert (
+        os.path.exists(dataset_path / "_staging" / staging_directories[0] / "_SUCCESS")
+        == staged
+    )
+
+    # The next run publishes the batch, or discards it and loads its files again
+    run_stages(workspace, STAGES)
+    run_stages(workspace, STAGES)
+
+    loaded = ds.dataset(dataset_path, format="parquet", partitioning="hive").to_table()
+    assert loaded.num_rows == 10
+    assert not os.path.exists(dataset_path / "_staging")
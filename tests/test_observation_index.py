@@ -0,0 +1,49 @@
+import numpy as np
+
+from utils.observation_index import ObservationIndex, merge_sorted_keys
+
+
+def test_merge_sorted_keys():
+    keys = np.array([1, 5, 9], dtype=np.int64)
+    new_keys = np.array([0, 5, 7, 12], dtype=np.int64)
+
+    assert merge_sorted_keys(keys, new_keys).tolist() == [0, 1, 5, 7, 9, 12]
+
+
+def test_runs_write_segments_until_they_are_merged(tmp_path):
+    path = tmp_path / "observations.npz"
+    index = ObservationIndex(path=path, max_segments=3)
+    index.reset(keys=np.array([10, 20], dtype=np.int64), watermark="w0")
+    index.save()
+
+    for run in range(1, 5):
+        index = ObservationIndex(path=path, max_segments=3)
+        assert index.is_consistent(f"w{run - 1}")
+
+        keys = np.array([run, 10, run], dtype=np.int64)
+        is_new = index.filter_new(keys)
+        assert is_new.tolist() == [True, False, False]
+
+        index.add(keys=keys[is_new], watermark=f"w{run}")
+        index.save()
+
+        segments = ObservationIndex.list_segments(path)
+        # The third run merges the segments into the base file
+        assert len(segments) == {1: 1, 2: 2, 3: 0, 4: 1}[run]
+
+    index = ObservationIndex(path=path, max_segments=3)
+    assert index.is_consistent("w4")
+    assert len(index) == 6
+    assert index.filter_new(np.array([1, 2, 3, 4, 10, 20, 5])).tolist() == [
+        False,
+        False,
+        False,
+        False,
+        False,
+        False,
+        True,
+    ]
+
+    ObservationIndex.remove(path)
+    assert not ObservationIndex(path=path).loaded
+    assert ObservationIndex.list_segments(path) == []
@@ -0,0 +1,149 @@
+import os
+import json
+
+import pytest
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+
+from conftest import build_context, run_stages, write_weather_batch
+
+import synthetic_data
+
+from loading.loading_weather_data import load_weather_data
+from processing import processing_weather_data
+from processing.processing_weather_data import (
+    get_processing_state_path,
+    process_weather_data,
+)
+
+STAGES = [load_weather_data, process_weather_data]
+
+# The timestamp after the two timestamps of the workspace
+NEXT_DT = synthetic_data.FIRST_DT + 2 * 1800
+
+
+def read_processed(env_variables: dict):
+    return ds.dataset(
+        env_variables["PROCESSED_FILES_PATH"] / "weather_data_processed",
+        format="parquet",
+        partitioning="hive",
+    ).to_table(columns=["city_id", "time_value", "ingestion_date"])
+
+
+def read_state(env_variables: dict) -> dict:
+    state_path = get_processing_state_path(
+        config=build_context(env_variables).config,
+        processed_files_path=env_variables["PROCESSED_FILES_PATH"],
+    )
+    with open(state_path, "r") as f:
+        return json.load(f)
+
+
+def count_unique_observations(table) -> int:
+    return len(
+        set(
+            zip(
+                table.column("city_id").to_pylist(),
+                table.column("time_value").to_pylist(),
+            )
+        )
+    )
+
+
+def test_runs_only_process_the_rows_loaded_since_the_last_run(workspace):
+    run_stages(workspace, STAGES)
+    first_run = read_processed(workspace)
+    assert first_run.num_rows == 10
+
+    # New measurements, loaded and processed by the second run
+    write_weather_batch(workspace, "later", n_cities=5, dts=[NEXT_DT], seed=2)
+    run_stages(workspace, STAGES)
+
+    processed = read_processed(workspace)
+    assert processed.num_rows == 15
+    assert count_unique_observations(processed) == 15
+
+    # Only the new rows were processed by the second run, the others were kept
+    second_run = processed.filter(
+        pc.greater(
+            processed.column("ingestion_date"),
+            pc.max(first_run.column("ingestion_date")),
+        )
+    )
+    assert second_run.num_rows == 5
+    assert {
+        value.timestamp() for value in second_run.column("time_value").to_pylist()
+    } == {NEXT_DT}
+
+    # Measurements already processed, loaded again, are rejected
+    write_weather_batch(workspace, "repeated", n_cities=5, dts=[NEXT_DT], seed=3)
+    run_stages(workspace, STAGES)
+
+    assert read_processed(workspace).num_rows == 15
+    assert read_state(workspace)["pending"] is None
+
+
+@pytest.mark.parametrize(
+    "failing_step, staged",
+    [("publish_staged_fragments", True), ("stage_dataset_fragments", False)],
+)
+def test_crash_between_staging_and_publishing_is_recovered(
+    workspace, monkeypatch, failing_step, staged
+):
+    stage_dataset_fragments = processing_weather_data.stage_dataset_fragments
+
+    def crash(**kwargs):
+        # Staging crashes after writing the fragments, before the _SUCCESS marker
+        if failing_step == "stage_dataset_fragments":
+            stage_dataset_fragments(**kwargs)
+            os.remove(
+                kwargs["dataset_path"] / "_staging" / kwargs["batch_id"] / "_SUCCESS"
+            )
+        raise OSError("Simulated crash")
+
+    run_stages(workspace, STAGES)
+    first_watermark = read_state(workspace)["watermark"]
+
+    # The second run crashes while staging its fragments, or after staging them and
+    # before publishing
+    write_weather_batch(workspace, "later", n_cities=5, dts=[NEXT_DT], seed=2)
+    monkeypatch.setattr(processing_weather_data, failing_step, crash)
+    run_stages(workspace, STAGES)
+    monkeypatch.undo()
+
+    state = read_state(workspace)
+    assert state["watermark"] == first_watermark
+    assert state["pending"] is not None
+    processed_path = workspace["PROCESSED_FILES_PATH"] / "weather_data_processed"
+    batch_id = state["pending"]["batch_id"]
+    assert os.path.exists(processed_path / "_staging" / batch_id / "_SUCCESS") == staged
+    assert read_processed(workspace).num_rows == 10
+
+    # The next run publishes the staged batch, or discards it and processes the rows
+    # again, without duplicating them
+    run_stages(workspace, STAGES)
+
+    processed = read_processed(workspace)
+    assert processed.num_rows == 15
+    assert count_unique_observations(processed) == 15
+
+    # The fragments of the staged batch are only kept if it was published
+    fragments = ds.dataset(processed_path, format="parquet").files
+    assert any(f"part-{batch_id}-" in fragment for fragment in fragments) == staged
+
+    state = read_state(workspace)
+    assert state["pending"] is None
+    assert state["watermark"] != first_watermark
+    assert not os.path.exists(processed_path / "_staging")
+
+    # And the observation index matches the processed data
+    write_weather_batch(
+        workspace,
+        "repeated",
+        n_cities=5,
+        dts=[synthetic_data.FIRST_DT, NEXT_DT],
+        seed=3,
+    )
+    run_stages(workspace, STAGES)
+
+    assert read_processed(workspace).num_rows == 15
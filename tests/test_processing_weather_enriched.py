@@ -0,0 +1,44 @@
+import pyarrow.dataset as ds
+
+from conftest import run_stages, update_config
+
+from loading.loading_weather_codes import load_weather_codes
+from loading.loading_city_codes import load_city_codes
+from loading.loading_weather_data import load_weather_data
+from processing.processing_weather_codes import process_weather_codes
+from processing.processing_city_codes import process_city_codes
+from processing.processing_weather_data import process_weather_data
+from processing.processing_weather_enriched import process_weather_enriched
+
+STAGES = [
+    load_weather_codes,
+    process_weather_codes,
+    load_city_codes,
+    process_city_codes,
+    load_weather_data,
+    process_weather_data,
+    process_weather_enriched,
+]
+
+
+def count_rows(env_variables: dict, table_name: str) -> int:
+    return ds.dataset(
+        env_variables["PROCESSED_FILES_PATH"] / table_name,
+        format="parquet",
+        partitioning="hive",
+    ).count_rows()
+
+
+def test_enriched_view_is_rebuilt_with_the_processed_data(workspace):
+    run_stages(workspace, STAGES)
+    assert count_rows(workspace, "weather_data_enriched") == 10
+
+    # A full rebuild gives every processed row a new ingestion date
+    update_config(
+        workspace,
+        lambda config: config["processing_layer"]["weather_data"].update(mode="full"),
+    )
+    run_stages(workspace, STAGES)
+
+    assert count_rows(workspace, "weather_data_processed") == 10
+    assert count_rows(workspace, "weather_data_enriched") == 10
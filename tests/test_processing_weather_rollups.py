@@ -0,0 +1,99 @@
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+
+from conftest import run_stages, update_config, write_weather_batch
+
+import synthetic_data
+
+from loading.loading_weather_data import load_weather_data
+from processing.processing_weather_data import process_weather_data
+from processing.processing_weather_rollups import (
+    ROLLUP_GRAINS,
+    aggregate_partial_states,
+    process_weather_rollups,
+)
+
+STAGES = [load_weather_data, process_weather_data, process_weather_rollups]
+
+
+def read_rollups(env_variables: dict, grain: str):
+    return (
+        ds.dataset(
+            env_variables["PROCESSED_FILES_PATH"] / "weather_data_rollups",
+            format="parquet",
+            partitioning="hive",
+        )
+        .to_table(filter=ds.field("grain") == grain)
+        .drop_columns(["grain", "date"])
+        .sort_by([("city_id", "ascending"), ("bucket_start", "ascending")])
+    )
+
+
+def read_processed(env_variables: dict):
+    return ds.dataset(
+        env_variables["PROCESSED_FILES_PATH"] / "weather_data_processed",
+        format="parquet",
+        partitioning="hive",
+    ).to_table()
+
+
+def test_rollups_merge_runs_over_the_same_day(workspace):
+    run_stages(workspace, STAGES)
+
+    # A second run with later measurements of the same day, and of the same hours
+    write_weather_batch(
+        workspace,
+        file_name="second_run",
+        n_cities=5,
+        dts=[synthetic_data.FIRST_DT + 600, synthetic_data.FIRST_DT + 3 * 1800],
+    )
+    run_stages(workspace, STAGES)
+
+    processed = read_processed(workspace)
+    assert processed.num_rows == 20
+
+    for grain, unit in ROLLUP_GRAINS.items():
+        rollups = read_rollups(workspace, grain)
+        expected = aggregate_partial_states(
+            table=processed, unit=unit, measures=["temperature", "humidity"]
+        ).sort_by([("city_id", "ascending"), ("bucket_start", "ascending")])
+
+        assert rollups.num_rows == expected.num_rows
+        assert pc.sum(rollups.column("temperature_count")).as_py() == 20
+
+        for column in ["city_id", "bucket_start", "temperature_count"]:
+            assert rollups.column(column).equals(expected.column(column))
+        for column in ["temperature_min", "temperature_max", "humidity_max"]:
+            assert rollups.column(column).to_pylist() == (
+                expected.column(column).to_pylist()
+            )
+        for column in ["temperature_sum", "temperature_sumsq", "humidity_sum"]:
+            for value, expected_value in zip(
+                rollups.column(column).to_pylist(),
+                expected.column(column).to_pylist(),
+            ):
+                assert abs(value - expected_value) < 1e-6 * max(1, abs(expected_value))
+
+
+def test_rollups_skip_when_no_new_rows(workspace):
+    run_stages(workspace, STAGES)
+    daily = read_rollups(workspace, "daily")
+
+    run_stages(workspace, STAGES)
+
+    assert read_rollups(workspace, "daily").equals(daily)
+
+
+def test_rollups_are_rebuilt_with_the_processed_data(workspace):
+    run_stages(workspace, STAGES)
+
+    # A full rebuild gives every processed row a new ingestion date
+    update_config(
+        workspace,
+        lambda config: config["processing_layer"]["weather_data"].update(mode="full"),
+    )
+    run_stages(workspace, STAGES)
+
+    for grain in ROLLUP_GRAINS:
+        rollups = read_rollups(workspace, grain)
+        assert pc.sum(rollups.column("temperature_count")).as_py() == 10
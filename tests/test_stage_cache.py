@@ -0,0 +1,36 @@
+import os
+
+from conftest import run_stages
+
+from loading.loading_weather_codes import load_weather_codes
+from processing.processing_weather_codes import process_weather_codes
+from utils import auxiliary_functions
+from utils.stage_cache import StageCache
+
+STAGES = [load_weather_codes, process_weather_codes]
+
+
+def test_stage_reruns_when_the_utils_it_depends_on_change(workspace, monkeypatch):
+    processed_path = (
+        workspace["PROCESSED_FILES_PATH"] / "weather_codes_processed.parquet"
+    )
+
+    run_stages(workspace, STAGES)
+    first_mtime = os.stat(processed_path).st_mtime_ns
+
+    # Unchanged inputs, config and code: the stage is skipped
+    run_stages(workspace, STAGES)
+    assert os.stat(processed_path).st_mtime_ns == first_mtime
+
+    # A change in the helpers shaping the output makes it stale
+    hash_file = StageCache.hash_file
+
+    def changed_hash_file(self, path):
+        if os.path.samefile(path, auxiliary_functions.__file__):
+            return "changed"
+        return hash_file(self, path)
+
+    monkeypatch.setattr(StageCache, "hash_file", changed_hash_file)
+    run_stages(workspace, STAGES)
+
+    assert os.stat(processed_path).st_mtime_ns != first_mtime
@@ -0,0 +1,25 @@
+import time
+
+import numpy as np
+
+from utils.stage_metrics import MetricsRecorder
+
+
+def test_peak_memory_is_measured_per_stage():
+    recorder = MetricsRecorder(metrics_path=None)
+
+    with recorder.measure("large_stage"):
+        array = np.ones(200 * 1024 * 1024 // 8)
+        time.sleep(0.2)
+        del array
+
+    with recorder.measure("small_stage"):
+        time.sleep(0.2)
+
+    large_stage = recorder.results["large_stage"]
+    small_stage = recorder.results["small_stage"]
+
+    assert large_stage["rss_growth_mb"] > 150
+    assert small_stage["rss_growth_mb"] < 50
+    # The small stage is not charged with the peak of the stage before it
+    assert small_stage["peak_rss_mb"] < large_stage["peak_rss_mb"] - 100